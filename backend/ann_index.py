@@ -0,0 +1,354 @@
+from app import app
+from models import EmbeddingIndex
+from db_context import db_context
+from embedding_search import index_signature, load_matrix, normalize_rows, fetch_rows
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import or_
+import json
+import os
+import threading
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+
+# Índice aproximado (IVF-flat) sobre o EmbeddingIndex para a busca do RAG:
+# os vetores normalizados são agrupados em listas por k-means esférico e a
+# consulta só compara os vetores das ANN_NPROBE listas de centroide mais
+# próximo. Fica em disco ao lado do banco (instance/rag_ann):
+#   meta.json                  geração atual, dimensão e marca d'água
+#   base-<g>-*.npy             centroides, ids, listas e vetores (mmap)
+#   delta.npz                  linhas novas/alteradas desde a geração
+# Cada consulta compara a assinatura do EmbeddingIndex com a marca d'água e
+# aplica só as linhas alteradas ao delta (comparado inteiro, sem listas);
+# quando o delta passa de ANN_REBUILD_FRACTION da base (ou linhas foram
+# apagadas), a reconstrução roda numa thread em segundo plano.
+
+def index_dir() -> str:
+    return os.getenv('RAG_ANN_DIR') or os.path.join(app.instance_path, 'rag_ann')
+
+def default_nprobe() -> int:
+    return int(os.getenv('ANN_NPROBE') or 8)
+
+def rebuild_fraction() -> float:
+    return float(os.getenv('ANN_REBUILD_FRACTION') or 0.2)
+
+def nlist_for(count: int) -> int:
+    configured = os.getenv('ANN_NLIST')
+    nlist = int(configured) if configured else int(round(np.sqrt(count)))
+    return max(1, min(nlist, count))
+
+def _assign(matrix, centroids, chunk: int = 8192):
+    """
+    Centroide mais próximo (cosseno) de cada linha, em blocos
+    """
+    lists = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk):
+        lists[start:start + chunk] = np.argmax(matrix[start:start + chunk] @ centroids.T, axis=1)
+    return lists
+
+def train_centroids(matrix, nlist: int, iterations: int = 10, seed: int = 0):
+    """
+    k-means esférico numa amostra (até 64 vetores por lista)
+    """
+    rng = np.random.default_rng(seed)
+    sample = matrix[np.sort(rng.choice(len(matrix), size=min(len(matrix), nlist * 64), replace=False))]
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        lists = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        empty = np.bincount(lists, minlength=nlist) == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+def _format_time(value):
+    return value.isoformat() if value else None
+
+@contextmanager
+def _file_lock(blocking: bool = True):
+    """
+    Trava entre processos para escrever o índice; com blocking=False entrega
+    False sem esperar se outro processo (um rebuild) está com ela
+    """
+    os.makedirs(index_dir(), exist_ok=True)
+    with open(os.path.join(index_dir(), '.lock'), 'a') as handle:
+        acquired = True
+        if fcntl:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                acquired = False
+        try:
+            yield acquired
+        finally:
+            if fcntl and acquired:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _base_path(generation: int, name: str) -> str:
+    return os.path.join(index_dir(), f"base-{generation}-{name}.npy")
+
+class IVFIndex:
+    def __init__(self, meta, centroids, ids, lists, vectors, delta):
+        self.meta = meta
+        self.centroids = centroids
+        self.ids = ids
+        self.lists = lists
+        self.vectors = vectors  # mmap somente leitura
+        self.order = np.argsort(lists, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(centroids)))])
+        self.delta_ids = delta["ids"]
+        self.delta_vectors = delta["vectors"]
+        self.watermark = delta["watermark"]
+        # Linhas da base substituídas por uma versão mais nova no delta
+        self.alive = ~np.isin(ids, self.delta_ids)
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    @property
+    def count(self) -> int:
+        return int(self.alive.sum()) + len(self.delta_ids)
+
+    def search(self, query, k: int, nprobe: int):
+        """
+        (ids, scores) aproximados, ou None se a consulta tem outra dimensão
+        """
+        q = normalize_rows(np.asarray(query, dtype=np.float32))
+        if q.shape != (self.dim,):
+            return None
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+        probe = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+
+        positions = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in probe])
+        positions = np.sort(positions[self.alive[positions]])  # leitura sequencial no mmap
+        # O delta (pequeno) é comparado inteiro
+        ids = np.concatenate([self.ids[positions], self.delta_ids])
+        scores = np.concatenate([self.vectors[positions] @ q, self.delta_vectors @ q])
+        if not len(scores):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return ids[best], scores[best]
+
+def _empty_delta(dim: int, watermark: dict):
+    return {
+        "ids": np.empty(0, dtype=np.int64),
+        "vectors": np.empty((0, dim), dtype=np.float32),
+        "watermark": watermark,
+    }
+
+def _load_from_disk():
+    meta_path = os.path.join(index_dir(), 'meta.json')
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        g = meta["generation"]
+        centroids = np.load(_base_path(g, 'centroids'))
+        ids = np.load(_base_path(g, 'ids'))
+        lists = np.load(_base_path(g, 'lists'))
+        vectors = np.load(_base_path(g, 'vectors'), mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    delta = _empty_delta(centroids.shape[1], meta["watermark"])
+    try:
+        with np.load(os.path.join(index_dir(), 'delta.npz'), allow_pickle=False) as data:
+            if int(data['generation']) == g:
+                delta = {
+                    "ids": data['ids'], "vectors": data['vectors'],
+                    "watermark": json.loads(str(data['watermark'])),
+                }
+    except (OSError, ValueError, KeyError):
+        pass
+    return IVFIndex(meta, centroids, ids, lists, vectors, delta)
+
+def _watermark(signature) -> dict:
+    count, max_id, max_updated = signature
+    return {"count": int(count or 0), "max_id": int(max_id or 0), "max_updated_at": _format_time(max_updated)}
+
+def build(signature=None):
+    """
+    Reconstrói o índice a partir de todo o EmbeddingIndex (nova geração)
+    """
+    signature = signature or index_signature()
+    ids, matrix = load_matrix()
+    meta_path = os.path.join(index_dir(), 'meta.json')
+    if not len(ids):
+        try:
+            os.remove(meta_path)
+        except OSError:
+            pass
+        return
+    nlist = nlist_for(len(ids))
+    centroids = train_centroids(matrix, nlist)
+    lists = _assign(matrix, centroids)
+
+    previous = None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)["generation"]
+    except (OSError, ValueError, KeyError):
+        pass
+    generation = (previous or 0) + 1
+    for name, array in (('centroids', centroids), ('ids', ids), ('lists', lists), ('vectors', matrix)):
+        np.save(_base_path(generation, name), array)
+    _write_json(meta_path, {
+        "generation": generation,
+        "dim": int(matrix.shape[1]),
+        "nlist": nlist,
+        "count": len(ids),
+        "built_at": datetime.utcnow().isoformat(),
+        "watermark": _watermark(signature),
+    })
+    if previous is not None:
+        for name in ('centroids', 'ids', 'lists', 'vectors'):
+            try:
+                os.remove(_base_path(previous, name))
+            except OSError:
+                pass
+    print(f"Índice ANN reconstruído: {len(ids)} vetores em {nlist} listas")
+
+def _apply_changes(index: IVFIndex, signature):
+    """
+    Leva ao delta as linhas novas/alteradas desde a marca d'água
+    """
+    mark = index.watermark
+    criteria = [EmbeddingIndex.id > mark["max_id"]]
+    if mark["max_updated_at"]:
+        criteria.append(EmbeddingIndex.updated_at > _parse_time(mark["max_updated_at"]))
+    ids, matrix = load_matrix(or_(*criteria), dim=index.dim)
+
+    keep = ~np.isin(index.delta_ids, ids)
+    path = os.path.join(index_dir(), 'delta.npz')
+    tmp = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp,
+        generation=np.array(index.meta["generation"]),
+        ids=np.concatenate([index.delta_ids[keep], ids]),
+        vectors=np.concatenate([index.delta_vectors[keep], matrix]),
+        watermark=np.array(json.dumps(_watermark(signature))),
+    )
+    os.replace(tmp, path)
+
+def _needs_rebuild(index: IVFIndex, signature) -> bool:
+    # Delta grande demais, ou o índice tem mais linhas que o banco (remoções);
+    # linhas de outra dimensão ficam de fora e não contam
+    return (len(index.delta_ids) > rebuild_fraction() * len(index.ids)
+            or index.count > int(signature[0] or 0))
+
+_state = {"stamp": None, "index": None}
+_state_lock = threading.Lock()
+
+def _disk_stamp():
+    stamp = []
+    for name in ('meta.json', 'delta.npz'):
+        try:
+            stamp.append(os.path.getmtime(os.path.join(index_dir(), name)))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def _current():
+    stamp = _disk_stamp()
+    if _state["stamp"] != stamp:
+        _state.update(stamp=stamp, index=_load_from_disk())
+    return _state["index"]
+
+_rebuild = {"thread": None}
+
+def _rebuild_in_background():
+    try:
+        with db_context():
+            with _file_lock():
+                # Outro worker pode ter reconstruído enquanto esperávamos a trava
+                signature = index_signature()
+                with _state_lock:
+                    index = _current()
+                if index is None or _needs_rebuild(index, signature):
+                    build(signature)
+    except Exception as e:
+        print(f"Erro ao reconstruir índice ANN: {e}")
+
+def _schedule_rebuild():
+    # Chamado com _state_lock; um rebuild por processo de cada vez
+    thread = _rebuild["thread"]
+    if thread is not None and thread.is_alive():
+        return
+    thread = threading.Thread(target=_rebuild_in_background, name='rag-ann-build', daemon=True)
+    _rebuild["thread"] = thread
+    thread.start()
+
+def sync():
+    """
+    Índice com as linhas alteradas aplicadas ao delta, ou None enquanto não
+    existe um (a reconstrução roda em segundo plano, nunca na requisição;
+    até terminar, vale o índice antigo + delta)
+    """
+    signature = index_signature()
+    with _state_lock:
+        index = _current()
+        if index is None:
+            _schedule_rebuild()
+            return None
+        if index.watermark != _watermark(signature):
+            with _file_lock(blocking=False) as acquired:
+                # Trava ocupada (rebuild em andamento): serve o índice atual
+                if acquired:
+                    index = _current()
+                    if index is not None and index.watermark != _watermark(signature):
+                        _apply_changes(index, signature)
+                        index = _current()
+        if index is None or _needs_rebuild(index, signature):
+            _schedule_rebuild()
+        return index
+
+def search(query, k: int = 5, nprobe: int = None):
+    """
+    [(score, EmbeddingIndex)] aproximados, ou None sem índice ou com consulta
+    de outra dimensão (usar a busca exata)
+    """
+    index = sync()
+    if index is None:
+        return None
+    found = index.search(query, k, nprobe or default_nprobe())
+    if found is None:
+        return None
+    return fetch_rows(*found)
+
+def status() -> dict:
+    with _state_lock:
+        index = _current()
+    if index is None:
+        return {"built": False}
+    return {
+        "built": True,
+        "count": index.count,
+        "dim": index.dim,
+        "nlist": len(index.centroids),
+        "delta": len(index.delta_ids),
+        "built_at": index.meta.get("built_at"),
+        "nprobe": default_nprobe(),
+    }
+
+if __name__ == '__main__':
+    with app.app_context():
+        with _file_lock():
+            build()
@@ -0,0 +1,489 @@
+"""
+Benchmarks locais do backend.
+
+Uso:
+    python benchmark.py pdf-backends [--docs 20] [--pages 10]
+    python benchmark.py upload-memory [--uploads 8] [--size-mb 15] [--max-growth-mb 64]
+    python benchmark.py prompt-compaction [--docs 50] [--max-pages 4]
+    python benchmark.py classify-rules [--count 100000]
+    python benchmark.py rag-search [--entities 50000] [--dim 1536] [--queries 20]
+    python benchmark.py embedding-storage [--entities 10000] [--dim 1536]
+    python benchmark.py rag-ann [--entities 100000] [--dim 384] [--nprobe 8]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# ==================== CORPUS SINTÉTICO ====================
+
+SAMPLE_PAGE = [
+    "DANFE - DOCUMENTO AUXILIAR DA NOTA FISCAL ELETRONICA",
+    "Nota Fiscal N {nf}  Serie 1",
+    "Razao Social: FORNECEDOR EXEMPLO {doc} LTDA",
+    "CNPJ: 11.222.333/0001-81",
+    "Destinatario: PRODUTOR RURAL EXEMPLO  CPF: 529.982.247-25",
+    "Emissao: 20/09/2024   Vencimento: 20/10/2024",
+    "Descricao: OLEO DIESEL S10, FILTRO DE OLEO, PNEU 18.4-34",
+] + [
+    "{item:04d}  PRODUTO DE EXEMPLO {item} UN 1,0000 123,45 123,45" for _ in range(40)
+] + [
+    "Valor Total: R$ 1.234,56",
+    "INFORMACOES COMPLEMENTARES: documento emitido por ME ou EPP optante pelo Simples Nacional",
+]
+
+def _escape(text: str) -> bytes:
+    return text.encode("latin-1", "replace").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+def make_synthetic_pdf(pages, padding: int = 0) -> bytes:
+    """
+    Gera um PDF mínimo (Helvetica, uma linha por item) sem dependências externas.
+    pages: lista de páginas, cada uma uma lista de linhas de texto.
+    padding: bytes de um stream binário extra (simula imagens de PDFs escaneados).
+    """
+    objects = []
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    if padding:
+        add(b"<< /Length %d >>\nstream\n" % padding + os.urandom(padding) + b"\nendstream")
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = font + 2 * len(pages) + 1
+    kids = []
+    for lines in pages:
+        ops = b" ".join(b"(" + _escape(line) + b") Tj T*" for line in lines)
+        content = b"BT /F1 9 Tf 30 810 Td 11 TL " + ops + b" ET"
+        stream = add(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        kids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, stream, font)
+        ))
+    add(b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % k for k in kids) + b"] /Count %d >>" % len(kids))
+    catalog = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    return bytes(out)
+
+def synthetic_invoice_pages(doc: int, pages: int):
+    item = 0
+    result = []
+    for _ in range(pages):
+        lines = []
+        for line in SAMPLE_PAGE:
+            item += 1
+            lines.append(line.format(nf=1000 + doc, doc=doc, item=item))
+        result.append(lines)
+    return result
+
+def write_corpus(directory: str, docs: int, pages: int):
+    paths = []
+    for doc in range(docs):
+        path = os.path.join(directory, f"nota_{doc:04d}.pdf")
+        with open(path, "wb") as f:
+            f.write(make_synthetic_pdf(synthetic_invoice_pages(doc, pages)))
+        paths.append(path)
+    return paths
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss é em KB no Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# ==================== PDF BACKENDS ====================
+
+def _run_pdf_backend(name: str, corpus_dir: str):
+    """Executado em subprocesso para medir o pico de RSS de cada backend isoladamente"""
+    from pdf_text_backends import get_backend
+    backend = get_backend(name)
+    paths = sorted(os.path.join(corpus_dir, f) for f in os.listdir(corpus_dir) if f.endswith(".pdf"))
+    pages = 0
+    chars = 0
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, "rb") as f:
+            for text in backend.iter_pages(f):
+                pages += 1
+                chars += len(text)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "backend": name,
+        "documents": len(paths),
+        "pages": pages,
+        "chars": chars,
+        "seconds": round(elapsed, 3),
+        "pages_per_sec": round(pages / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": round(_peak_rss_mb(), 1)
+    }))
+
+def bench_pdf_backends(args):
+    from pdf_text_backends import BACKENDS
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        write_corpus(corpus_dir, args.docs, args.pages)
+        print(f"Corpus: {args.docs} PDFs x {args.pages} páginas")
+        for name in args.backends or sorted(BACKENDS):
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_pdf-backend", name, corpus_dir],
+                capture_output=True, text=True
+            )
+            if proc.returncode != 0:
+                print(f"{name}: falhou ({proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else proc.returncode})")
+                continue
+            r = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(f"{name:8s} {r['pages_per_sec']:>10} páginas/s  {r['seconds']:>8}s  pico RSS {r['peak_rss_mb']} MB")
+
+# ==================== MEMÓRIA EM UPLOADS CONCORRENTES ====================
+
+def _run_upload_memory(mode: str, corpus_dir: str, concurrency: int):
+    """
+    Executado em subprocesso: processa os PDFs do corpus em paralelo simulando
+    o caminho antigo (bytes do upload na memória) ou o novo (spool + mmap).
+    """
+    os.environ.setdefault("UPLOAD_SPOOL_DIR", os.path.join(corpus_dir, "spool"))
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.datastructures import FileStorage
+    import io
+    from pdf_processor import PDFProcessor
+    from upload_spool import spooled
+
+    paths = sorted(os.path.join(corpus_dir, f) for f in os.listdir(corpus_dir) if f.endswith(".pdf"))
+    baseline = _peak_rss_mb()
+
+    def handle(path):
+        with open(path, "rb") as f:
+            upload = FileStorage(stream=f, filename=os.path.basename(path))
+            processor = PDFProcessor()
+            if mode == "bytes":
+                content = upload.read()
+                return len(processor.extract_text_until_complete(io.BytesIO(content)))
+            with spooled(upload, suffix=".pdf") as spooled_path:
+                return len(processor.extract_text_until_complete(spooled_path))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(handle, paths))
+    print(json.dumps({
+        "mode": mode,
+        "uploads": len(paths),
+        "seconds": round(time.perf_counter() - start, 3),
+        "baseline_rss_mb": round(baseline, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1)
+    }))
+
+def bench_upload_memory(args):
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        for doc in range(args.uploads):
+            with open(os.path.join(corpus_dir, f"scan_{doc:03d}.pdf"), "wb") as f:
+                f.write(make_synthetic_pdf(synthetic_invoice_pages(doc, 1), padding=args.size_mb * 1024 * 1024))
+        print(f"{args.uploads} uploads concorrentes de ~{args.size_mb} MB")
+        spool_growth = None
+        for mode in ("bytes", "spool"):
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_upload-memory", mode, corpus_dir, str(args.uploads)],
+                capture_output=True, text=True
+            )
+            if proc.returncode != 0:
+                print(f"{mode}: falhou\n{proc.stderr}")
+                continue
+            r = json.loads(proc.stdout.strip().splitlines()[-1])
+            growth = r["peak_rss_mb"] - r["baseline_rss_mb"]
+            print(f"{mode:6s} pico RSS {r['peak_rss_mb']} MB (+{growth:.1f} MB sobre a base)  {r['seconds']}s")
+            if mode == "spool":
+                spool_growth = growth
+
+    # Com --max-growth-mb o benchmark vira checagem (CI): sai com código 1 se
+    # o caminho spool + mmap crescer além do limite ou não rodar
+    if args.max_growth_mb is not None:
+        if spool_growth is None or spool_growth > args.max_growth_mb:
+            print(f"FALHA: crescimento do spool acima de {args.max_growth_mb} MB")
+            sys.exit(1)
+        print(f"OK: crescimento do spool dentro de {args.max_growth_mb} MB")
+
+# ==================== COMPACTAÇÃO DO PROMPT ====================
+
+def synthetic_danfe_text(doc: int, pages: int) -> str:
+    """Texto no formato típico de um DANFE extraído pelo PyPDF2, com anexo de produtos"""
+    header = [
+        "RECEBEMOS DE FORNECEDOR EXEMPLO LTDA OS PRODUTOS CONSTANTES DA NOTA FISCAL INDICADA AO LADO",
+        "DATA DE RECEBIMENTO IDENTIFICAÇÃO E ASSINATURA DO RECEBEDOR",
+        "DANFE DOCUMENTO AUXILIAR DA NOTA FISCAL ELETRÔNICA 0 - ENTRADA 1 - SAÍDA",
+        f"Nota Fiscal Nº {1000 + doc} SÉRIE 1",
+        "Consulta de autenticidade no portal nacional da NF-e www.nfe.fazenda.gov.br/portal",
+    ]
+    first = [
+        "IDENTIFICAÇÃO DO EMITENTE",
+        f"FORNECEDOR EXEMPLO {doc} LTDA",
+        "RUA DAS MAQUINAS 100 - CENTRO - PARAIBA DO SUL - RJ",
+        "CNPJ: 11.222.333/0001-81 INSCRIÇÃO ESTADUAL 123456789",
+        "PROTOCOLO DE AUTORIZAÇÃO DE USO 135240000000000 20/09/2024 10:00",
+        "DESTINATÁRIO / REMETENTE",
+        "PRODUTOR RURAL EXEMPLO CPF: 529.982.247-25",
+        "Emissão: 20/09/2024 FAZENDA BOA VISTA - ZONA RURAL",
+        "FATURA / DUPLICATA",
+        "001 Vencimento: 20/10/2024 R$ 617,28 002 20/11/2024 R$ 617,28",
+        "CÁLCULO DO IMPOSTO",
+        "BASE DE CÁLCULO DO ICMS 0,00 VALOR DO ICMS 0,00 VALOR DO FRETE 0,00",
+        "Valor Total da Nota: R$ 1.234,56",
+        "TRANSPORTADOR / VOLUMES TRANSPORTADOS",
+        "TRANSPORTADORA EXEMPLO LTDA CNPJ 44.555.666/0001-77 PLACA ABC1D23 UF RJ",
+        "QUANTIDADE 10 ESPÉCIE VOLUMES PESO BRUTO 250,000 PESO LÍQUIDO 240,000",
+    ]
+    products = ["DADOS DOS PRODUTOS / SERVIÇOS", "CÓDIGO DESCRIÇÃO NCM CST CFOP UN QTD V.UNIT V.TOTAL"]
+    footer = [
+        "CÁLCULO DO ISSQN",
+        "INSCRIÇÃO MUNICIPAL VALOR TOTAL DOS SERVIÇOS 0,00 BASE DE CÁLCULO DO ISSQN 0,00",
+        "DADOS ADICIONAIS",
+        "INFORMAÇÕES COMPLEMENTARES: DOCUMENTO EMITIDO POR ME OU EPP OPTANTE PELO SIMPLES NACIONAL.",
+        "NÃO GERA DIREITO A CRÉDITO FISCAL DE IPI. Val Aprox Tributos R$ 150,00 Fonte IBPT Lei 12.741/2012",
+        "RESERVADO AO FISCO",
+    ]
+    text_pages = []
+    item = 0
+    for page in range(pages):
+        lines = list(header) + (first if page == 0 else []) + products
+        for _ in range(35):
+            item += 1
+            lines.append(f"{item:05d} PECA DE REPOSICAO MODELO {item} 84329000 000 5102 UN 1,0000 35,27 35,27")
+        lines += footer + [f"FOLHA {page + 1}/{pages}"]
+        text_pages.append("\n".join(lines))
+    return "\n".join(text_pages)
+
+def _count_tokens(text: str) -> int:
+    try:
+        import tiktoken
+        return len(tiktoken.get_encoding("cl100k_base").encode(text))
+    except Exception:
+        # Aproximação usual: ~4 caracteres por token
+        return max(1, len(text) // 4)
+
+def bench_prompt_compaction(args):
+    from pdf_processor import PDFProcessor, REQUIRED_FIELDS
+    processor = PDFProcessor()
+    scenarios = [
+        ("todos os campos", REQUIRED_FIELDS),
+        ("só descrição", ["descricao_produtos"]),
+        ("só fornecedor", ["fornecedor.razao_social", "fornecedor.cnpj"]),
+    ]
+    texts = [synthetic_danfe_text(doc, 1 + doc % args.max_pages) for doc in range(args.docs)]
+    original = sum(_count_tokens(t) for t in texts)
+    print(f"Corpus: {len(texts)} DANFEs sintéticos (1 a {args.max_pages} páginas), {original} tokens")
+    for label, fields in scenarios:
+        start = time.perf_counter()
+        compacted = sum(_count_tokens(processor.compact_text(t, fields)) for t in texts)
+        elapsed = (time.perf_counter() - start) * 1000
+        reduction = 100.0 * (original - compacted) / original
+        print(f"{label:16s} {compacted:>8} tokens  redução {reduction:5.1f}%  ({elapsed:.1f} ms)")
+
+# ==================== REGRAS DE CLASSIFICAÇÃO ====================
+
+DESCRIPTION_WORDS = [
+    "Óleo Diesel S10", "Filtro de ar", "PNEU 18.4-34", "Sementes de soja", "Fertilizante NPK 04-14-08",
+    "Defensivo agrícola", "Energia elétrica", "Frete rodoviário", "Colheita terceirizada", "Seguro agrícola",
+    "IPVA 2024", "ITR exercício 2024", "Honorários contábeis", "Manutenção de máquinas", "Ureia nitrogenada",
+    "Material de escritório", "Parafuso sextavado", "Correia dentada", "Arrendamento de terras", "Implemento agrícola",
+]
+
+def synthetic_descriptions(count: int):
+    words = DESCRIPTION_WORDS
+    return [
+        f"{words[i % len(words)]}, {words[(i * 7) % len(words)].lower()} e {words[(i * 13) % len(words)]} lote {i}"
+        for i in range(count)
+    ]
+
+def _classify_linear(text: str):
+    """Implementação anterior: lista refeita a cada chamada, primeira substring que casar vence"""
+    from expense_classifier import KEYWORD_RULES
+    text = (text or "").lower()
+    rules = [(term, category) for term, category, _, _ in KEYWORD_RULES]
+    for kw, cat in rules:
+        if kw in text:
+            return cat
+    return "ADMINISTRATIVAS"
+
+def bench_classify_rules(args):
+    from expense_classifier import rules_matcher
+    descriptions = synthetic_descriptions(args.count)
+    start = time.perf_counter()
+    matcher = rules_matcher()
+    build_ms = (time.perf_counter() - start) * 1000
+    print(f"{len(descriptions)} descrições sintéticas (matcher compilado em {build_ms:.1f} ms)")
+    for label, classify in (("linear", _classify_linear), ("trie (regex)", matcher.best)):
+        start = time.perf_counter()
+        results = [classify(d) for d in descriptions]
+        elapsed = time.perf_counter() - start
+        print(f"{label:13s} {elapsed:6.2f} s  {len(descriptions) / elapsed:10.0f} descrições/s  sem regra: {results.count(None)}")
+
+# ==================== BUSCA POR EMBEDDINGS ====================
+
+def _cosine_similarity(a, b):
+    """Implementação anterior (rag_routes): Python puro, um par por vez"""
+    import math
+    if not a or not b:
+        return 0.0
+    s = 0.0
+    na = 0.0
+    nb = 0.0
+    for i in range(min(len(a), len(b))):
+        s += a[i] * b[i]
+        na += a[i] * a[i]
+        nb += b[i] * b[i]
+    denom = math.sqrt(na) * math.sqrt(nb)
+    return (s / denom) if denom else 0.0
+
+def _search_linear(rows, query, k):
+    """Caminho anterior da consulta: json.loads + cosseno para cada linha"""
+    scored = [(_cosine_similarity(query, json.loads(raw)), i) for i, raw in enumerate(rows)]
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [i for _, i in scored[:k]]
+
+def bench_rag_search(args):
+    import numpy as np
+    from embedding_search import normalize_rows, top_k
+    rng = np.random.default_rng(42)
+    vectors = rng.standard_normal((args.entities, args.dim), dtype=np.float32)
+    rows = [json.dumps([round(float(x), 6) for x in v]) for v in vectors]
+    queries = [v + 0.1 * rng.standard_normal(args.dim, dtype=np.float32) for v in vectors[:args.queries]]
+    print(f"{args.entities} embeddings sintéticos de dimensão {args.dim}, top {args.top_k}")
+
+    linear_queries = queries[:args.linear_queries]
+    start = time.perf_counter()
+    expected = [_search_linear(rows, q.tolist(), args.top_k) for q in linear_queries]
+    elapsed = (time.perf_counter() - start) / len(linear_queries)
+    print(f"{'linear':13s} {elapsed * 1000:9.1f} ms/consulta  ({len(linear_queries)} consultas)")
+
+    start = time.perf_counter()
+    matrix = normalize_rows(np.stack([np.array(json.loads(raw), dtype=np.float32) for raw in rows]))
+    build_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    found = [top_k(matrix, q, args.top_k)[0].tolist() for q in queries]
+    elapsed = (time.perf_counter() - start) / len(queries)
+    same = sum(found[i] == expected[i] for i in range(len(expected)))
+    print(f"{'numpy':13s} {elapsed * 1000:9.1f} ms/consulta  ({len(queries)} consultas; matriz montada uma vez em {build_ms:.0f} ms, "
+          f"{matrix.nbytes / 2**20:.0f} MB)  mesmo top {args.top_k}: {same}/{len(expected)}")
+
+def bench_embedding_storage(args):
+    import numpy as np
+    from embedding_codec import pack_embedding, unpack_embedding
+    rng = np.random.default_rng(42)
+    vectors = rng.standard_normal((args.entities, args.dim), dtype=np.float32)
+    print(f"{args.entities} embeddings sintéticos de dimensão {args.dim}")
+    formats = [
+        ("json", [json.dumps(v.tolist()) for v in vectors], lambda raw: np.array(json.loads(raw), dtype=np.float32)),
+        ("float32", [pack_embedding(v, "float32") for v in vectors], unpack_embedding),
+        ("float16", [pack_embedding(v, "float16") for v in vectors], unpack_embedding),
+    ]
+    for label, rows, decode in formats:
+        size = sum(len(r) for r in rows)
+        start = time.perf_counter()
+        matrix = np.stack([decode(r) for r in rows])
+        elapsed = (time.perf_counter() - start) * 1000
+        error = float(np.abs(matrix - vectors).max())
+        print(f"{label:8s} {size / args.entities:8.0f} bytes/linha  {size / 2**20:7.1f} MB  leitura {elapsed:8.1f} ms  erro máx {error:.1e}")
+
+def bench_rag_ann(args):
+    import numpy as np
+    from embedding_search import normalize_rows, top_k
+    from ann_index import IVFIndex, nlist_for, train_centroids, _assign, _empty_delta
+    rng = np.random.default_rng(42)
+    # Vetores agrupados (como embeddings reais), não uniformes
+    centers = rng.standard_normal((args.clusters, args.dim), dtype=np.float32)
+    matrix = normalize_rows(centers[rng.integers(0, args.clusters, args.entities)]
+                            + 0.6 * rng.standard_normal((args.entities, args.dim), dtype=np.float32))
+    queries = matrix[:args.queries] + 0.3 * rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+    print(f"{args.entities} embeddings sintéticos de dimensão {args.dim}, top {args.top_k}")
+
+    start = time.perf_counter()
+    nlist = nlist_for(args.entities)
+    centroids = train_centroids(matrix, nlist)
+    lists = _assign(matrix, centroids)
+    index = IVFIndex({}, centroids, np.arange(args.entities), lists, matrix, _empty_delta(args.dim, {}))
+    print(f"IVF com {nlist} listas montado em {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    start = time.perf_counter()
+    expected = [set(top_k(matrix, q, args.top_k)[0].tolist()) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"{'exata':13s} {exact_ms:9.2f} ms/consulta")
+    for nprobe in sorted({1, args.nprobe, 4 * args.nprobe}):
+        start = time.perf_counter()
+        found = [set(index.search(q, args.top_k, nprobe)[0].tolist()) for q in queries]
+        elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = sum(len(f & e) for f, e in zip(found, expected)) / (len(queries) * args.top_k)
+        print(f"{'ivf nprobe=' + str(nprobe):13s} {elapsed:9.2f} ms/consulta  recall@{args.top_k} {recall:.3f}")
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Benchmarks do backend")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("pdf-backends", help="páginas/s e pico de RSS por backend de texto de PDF")
+    p.add_argument("--docs", type=int, default=20)
+    p.add_argument("--pages", type=int, default=10)
+    p.add_argument("--backends", nargs="*")
+    p.set_defaults(func=bench_pdf_backends)
+
+    p = sub.add_parser("_pdf-backend")
+    p.add_argument("name")
+    p.add_argument("corpus_dir")
+    p.set_defaults(func=lambda a: _run_pdf_backend(a.name, a.corpus_dir))
+
+    p = sub.add_parser("upload-memory", help="pico de RSS com uploads grandes concorrentes (bytes em memória x spool + mmap)")
+    p.add_argument("--uploads", type=int, default=8)
+    p.add_argument("--size-mb", type=int, default=15)
+    p.add_argument("--max-growth-mb", type=float, help="falha se o pico de RSS do spool crescer mais que isso sobre a base")
+    p.set_defaults(func=bench_upload_memory)
+
+    p = sub.add_parser("_upload-memory")
+    p.add_argument("mode")
+    p.add_argument("corpus_dir")
+    p.add_argument("concurrency", type=int)
+    p.set_defaults(func=lambda a: _run_upload_memory(a.mode, a.corpus_dir, a.concurrency))
+
+    p = sub.add_parser("prompt-compaction", help="redução de tokens do prompt num corpus de DANFEs sintéticos")
+    p.add_argument("--docs", type=int, default=50)
+    p.add_argument("--max-pages", type=int, default=4)
+    p.set_defaults(func=bench_prompt_compaction)
+
+    p = sub.add_parser("classify-rules", help="descrições/s das regras locais do classificador de despesas")
+    p.add_argument("--count", type=int, default=100000)
+    p.set_defaults(func=bench_classify_rules)
+
+    p = sub.add_parser("rag-search", help="ms por consulta da busca por embeddings (loop Python x matriz NumPy)")
+    p.add_argument("--entities", type=int, default=50000)
+    p.add_argument("--dim", type=int, default=1536)
+    p.add_argument("--queries", type=int, default=20)
+    p.add_argument("--linear-queries", type=int, default=1)
+    p.add_argument("--top-k", type=int, default=5)
+    p.set_defaults(func=bench_rag_search)
+
+    p = sub.add_parser("embedding-storage", help="tamanho e tempo de leitura dos embeddings em JSON x binário")
+    p.add_argument("--entities", type=int, default=10000)
+    p.add_argument("--dim", type=int, default=1536)
+    p.set_defaults(func=bench_embedding_storage)
+
+    p = sub.add_parser("rag-ann", help="latência e recall do índice IVF x busca exata")
+    p.add_argument("--entities", type=int, default=100000)
+    p.add_argument("--dim", type=int, default=384)
+    p.add_argument("--clusters", type=int, default=200)
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--nprobe", type=int, default=8)
+    p.add_argument("--top-k", type=int, default=10)
+    p.set_defaults(func=bench_rag_ann)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+from app import db
+from db_context import db_context, independent_session
+from models import TipoDespesa, VersaoRegistro
+from sqlalchemy import func
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+# Registro das categorias de despesa carregado dos TipoDespesa ativos, com
+# cache por processo. Escritas em tipos de despesa incrementam a versão no
+# banco (bump_version); cada worker confere a versão (e uma assinatura da
+# tabela: quantidade, maior id, última alteração) a cada
+# CATEGORY_REGISTRY_CHECK_SECONDS e recarrega quando ela muda, sem reinício.
+# Os TipoDespesa são aplicados sobre DEFAULT_CATEGORIES (banco sem seed
+# continua com as categorias padrão).
+
+REGISTRY_NAME = 'categorias_despesa'
+
+DEFAULT_CATEGORIES = {
+    "INSUMOS AGRÍCOLAS": [
+        "Sementes", "Fertilizantes", "Defensivos Agrícolas", "Corretivos"
+    ],
+    "MANUTENÇÃO E OPERAÇÃO": [
+        "Combustíveis e Lubrificantes",
+        "Peças, Parafusos, Componentes Mecânicos",
+        "Manutenção de Máquinas e Equipamentos",
+        "Pneus, Filtros, Correias",
+        "Ferramentas e Utensílios"
+    ],
+    "RECURSOS HUMANOS": [
+        "Mão de Obra Temporária",
+        "Salários e Encargos"
+    ],
+    "SERVIÇOS OPERACIONAIS": [
+        "Frete e Transporte",
+        "Colheita Terceirizada",
+        "Secagem e Armazenagem",
+        "Pulverização e Aplicação"
+    ],
+    "INFRAESTRUTURA E UTILIDADES": [
+        "Energia Elétrica",
+        "Arrendamento de Terras",
+        "Construções e Reformas",
+        "Materiais de Construção"
+    ],
+    "ADMINISTRATIVAS": [
+        "Honorários (Contábeis, Advocatícios, Agronômicos)",
+        "Despesas Bancárias e Financeiras"
+    ],
+    "SEGUROS E PROTEÇÃO": [
+        "Seguro Agrícola",
+        "Seguro de Ativos (Máquinas/Veículos)",
+        "Seguro Prestamista"
+    ],
+    "IMPOSTOS E TAXAS": [
+        "ITR, IPTU, IPVA, INCRA-CCIR"
+    ],
+    "INVESTIMENTOS": [
+        "Aquisição de Máquinas e Implementos",
+        "Aquisição de Veículos",
+        "Aquisição de Imóveis",
+        "Infraestrutura Rural"
+    ]
+}
+
+_state = {"version": None, "categories": None, "etag": None, "checked_at": 0.0}
+_state_lock = threading.Lock()
+
+def check_interval() -> float:
+    return float(os.getenv('CATEGORY_REGISTRY_CHECK_SECONDS') or 5)
+
+def _items_from_description(nome: str, descricao: str):
+    """
+    "Categoria: X. Inclui: a, b (c, d)" (formato do seed) -> ["a", "b (c, d)"]
+    """
+    text = (descricao or "").strip()
+    m = re.match(r"Categoria:.*?\.\s*Inclui:\s*(.+)$", text, re.DOTALL)
+    if m:
+        return [item.strip() for item in re.split(r",\s*(?![^()]*\))", m.group(1)) if item.strip()]
+    if not text or text == f"Categoria: {nome}":
+        return []
+    return [text]
+
+def _current_version():
+    """
+    Versão explícita (bump_version) + assinatura barata da tabela, que pega
+    também tipos criados fora das rotas de cadastro
+    """
+    row = VersaoRegistro.query.filter_by(nome=REGISTRY_NAME).first()
+    signature = db.session.query(
+        func.count(TipoDespesa.id), func.max(TipoDespesa.id), func.max(TipoDespesa.updated_at)
+    ).one()
+    return (row.versao if row else 0, *signature)
+
+def _load_categories() -> dict:
+    """
+    DEFAULT_CATEGORIES com os TipoDespesa por cima: um tipo cadastrado
+    substitui o padrão de mesmo nome (inativo, remove-o) e tipos novos se somam
+    """
+    categories = dict(DEFAULT_CATEGORIES)
+    for tipo in TipoDespesa.query.order_by(TipoDespesa.nome.asc()).all():
+        if tipo.is_active:
+            items = _items_from_description(tipo.nome, tipo.descricao)
+            # Tipo criado só com o nome ("Categoria: X") mantém os exemplos do padrão
+            categories[tipo.nome] = items or categories.get(tipo.nome, [])
+        else:
+            categories.pop(tipo.nome, None)
+    return categories
+
+def _etag(categories: dict) -> str:
+    payload = json.dumps(categories, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+def _refresh(force: bool = False):
+    now = time.monotonic()
+    if not force and _state["categories"] is not None and now - _state["checked_at"] < check_interval():
+        return
+    try:
+        with db_context():
+            version = _current_version()
+            if force or version != _state["version"] or _state["categories"] is None:
+                categories = _load_categories()
+                _state.update(version=version, categories=categories, etag=_etag(categories))
+    except Exception as e:
+        print(f"Erro ao carregar categorias de despesa: {e}")
+        if _state["categories"] is None:
+            _state.update(version=None, categories=dict(DEFAULT_CATEGORIES), etag=_etag(DEFAULT_CATEGORIES))
+    _state["checked_at"] = now
+
+def get_categories() -> dict:
+    """
+    Categorias ativas (nome -> itens de exemplo)
+    """
+    with _state_lock:
+        _refresh()
+        return _state["categories"]
+
+def snapshot():
+    """
+    (categorias, etag) da mesma carga, para respostas HTTP condicionais
+    """
+    with _state_lock:
+        _refresh()
+        return _state["categories"], _state["etag"]
+
+def bump_version():
+    """
+    Marca o conjunto de categorias como alterado (chamar após o commit de
+    uma escrita em TipoDespesa); este processo recarrega na hora e os
+    demais na próxima verificação
+    """
+    try:
+        # Sessão própria: uma falha aqui não desfaz nada da requisição
+        with independent_session() as session:
+            updated = session.query(VersaoRegistro).filter_by(nome=REGISTRY_NAME).update(
+                {'versao': VersaoRegistro.versao + 1}
+            )
+            if not updated:
+                session.add(VersaoRegistro(nome=REGISTRY_NAME, versao=1))
+    except Exception as e:
+        print(f"Erro ao versionar categorias de despesa: {e}")
+    with _state_lock:
+        _refresh(force=True)
@@ -0,0 +1,144 @@
+from db_context import independent_session
+from keyword_matcher import normalize_text
+from models import ClassificacaoMemo
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import os
+import re
+import threading
+
+# Memória persistente das classificações feitas pelo LLM, por descrição
+# normalizada (sem acentos, caixa, quantidades, unidades e números da nota),
+# com um LRU em memória na frente. Cada entrada guarda a versão do conjunto
+# de categorias; quando ele muda, as entradas antigas deixam de valer. O banco
+# é acessado numa sessão própria (independent_session), sem commit/rollback
+# na sessão de quem chamou.
+
+UNITS = {
+    "un", "und", "unid", "pc", "pcs", "pca", "cx", "kg", "g", "t", "ton", "l", "lt", "lts", "ml",
+    "m", "m2", "m3", "mt", "sc", "fd", "gl", "par", "jg", "rl", "qtd", "x",
+}
+# Referências da nota/pedido que acompanham números
+NOTE_WORDS = {"nf", "nfe", "ref", "lote", "pedido", "ped", "cod", "codigo", "item", "n", "no", "o"}
+
+# Entra na versão das entradas: mudar descarta a memória inteira (2: entradas
+# antigas podem guardar a categoria padrão de quando não havia LLM disponível)
+FORMAT_VERSION = 2
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+
+def lru_size() -> int:
+    return int(os.getenv('CLASSIFICATION_MEMO_LRU_SIZE') or 4096)
+
+def max_entries() -> int:
+    return int(os.getenv('CLASSIFICATION_MEMO_MAX_ENTRIES') or 50000)
+
+def normalize_description(description: str) -> str:
+    """
+    "ÓLEO DIESEL S10 - 500 LT NF 1234" -> "oleo diesel"
+    """
+    words = re.split(r"[^a-z0-9]+", normalize_text(description))
+    return " ".join(w for w in words if w and w not in UNITS and w not in NOTE_WORDS and not any(c.isdigit() for c in w))
+
+def memo_key(description: str) -> str:
+    return hashlib.sha256(normalize_description(description).encode('utf-8')).hexdigest()
+
+def _lru_get(version: str, key: str):
+    with _lru_lock:
+        category = _lru.get((version, key))
+        if category is not None:
+            _lru.move_to_end((version, key))
+        return category
+
+def _lru_put(version: str, key: str, category: str):
+    with _lru_lock:
+        _lru[(version, key)] = category
+        _lru.move_to_end((version, key))
+        while len(_lru) > lru_size():
+            _lru.popitem(last=False)
+
+def lookup_many(descriptions, version: str) -> dict:
+    """
+    Categorias memorizadas para as descrições (descrição -> categoria),
+    válidas para a versão atual do conjunto de categorias
+    """
+    found = {}
+    missing = {}
+    for description in descriptions:
+        if not normalize_description(description):
+            continue
+        key = memo_key(description)
+        category = _lru_get(version, key)
+        if category is not None:
+            found[description] = category
+        else:
+            missing.setdefault(key, []).append(description)
+    if not missing:
+        return found
+    try:
+        with independent_session() as session:
+            entries = session.query(ClassificacaoMemo).filter(
+                ClassificacaoMemo.chave.in_(list(missing)),
+                ClassificacaoMemo.categorias_versao == version
+            ).all()
+            now = datetime.utcnow()
+            for entry in entries:
+                entry.hits = (entry.hits or 0) + 1
+                entry.last_accessed_at = now
+                _lru_put(version, entry.chave, entry.categoria)
+                for description in missing[entry.chave]:
+                    found[description] = entry.categoria
+    except Exception as e:
+        print(f"Erro ao ler memória de classificação: {e}")
+    return found
+
+def lookup(description: str, version: str):
+    return lookup_many([description], version).get(description)
+
+def store_many(items, version: str):
+    """
+    Memoriza [(descrição, categoria)] para a versão atual das categorias
+    """
+    rows = {}
+    for description, category in items:
+        normalized = normalize_description(description)
+        if normalized and category:
+            rows[memo_key(description)] = (normalized, category)
+    if not rows:
+        return
+    for key, (_, category) in rows.items():
+        _lru_put(version, key, category)
+    try:
+        with independent_session() as session:
+            existing = {e.chave: e for e in session.query(ClassificacaoMemo).filter(ClassificacaoMemo.chave.in_(list(rows))).all()}
+            now = datetime.utcnow()
+            for key, (normalized, category) in rows.items():
+                entry = existing.get(key)
+                if entry is None:
+                    entry = ClassificacaoMemo(chave=key, descricao_normalizada=normalized, hits=0)
+                    session.add(entry)
+                entry.categoria = category
+                entry.categorias_versao = version
+                entry.last_accessed_at = now
+            _evict(session, version)
+    except Exception as e:
+        print(f"Erro ao gravar memória de classificação: {e}")
+
+def store(description: str, category: str, version: str):
+    store_many([(description, category)], version)
+
+def _evict(session, version: str):
+    session.flush()
+    # Entradas de conjuntos de categorias antigos não valem mais
+    session.query(ClassificacaoMemo).filter(ClassificacaoMemo.categorias_versao != version).delete(synchronize_session=False)
+    excess = session.query(ClassificacaoMemo).count() - max_entries()
+    if excess > 0:
+        oldest = session.query(ClassificacaoMemo).order_by(ClassificacaoMemo.last_accessed_at.asc()).limit(excess).all()
+        for entry in oldest:
+            session.delete(entry)
+
+def clear_lru():
+    with _lru_lock:
+        _lru.clear()
@@ -3,6 +3,7 @@ from app import app, db
 from models import *
 from datetime import datetime
 from decimal import Decimal
+import category_registry
 
 def _to_decimal(val):
     try:
@@ -341,6 +342,7 @@ def create_tipo_despesa():
         
         db.session.add(tipo)
         db.session.commit()
+        category_registry.bump_version()
         
         return jsonify({
             'id': tipo.id,
@@ -359,6 +361,7 @@ def inactivate_tipo_despesa(tipo_id):
         tipo.is_active = False
         
         db.session.commit()
+        category_registry.bump_version()
         
         return jsonify({'message': 'Tipo de despesa inativado com sucesso'}), 200
         
@@ -373,6 +376,7 @@ def reactivate_tipo_despesa(tipo_id):
         tipo = TipoDespesa.query.get_or_404(tipo_id)
         tipo.is_active = True
         db.session.commit()
+        category_registry.bump_version()
         return jsonify({'message': 'Tipo de despesa reativado com sucesso'}), 200
     except Exception as e:
         db.session.rollback()
@@ -390,6 +394,7 @@ def update_tipo_despesa(tipo_id):
         tipo.nome = data.get('nome', tipo.nome)
         tipo.descricao = data.get('descricao', tipo.descricao)
         db.session.commit()
+        category_registry.bump_version()
         return jsonify({'message': 'Tipo de despesa atualizado com sucesso'}), 200
     except Exception as e:
         db.session.rollback()
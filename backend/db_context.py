@@ -0,0 +1,41 @@
+from app import app, db
+from contextlib import contextmanager
+from flask import has_app_context
+from sqlalchemy.orm import Session
+import os
+
+# Acesso ao banco fora de requisições (threads do hedge de LLM, workers do
+# pool de processos): abre o app context quando necessário.
+_engine_pid = os.getpid()
+
+@contextmanager
+def db_context():
+    global _engine_pid
+    if has_app_context():
+        yield
+        return
+    with app.app_context():
+        if _engine_pid != os.getpid():
+            # Processo filho (fork): não reutilizar conexões herdadas do pai
+            db.engine.dispose(close=False)
+            _engine_pid = os.getpid()
+        yield
+
+@contextmanager
+def independent_session():
+    """
+    Sessão própria, separada de db.session, para escritas auxiliares (caches):
+    o commit/rollback vale só para o que foi feito nela e nunca encerra a
+    transação da requisição que chamou. No SQLite, usar antes das escritas da
+    requisição (com uma escrita já enviada, a outra conexão espera o lock).
+    """
+    with db_context():
+        session = Session(db.engine)
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
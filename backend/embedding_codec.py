@@ -0,0 +1,38 @@
+import os
+import struct
+import numpy as np
+
+# Formato binário dos embeddings (EmbeddingIndex.embedding_blob): cabeçalho
+# de 8 bytes — "EV", versão do formato, tipo (1 = float32, 2 = float16),
+# dimensão (uint32) — seguido dos valores little-endian. float32 ocupa ~1/4
+# do JSON equivalente; float16 metade disso, com perda de precisão que não
+# muda o ranking de cosseno na prática.
+
+MAGIC = b"EV"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<2sBBI")
+DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f2")}
+DTYPE_CODES = {"float32": 1, "float16": 2}
+
+def storage_dtype() -> str:
+    name = (os.getenv('EMBEDDING_DTYPE') or 'float32').lower()
+    return name if name in DTYPE_CODES else 'float32'
+
+def pack_embedding(vector, dtype: str = None) -> bytes:
+    code = DTYPE_CODES[dtype or storage_dtype()]
+    values = np.asarray(vector, dtype=DTYPES[code]).ravel()
+    return HEADER.pack(MAGIC, FORMAT_VERSION, code, values.size) + values.tobytes()
+
+def unpack_embedding(blob: bytes) -> np.ndarray:
+    """
+    Vetor float32 do blob; ValueError se o cabeçalho não confere
+    """
+    if blob is None or len(blob) < HEADER.size:
+        raise ValueError("Embedding binário vazio ou truncado")
+    magic, version, code, dim = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != FORMAT_VERSION or code not in DTYPES:
+        raise ValueError("Cabeçalho de embedding desconhecido")
+    dtype = DTYPES[code]
+    if len(blob) != HEADER.size + dim * dtype.itemsize:
+        raise ValueError("Tamanho do embedding não confere com a dimensão")
+    return np.frombuffer(blob, dtype=dtype, count=dim, offset=HEADER.size).astype(np.float32)
@@ -0,0 +1,122 @@
+from app import db
+from models import EmbeddingIndex
+from embedding_codec import unpack_embedding
+from sqlalchemy import func
+import json
+import threading
+import numpy as np
+
+# Busca por similaridade de cosseno sobre o EmbeddingIndex: os vetores ficam
+# em memória como uma matriz float32 já normalizada (uma linha por entidade),
+# e a consulta é um produto matriz-vetor + argpartition. A matriz só é
+# refeita quando a assinatura do índice (quantidade, maior id, última
+# atualização) muda — inclusive por um build feito em outro worker.
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    Normaliza cada linha (norma L2 = 1); linhas nulas ficam zeradas
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def top_k(matrix: np.ndarray, query, k: int):
+    """
+    (índices, scores) das k linhas de matriz normalizada mais próximas da
+    consulta, em ordem decrescente de similaridade
+    """
+    if not len(matrix) or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    q = normalize_rows(np.asarray(query, dtype=np.float32))
+    if q.shape[0] != matrix.shape[1]:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    scores = matrix @ q
+    k = min(k, len(scores))
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best], kind='stable')]
+    return best, scores[best]
+
+_index = {"signature": None, "ids": None, "matrix": None}
+_index_lock = threading.Lock()
+
+def index_signature():
+    return tuple(db.session.query(
+        func.count(EmbeddingIndex.id), func.max(EmbeddingIndex.id), func.max(EmbeddingIndex.updated_at)
+    ).one())
+
+def row_vector(blob, raw):
+    """
+    Vetor float32 de uma linha (binário ou JSON antigo), ou None se inválido
+    """
+    try:
+        if blob is not None:
+            vector = unpack_embedding(blob)
+        else:
+            vector = np.array(json.loads(raw), dtype=np.float32)
+    except Exception:
+        return None
+    return vector if vector.ndim == 1 and vector.size else None
+
+def load_matrix(*criteria, dim: int = None):
+    """
+    (ids, matriz normalizada) das linhas do EmbeddingIndex que atendem aos
+    filtros; sem dim, vale a dimensão da maioria
+    """
+    rows = (
+        db.session.query(EmbeddingIndex.id, EmbeddingIndex.embedding_blob, EmbeddingIndex.embedding_json)
+        .filter(*criteria)
+        .order_by(EmbeddingIndex.id.asc())
+        .all()
+    )
+    ids, vectors = [], []
+    for row_id, blob, raw in rows:
+        vector = row_vector(blob, raw)
+        if vector is not None:
+            ids.append(row_id)
+            vectors.append(vector)
+    if not vectors:
+        return np.empty(0, dtype=np.int64), np.empty((0, dim or 0), dtype=np.float32)
+    # Vetores de outra dimensão (troca de modelo de embeddings no meio de um
+    # build) ficam de fora
+    lengths = [v.size for v in vectors]
+    if dim is None:
+        dim = max(set(lengths), key=lengths.count)
+    keep = [i for i, n in enumerate(lengths) if n == dim]
+    if not keep:
+        return np.empty(0, dtype=np.int64), np.empty((0, dim), dtype=np.float32)
+    matrix = normalize_rows(np.stack([vectors[i] for i in keep]))
+    return np.array([ids[i] for i in keep], dtype=np.int64), matrix
+
+def get_matrix():
+    """
+    (ids, matriz normalizada) do índice atual, refeita só quando o índice muda
+    """
+    signature = index_signature()
+    with _index_lock:
+        if _index["signature"] != signature:
+            ids, matrix = load_matrix()
+            _index.update(signature=signature, ids=ids, matrix=matrix)
+        return _index["ids"], _index["matrix"]
+
+def invalidate():
+    with _index_lock:
+        _index.update(signature=None, ids=None, matrix=None)
+
+def search(query, k: int = 5):
+    """
+    [(score, EmbeddingIndex)] das k entidades mais similares à consulta
+    """
+    ids, matrix = get_matrix()
+    positions, scores = top_k(matrix, query, k)
+    return fetch_rows(ids[positions], scores)
+
+def fetch_rows(ids, scores):
+    """
+    [(score, EmbeddingIndex)] na ordem dos ids encontrados pela busca
+    """
+    wanted = [int(i) for i in ids]
+    if not wanted:
+        return []
+    rows = {r.id: r for r in EmbeddingIndex.query.filter(EmbeddingIndex.id.in_(wanted)).all()}
+    return [(float(s), rows[i]) for i, s in zip(wanted, scores) if i in rows]
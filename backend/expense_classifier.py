@@ -1,151 +1,160 @@
-import openai
-from openai import OpenAI
+import category_registry
+import classification_memo
+import hashlib
 import json
+import llm_cache
+import local_classifier
 import os
-from typing import List, Dict
+import threading
+from typing import List, Dict, Optional
+from keyword_matcher import KeywordMatcher
+from llm_providers import openai_client, gemini_model, gemini_key, pick_gemini_model, call_provider, breaker_error_kind, hedged_call
+
+# Regras locais: (termo, categoria, peso, palavra inteira). Termos sem
+# palavra inteira são radicais ("fertiliz" casa "fertilizante"). Termos de
+# investimento pesam menos para que "manutenção de máquinas" ou "seguro de
+# veículo" fiquem na categoria do serviço.
+KEYWORD_RULES = [
+    ("diesel", "MANUTENÇÃO E OPERAÇÃO", 2, False),
+    ("combust", "MANUTENÇÃO E OPERAÇÃO", 2, False),
+    ("manutenção", "MANUTENÇÃO E OPERAÇÃO", 2, False),
+    ("pneu", "MANUTENÇÃO E OPERAÇÃO", 2, False),
+    ("filtro", "MANUTENÇÃO E OPERAÇÃO", 2, False),
+    ("correia", "MANUTENÇÃO E OPERAÇÃO", 2, False),
+    ("semente", "INSUMOS AGRÍCOLAS", 2, False),
+    ("fertiliz", "INSUMOS AGRÍCOLAS", 2, False),
+    ("defensiv", "INSUMOS AGRÍCOLAS", 2, False),
+    ("energia", "INFRAESTRUTURA E UTILIDADES", 2, False),
+    ("arrendamento", "INFRAESTRUTURA E UTILIDADES", 2, False),
+    ("constru", "INFRAESTRUTURA E UTILIDADES", 2, False),
+    ("honorár", "ADMINISTRATIVAS", 2, False),
+    ("contáb", "ADMINISTRATIVAS", 2, False),
+    ("advog", "ADMINISTRATIVAS", 2, False),
+    ("frete", "SERVIÇOS OPERACIONAIS", 2, False),
+    ("transporte", "SERVIÇOS OPERACIONAIS", 2, False),
+    ("colheita", "SERVIÇOS OPERACIONAIS", 2, False),
+    ("secagem", "SERVIÇOS OPERACIONAIS", 2, False),
+    ("pulveriza", "SERVIÇOS OPERACIONAIS", 2, False),
+    ("mão de obra", "RECURSOS HUMANOS", 2, False),
+    ("salár", "RECURSOS HUMANOS", 2, False),
+    ("encargo", "RECURSOS HUMANOS", 2, False),
+    ("seguro", "SEGUROS E PROTEÇÃO", 2, False),
+    ("iptu", "IMPOSTOS E TAXAS", 2, True),
+    ("ipva", "IMPOSTOS E TAXAS", 2, True),
+    ("itr", "IMPOSTOS E TAXAS", 2, True),
+    ("ccir", "IMPOSTOS E TAXAS", 2, True),
+    ("máquina", "INVESTIMENTOS", 1, False),
+    ("implemento", "INVESTIMENTOS", 1, False),
+    ("veículo", "INVESTIMENTOS", 1, False),
+    ("imóvel", "INVESTIMENTOS", 1, False),
+]
+
+# Desempate entre categorias com a mesma pontuação (maior vence)
+CATEGORY_PRIORITIES = {
+    "IMPOSTOS E TAXAS": 9,
+    "SEGUROS E PROTEÇÃO": 8,
+    "MANUTENÇÃO E OPERAÇÃO": 7,
+    "INSUMOS AGRÍCOLAS": 6,
+    "SERVIÇOS OPERACIONAIS": 5,
+    "RECURSOS HUMANOS": 4,
+    "INFRAESTRUTURA E UTILIDADES": 3,
+    "ADMINISTRATIVAS": 2,
+    "INVESTIMENTOS": 1,
+}
+
+_rules_matcher = None
+_rules_matcher_lock = threading.Lock()
+
+def rules_matcher() -> KeywordMatcher:
+    """
+    Matcher das regras locais, compilado uma vez por processo
+    """
+    global _rules_matcher
+    with _rules_matcher_lock:
+        if _rules_matcher is None:
+            _rules_matcher = KeywordMatcher(KEYWORD_RULES, CATEGORY_PRIORITIES)
+        return _rules_matcher
 
 class ExpenseClassifier:
     def __init__(self):
         """
         Inicializa o classificador com cliente OpenAI e Gemini
         """
-        openai_key = os.getenv('OPENAI_API_KEY')
-        self.client = OpenAI(api_key=openai_key) if openai_key else None
+        # Clientes compartilhados do processo (registro em llm_providers)
+        self.client = openai_client()
         
-        # Configurar Gemini como fallback
-        gemini_key = os.getenv('GOOGLE_API_KEY') or os.getenv('GEMINI_API_KEY')
-        if gemini_key:
-            import google.generativeai as genai
-            genai.configure(api_key=gemini_key)
-            # Seleciona dinamicamente um modelo Gemini disponível que suporte generateContent
-            model_name = os.getenv('GEMINI_MODEL_NAME')
-            if not model_name:
-                try:
-                    preferred = [
-                        "gemini-2.5-flash",
-                        "gemini-2.0-flash",
-                        "gemini-1.5-flash",
-                        "gemini-1.5-pro",
-                    ]
-                    available = []
-                    for m in genai.list_models():
-                        methods = getattr(m, "supported_generation_methods", None)
-                        name = getattr(m, "name", "")
-                        base = name.replace("models/", "")
-                        if methods and "generateContent" in methods:
-                            # Evitar modelos experimentais/preview/latest que podem causar 404/429
-                            if any(suf in base for suf in ["-exp", "-preview"]) or base.endswith("-latest"):
-                                continue
-                            available.append(base)
-                    for name in preferred:
-                        if name in available:
-                            model_name = name
-                            break
-                    if not model_name and available:
-                        model_name = available[0]
-                except Exception:
-                    # Fallback para um nome estável
-                    model_name = "gemini-1.5-pro"
-            self.gemini_model = genai.GenerativeModel(model_name)
-        else:
-            self.gemini_model = None
-        self.categories = {
-            "INSUMOS AGRÍCOLAS": [
-                "Sementes", "Fertilizantes", "Defensivos Agrícolas", "Corretivos"
-            ],
-            "MANUTENÇÃO E OPERAÇÃO": [
-                "Combustíveis e Lubrificantes",
-                "Peças, Parafusos, Componentes Mecânicos",
-                "Manutenção de Máquinas e Equipamentos",
-                "Pneus, Filtros, Correias",
-                "Ferramentas e Utensílios"
-            ],
-            "RECURSOS HUMANOS": [
-                "Mão de Obra Temporária",
-                "Salários e Encargos"
-            ],
-            "SERVIÇOS OPERACIONAIS": [
-                "Frete e Transporte",
-                "Colheita Terceirizada",
-                "Secagem e Armazenagem",
-                "Pulverização e Aplicação"
-            ],
-            "INFRAESTRUTURA E UTILIDADES": [
-                "Energia Elétrica",
-                "Arrendamento de Terras",
-                "Construções e Reformas",
-                "Materiais de Construção"
-            ],
-            "ADMINISTRATIVAS": [
-                "Honorários (Contábeis, Advocatícios, Agronômicos)",
-                "Despesas Bancárias e Financeiras"
-            ],
-            "SEGUROS E PROTEÇÃO": [
-                "Seguro Agrícola",
-                "Seguro de Ativos (Máquinas/Veículos)",
-                "Seguro Prestamista"
-            ],
-            "IMPOSTOS E TAXAS": [
-                "ITR, IPTU, IPVA, INCRA-CCIR"
-            ],
-            "INVESTIMENTOS": [
-                "Aquisição de Máquinas e Implementos",
-                "Aquisição de Veículos",
-                "Aquisição de Imóveis",
-                "Infraestrutura Rural"
-            ]
-        }
+        # Gemini como fallback: o modelo é resolvido sob demanda (ver gemini_model),
+        # para que instanciar o classificador não faça chamadas remotas
+        self._gemini_model = None
+
+    @property
+    def categories(self) -> Dict[str, List[str]]:
+        """
+        Categorias ativas do registro (TipoDespesa, recarregadas quando mudam)
+        """
+        return category_registry.get_categories()
 
-    def _classify_with_rules(self, product_description: str) -> str:
-        text = (product_description or "").lower()
-        rules = [
-            ("diesel", "MANUTENÇÃO E OPERAÇÃO"),
-            ("combust", "MANUTENÇÃO E OPERAÇÃO"),
-            ("manutenção", "MANUTENÇÃO E OPERAÇÃO"),
-            ("pneu", "MANUTENÇÃO E OPERAÇÃO"),
-            ("filtro", "MANUTENÇÃO E OPERAÇÃO"),
-            ("correia", "MANUTENÇÃO E OPERAÇÃO"),
-            ("semente", "INSUMOS AGRÍCOLAS"),
-            ("fertiliz", "INSUMOS AGRÍCOLAS"),
-            ("defensiv", "INSUMOS AGRÍCOLAS"),
-            ("energia", "INFRAESTRUTURA E UTILIDADES"),
-            ("arrendamento", "INFRAESTRUTURA E UTILIDADES"),
-            ("constru", "INFRAESTRUTURA E UTILIDADES"),
-            ("honorár", "ADMINISTRATIVAS"),
-            ("contáb", "ADMINISTRATIVAS"),
-            ("advog", "ADMINISTRATIVAS"),
-            ("frete", "SERVIÇOS OPERACIONAIS"),
-            ("transporte", "SERVIÇOS OPERACIONAIS"),
-            ("colheita", "SERVIÇOS OPERACIONAIS"),
-            ("secagem", "SERVIÇOS OPERACIONAIS"),
-            ("pulveriza", "SERVIÇOS OPERACIONAIS"),
-            ("mão de obra", "RECURSOS HUMANOS"),
-            ("salár", "RECURSOS HUMANOS"),
-            ("encargo", "RECURSOS HUMANOS"),
-            ("seguro", "SEGUROS E PROTEÇÃO"),
-            ("iptu", "IMPOSTOS E TAXAS"),
-            ("ipva", "IMPOSTOS E TAXAS"),
-            ("itr", "IMPOSTOS E TAXAS"),
-            ("ccir", "IMPOSTOS E TAXAS"),
-            ("máquina", "INVESTIMENTOS"),
-            ("implemento", "INVESTIMENTOS"),
-            ("veículo", "INVESTIMENTOS"),
-            ("imóvel", "INVESTIMENTOS"),
-        ]
-        for kw, cat in rules:
-            if kw in text:
-                return cat
-        return "ADMINISTRATIVAS"
+    @property
+    def gemini_model(self):
+        """
+        Modelo Gemini que suporte generateContent, escolhido pela descoberta
+        em cache (None sem chave configurada)
+        """
+        if self._gemini_model is None and gemini_key():
+            model_name = pick_gemini_model(
+                ["gemini-2.5-flash", "gemini-2.0-flash", "gemini-1.5-flash", "gemini-1.5-pro"],
+                env_model=os.getenv('GEMINI_MODEL_NAME'),
+            )
+            self._gemini_model = gemini_model(model_name)
+        return self._gemini_model
+
+    def _classify_with_rules(self, product_description: str) -> Optional[str]:
+        """
+        Regras locais por palavra-chave (uma passada, ver keyword_matcher);
+        None quando nenhuma palavra-chave casa ou a categoria foi inativada
+        """
+        category = rules_matcher().best(product_description)
+        return category if category in self.categories else None
 
     def classify_expense(self, product_description: str) -> str:
         """
-        Classifica uma despesa baseada na descrição dos produtos usando OpenAI GPT
+        Classifica uma despesa baseada na descrição dos produtos: modelo local
+        treinado com o histórico, regras por palavra-chave, memória de
+        classificações anteriores e, por último, LLM
         """
-        # Primeiro, regras locais rápidas
+        # Primeiro, o modelo local (só quando treinado e confiante)
+        local_cat = local_classifier.classify(product_description)
+        if local_cat:
+            return local_cat
+
+        # Depois, regras locais rápidas
         rule_cat = self._classify_with_rules(product_description)
         if rule_cat:
             return rule_cat
 
+        # Descrição já classificada pelo LLM antes (mesmo conjunto de categorias)
+        version = self.categories_version()
+        memo_cat = classification_memo.lookup(product_description, version)
+        if memo_cat:
+            return memo_cat
+
+        category = self._classify_with_llm(product_description)
+        if category is None:
+            return "ADMINISTRATIVAS"
+        classification_memo.store(product_description, category, version)
+        return category
+
+    def categories_version(self) -> str:
+        """
+        Identifica o conjunto de categorias (invalida a memória de classificações)
+        """
+        names = "\n".join([f"memo-v{classification_memo.FORMAT_VERSION}"] + sorted(self.categories))
+        return hashlib.sha256(names.encode('utf-8')).hexdigest()
+
+    def _classify_with_llm(self, product_description: str) -> Optional[str]:
+        """
+        Classificação pelo LLM (OpenAI, depois Gemini); None se ambos falharem
+        """
         categories_text = "\n".join([
             f"{category}: {', '.join(items)}"
             for category, items in self.categories.items()
@@ -171,75 +180,177 @@ class ExpenseClassifier:
         try:
             if not self.client:
                 return self._classify_with_gemini(prompt)
-            response = self.client.completions.create(
-                model="gpt-3.5-turbo-instruct",
-                prompt=prompt,
-                max_tokens=100,
-                temperature=0.1
-            )
+            # Descrições repetidas são respondidas pelo cache de LLM
+            classification = llm_cache.cached(
+                "openai", "gpt-3.5-turbo-instruct", prompt, 0.1,
+                lambda: call_provider(
+                    "openai",
+                    self.client.completions.create,
+                    model="gpt-3.5-turbo-instruct",
+                    prompt=prompt,
+                    max_tokens=100,
+                    temperature=0.1
+                ).choices[0].text
+            ).strip()
             
-            classification = response.choices[0].text.strip()
-            
-            # Verificar se a classificação está nas categorias válidas
-            if classification in self.categories:
-                return classification
-            else:
-                # Tentar encontrar uma categoria similar
-                for category in self.categories.keys():
-                    if category.lower() in classification.lower() or classification.lower() in category.lower():
-                        return category
-                
-                # Se não encontrar, retornar uma categoria padrão
-                return "ADMINISTRATIVAS"
+            return self._match_category(classification)
                 
         except Exception as e:
-            error_message = str(e)
-            print(f"OpenAI error in classification: {error_message}")
-            
-            # Tratamento específico para erros de quota da OpenAI - tentar Gemini
-            if "quota" in error_message.lower() or "exceeded" in error_message.lower():
-                print("OpenAI quota exceeded, trying Gemini fallback...")
-                return self._classify_with_gemini(prompt)
-            elif "rate limit" in error_message.lower():
-                print("OpenAI rate limit reached, trying Gemini fallback...")
-                return self._classify_with_gemini(prompt)
-            elif "authentication" in error_message.lower() or "api key" in error_message.lower():
-                print("OpenAI authentication error, trying Gemini fallback...")
-                return self._classify_with_gemini(prompt)
-            else:
-                # Para outros erros, tentar Gemini como fallback
-                print("OpenAI error, trying Gemini fallback...")
-                return self._classify_with_gemini(prompt)
+            # Quota, rate limit, autenticação e timeout contam para o circuit
+            # breaker; com o circuito aberto a OpenAI nem é chamada
+            kind = breaker_error_kind(e) or "erro"
+            print(f"OpenAI error in classification ({kind}): {str(e)}, trying Gemini fallback...")
+            return self._classify_with_gemini(prompt)
     
-    def _classify_with_gemini(self, prompt: str) -> str:
+    def _classify_with_gemini(self, prompt: str) -> Optional[str]:
         """
         Classifica despesa usando Google Gemini como fallback
         """
         if not self.gemini_model:
             print("Gemini not configured, using default category.")
-            return "ADMINISTRATIVAS"
+            return None
         
         try:
-            import google.generativeai as genai
-            response = self.gemini_model.generate_content(prompt)
-            classification = response.text.strip()
+            model_name = getattr(self.gemini_model, "model_name", None)
+            classification = llm_cache.cached(
+                "gemini", model_name, prompt, 0,
+                lambda: call_provider("gemini", self.gemini_model.generate_content, prompt).text
+            ).strip()
             
-            # Verificar se a classificação está nas categorias válidas
-            if classification in self.categories:
-                return classification
-            else:
-                # Tentar encontrar uma categoria similar
-                for category in self.categories.keys():
-                    if category.lower() in classification.lower() or classification.lower() in category.lower():
-                        return category
-                
-                # Se não encontrar, retornar uma categoria padrão
-                return "ADMINISTRATIVAS"
+            return self._match_category(classification)
                 
         except Exception as gemini_error:
             print(f"Gemini classification error: {str(gemini_error)}")
-            return "ADMINISTRATIVAS"  # Categoria padrão em caso de erro
+            return None
     
+    def _match_category(self, classification: str, default: Optional[str] = "ADMINISTRATIVAS") -> Optional[str]:
+        """
+        Categoria válida correspondente à resposta do LLM (default se nenhuma)
+        """
+        classification = (classification or "").strip()
+        # Verificar se a classificação está nas categorias válidas
+        if classification in self.categories:
+            return classification
+        # Tentar encontrar uma categoria similar
+        for category in self.categories.keys():
+            if classification and (category.lower() in classification.lower() or classification.lower() in category.lower()):
+                return category
+        # Se não encontrar, retornar uma categoria padrão
+        return default
+
+    def classify_many(self, descriptions: List[str]) -> List[str]:
+        """
+        Classifica várias descrições: modelo local, regras e memória de
+        classificações para todas de uma vez; as que sobrarem (sem repetição)
+        vão ao LLM em lotes de
+        CLASSIFY_BATCH_SIZE, uma chamada por lote respondendo um array JSON
+        """
+        results = local_classifier.classify_many(descriptions)
+        unresolved = {}
+        for i, description in enumerate(descriptions):
+            if results[i] is None:
+                results[i] = self._classify_with_rules(description)
+            if results[i] is None:
+                unresolved.setdefault((description or "").strip(), []).append(i)
+
+        version = self.categories_version()
+        for description, category in classification_memo.lookup_many(list(unresolved), version).items():
+            for i in unresolved.pop(description):
+                results[i] = category
+
+        pending = list(unresolved)
+        batch_size = max(1, int(os.getenv('CLASSIFY_BATCH_SIZE') or 50))
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            try:
+                labels = self._classify_batch_with_llm(batch)
+            except Exception as e:
+                print(f"LLM error in batch classification: {str(e)}")
+                labels = None
+            if labels is None:
+                # Sem LLM disponível: categoria padrão, sem memorizar
+                labels = [None] * len(batch)
+            else:
+                # Só respostas do LLM; itens sem categoria válida não são memorizados
+                classification_memo.store_many([(d, l) for d, l in zip(batch, labels) if l], version)
+            for description, label in zip(batch, labels):
+                for i in unresolved[description]:
+                    results[i] = label or "ADMINISTRATIVAS"
+        return results
+
+    def _classify_batch_with_llm(self, descriptions: List[str]) -> Optional[List[Optional[str]]]:
+        """
+        Uma única chamada ao LLM (com hedge e cache) para o lote inteiro.
+        None sem provedor configurado; None no item cuja resposta não é uma
+        categoria válida
+        """
+        categories = list(self.categories)
+        categories_text = "\n".join([
+            f"{category}: {', '.join(items)}"
+            for category, items in self.categories.items()
+        ])
+        items_text = "\n".join(f"{n}. {d}" for n, d in enumerate(descriptions, start=1))
+        prompt = f"""
+        Você é um especialista em classificação de despesas agrícolas.
+
+        Classifique CADA descrição de produtos abaixo em UMA das seguintes categorias:
+
+        {categories_text}
+
+        Descrições (numeradas):
+        {items_text}
+
+        Responda com o objeto JSON {{"categorias": [...]}}, com exatamente {len(descriptions)} nomes de categoria, na mesma ordem das descrições.
+        """
+        schema = {
+            "type": "object",
+            "properties": {"categorias": {"type": "array", "items": {"type": "string", "enum": categories}}},
+            "required": ["categorias"],
+            "additionalProperties": False,
+        }
+
+        def parse(text):
+            labels = json.loads(text).get("categorias")
+            if not isinstance(labels, list) or len(labels) != len(descriptions):
+                raise ValueError("resposta do LLM com quantidade de categorias diferente do lote")
+            return [self._match_category(label if isinstance(label, str) else "", default=None) for label in labels]
+
+        attempts = []
+        if self.client:
+            model = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+            def ask_openai(timeout):
+                response = self.client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    response_format={"type": "json_schema", "json_schema": {"name": "classificacao", "strict": True, "schema": schema}},
+                    temperature=0.1,
+                    timeout=timeout
+                )
+                return parse(response.choices[0].message.content)
+            attempts.append((f"openai:{model}", ask_openai))
+        if self.gemini_model:
+            gemini = self.gemini_model
+            def ask_gemini(timeout):
+                response = gemini.generate_content(
+                    prompt,
+                    generation_config={
+                        "response_mime_type": "application/json",
+                        "response_schema": {
+                            "type": "object",
+                            "properties": {"categorias": {"type": "array", "items": {"type": "string"}}},
+                            "required": ["categorias"],
+                        },
+                        "temperature": 0.1,
+                    },
+                    request_options={"timeout": timeout}
+                )
+                return parse(response.text)
+            name = getattr(gemini, "model_name", "").replace("models/", "")
+            attempts.append((f"gemini:{name}", ask_gemini))
+        if not attempts:
+            return None
+        return hedged_call(attempts, cache=(prompt, 0.1))
+
     def get_all_categories(self) -> Dict[str, List[str]]:
         """
         Retorna todas as categorias disponíveis
@@ -0,0 +1,115 @@
+from app import db
+from db_context import independent_session
+from models import CacheExtracao
+from pdf_processor import missing_required_fields
+from datetime import datetime
+from sqlalchemy import func
+import hashlib
+import json
+import os
+import threading
+
+# Cache de resultados de extração endereçado pelo SHA-256 do PDF.
+# Contadores de hit/miss são mantidos por processo; o total de hits
+# de cada entrada fica persistido na tabela. Lê e grava numa sessão própria
+# (independent_session), sem commit/rollback na sessão da requisição.
+_counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_counters_lock = threading.Lock()
+
+def _count(name: str, amount: int = 1):
+    with _counters_lock:
+        _counters[name] += amount
+
+def max_entries() -> int:
+    return int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES') or 5000)
+
+def hash_stream(stream, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Calcula o SHA-256 de um stream sem carregá-lo inteiro e volta ao início
+    """
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def lookup(documento_hash: str):
+    """
+    Retorna os dados extraídos em cache para o hash, ou None
+    """
+    try:
+        with independent_session() as session:
+            entry = session.query(CacheExtracao).filter_by(documento_hash=documento_hash).first()
+            if not entry:
+                _count('misses')
+                return None
+            data = json.loads(entry.result_json)
+            if data is None:
+                # Só o texto de uma extração incompleta (ver store_result)
+                _count('misses')
+                return None
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_accessed_at = datetime.utcnow()
+    except Exception as e:
+        print(f"Erro ao ler cache de extração: {e}")
+        _count('misses')
+        return None
+    _count('hits')
+    return data
+
+def store(documento_hash: str, data: dict, text: str = None):
+    """
+    Grava o resultado da extração e aplica o limite de tamanho (remove os
+    menos acessados recentemente)
+    """
+    try:
+        with independent_session() as session:
+            entry = session.query(CacheExtracao).filter_by(documento_hash=documento_hash).first()
+            if not entry:
+                entry = CacheExtracao(documento_hash=documento_hash, hits=0)
+                session.add(entry)
+            entry.result_json = json.dumps(data, ensure_ascii=False)
+            if text is not None:
+                entry.texto = text
+            entry.last_accessed_at = datetime.utcnow()
+            evicted = _evict(session)
+    except Exception as e:
+        print(f"Erro ao gravar cache de extração: {e}")
+        return
+    _count('stores')
+    _count('evictions', evicted)
+
+def store_result(documento_hash: str, data: dict, text: str = None) -> bool:
+    """
+    Grava o resultado só de extrações completas: o resultado degradado de uma
+    falha do LLM (rules_fallback) ou com campo obrigatório vazio ficaria
+    servido para sempre a esse PDF. Nesses casos guarda apenas o texto (usado
+    no aprendizado de templates), sem resultado para lookup. Retorna se o
+    resultado foi gravado.
+    """
+    if data.get('extraction_path') == 'rules_fallback' or missing_required_fields(data):
+        store(documento_hash, None, text)
+        return False
+    store(documento_hash, data, text)
+    return True
+
+def _evict(session) -> int:
+    session.flush()
+    excess = session.query(CacheExtracao).count() - max_entries()
+    if excess <= 0:
+        return 0
+    stale = session.query(CacheExtracao).order_by(CacheExtracao.last_accessed_at.asc()).limit(excess).all()
+    for entry in stale:
+        session.delete(entry)
+    return len(stale)
+
+def stats() -> dict:
+    with _counters_lock:
+        counters = dict(_counters)
+    lookups = counters['hits'] + counters['misses']
+    counters['hit_rate'] = (counters['hits'] / lookups) if lookups else 0.0
+    counters['entries'] = CacheExtracao.query.count()
+    counters['max_entries'] = max_entries()
+    counters['total_hits'] = int(db.session.query(func.coalesce(func.sum(CacheExtracao.hits), 0)).scalar())
+    return counters
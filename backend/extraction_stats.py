@@ -0,0 +1,33 @@
+from db_context import independent_session
+from models import EstatisticaExtracao
+
+# Contagem persistida de documentos por caminho de extração
+# (cache, template, rules, llm_partial, llm, rules_fallback), gravada numa
+# sessão própria para não encerrar a transação de quem chamou
+
+def record_path(path: str):
+    if not path:
+        return
+    try:
+        with independent_session() as session:
+            updated = session.query(EstatisticaExtracao).filter_by(caminho=path).update(
+                {'total': EstatisticaExtracao.total + 1}
+            )
+            if not updated:
+                session.add(EstatisticaExtracao(caminho=path, total=1))
+    except Exception as e:
+        print(f"Erro ao registrar estatística de extração: {e}")
+
+def report() -> dict:
+    rows = EstatisticaExtracao.query.order_by(EstatisticaExtracao.caminho.asc()).all()
+    total = sum(row.total for row in rows)
+    return {
+        'total': total,
+        'paths': {
+            row.caminho: {
+                'documents': row.total,
+                'percent': round(100.0 * row.total / total, 2) if total else 0.0
+            }
+            for row in rows
+        }
+    }
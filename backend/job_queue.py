@@ -0,0 +1,159 @@
+from app import app, db
+from models import ExtracaoJob
+from pdf_processor import PDFProcessor
+from supplier_templates import load_templates
+from concurrent.futures import ThreadPoolExecutor
+import extraction_cache
+from extraction_stats import record_path
+from datetime import datetime, timedelta
+import json
+import os
+import threading
+import uuid
+
+# Fila de extração em segundo plano: os jobs ficam persistidos na tabela
+# extracao_jobs e são executados por threads locais do próprio worker.
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(os.getenv('JOB_WORKERS') or 2)
+            _executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='extracao-job')
+        return _executor
+
+def stale_seconds() -> float:
+    return float(os.getenv('JOB_STALE_SECONDS') or 900)
+
+def recover_jobs():
+    """
+    Chamada na inicialização do app: jobs 'processando' há mais de
+    JOB_STALE_SECONDS (o processo caiu no meio) viram 'erro', para que quem
+    consulta /api/jobs/<id> não espere para sempre; jobs 'pendente' são
+    reenfileirados (o processo reiniciou antes de executá-los)
+    """
+    try:
+        cutoff = datetime.utcnow() - timedelta(seconds=stale_seconds())
+        stale = ExtracaoJob.query.filter(
+            ExtracaoJob.status == 'processando',
+            db.or_(ExtracaoJob.started_at.is_(None), ExtracaoJob.started_at < cutoff),
+        ).all()
+        for job in stale:
+            job.status = 'erro'
+            job.error = 'Processamento interrompido (reinício do servidor); envie o arquivo novamente'
+            job.finished_at = datetime.utcnow()
+            if job.file_path:
+                try:
+                    os.remove(job.file_path)
+                except OSError:
+                    pass
+        db.session.commit()
+        pending = [job.id for job in ExtracaoJob.query.filter_by(status='pendente').all()]
+        if pending:
+            executor = _get_executor()
+            for job_id in pending:
+                executor.submit(_run_job, job_id)
+        if stale or pending:
+            print(f"Jobs de extração: {len(stale)} interrompidos marcados como erro, {len(pending)} pendentes reenfileirados")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erro ao recuperar jobs: {e}")
+
+def _uploads_dir() -> str:
+    path = os.path.join(app.instance_path, 'uploads')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def enqueue_pdf(file) -> ExtracaoJob:
+    """
+    Grava o upload em disco, cria o job e o envia para execução.
+    Se o mesmo PDF já foi extraído, o job nasce concluído com o resultado em cache.
+    """
+    documento_hash = extraction_cache.hash_stream(file.stream)
+    cached = extraction_cache.lookup(documento_hash)
+    if cached is not None:
+        record_path('cache')
+        job = ExtracaoJob(
+            filename=file.filename,
+            documento_hash=documento_hash,
+            status='concluido',
+            result_json=json.dumps(cached, ensure_ascii=False),
+            started_at=datetime.utcnow(),
+            finished_at=datetime.utcnow()
+        )
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    extension = '.xml' if (file.filename or '').lower().endswith('.xml') else '.pdf'
+    file_path = os.path.join(_uploads_dir(), f"{uuid.uuid4().hex}{extension}")
+    file.save(file_path)
+
+    job = ExtracaoJob(filename=file.filename, file_path=file_path, documento_hash=documento_hash, status='pendente')
+    db.session.add(job)
+    db.session.commit()
+
+    _get_executor().submit(_run_job, job.id)
+    return job
+
+def _run_job(job_id: int):
+    with app.app_context():
+        try:
+            # Reivindicar o job de forma atômica (evita execução duplicada entre workers)
+            claimed = ExtracaoJob.query.filter_by(id=job_id, status='pendente').update(
+                {'status': 'processando', 'started_at': datetime.utcnow()}
+            )
+            db.session.commit()
+            if not claimed:
+                return
+
+            job = ExtracaoJob.query.get(job_id)
+            try:
+                processor = PDFProcessor(templates=load_templates())
+                # Passa o caminho: o PDF é lido via mmap, sem copiar os bytes para a memória
+                if job.file_path.endswith('.xml'):
+                    result = processor.process_xml(job.file_path)
+                else:
+                    result = processor.process_pdf(job.file_path)
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+
+            if result['success']:
+                record_path(result['data'].get('extraction_path'))
+                result['data']['documento_hash'] = job.documento_hash
+                job.status = 'concluido'
+                job.result_json = json.dumps(result['data'], ensure_ascii=False)
+                if job.documento_hash:
+                    extraction_cache.store_result(job.documento_hash, result['data'], result['text'])
+            else:
+                job.status = 'erro'
+                job.error = result['error']
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+
+            try:
+                os.remove(job.file_path)
+            except OSError:
+                pass
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erro ao executar job {job_id}: {e}")
+        finally:
+            db.session.remove()
+
+def job_to_dict(job: ExtracaoJob) -> dict:
+    result = {
+        'id': job.id,
+        'status': job.status,
+        'filename': job.filename,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+    if job.status == 'concluido':
+        result['data'] = json.loads(job.result_json)
+    elif job.status == 'erro':
+        result['error'] = job.error
+    return result
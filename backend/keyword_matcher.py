@@ -0,0 +1,70 @@
+import re
+import unicodedata
+
+# Casamento de várias palavras-chave numa única passada sobre o texto
+# normalizado (sem acentos, minúsculo). Os termos formam uma trie que é
+# compilada numa única expressão regular com prefixos fatorados, de modo que
+# a varredura roda no motor de regex (C) em vez de um laço por caractere em
+# Python. Cada termo pontua uma categoria com um peso; termos só casam no
+# início de palavra ("itr" não casa em "nitrogenado") e, se whole_word,
+# também até o fim da palavra.
+
+_END = ''  # marca de fim de termo na trie
+
+def normalize_text(text: str) -> str:
+    text = text or ''
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize('NFKD', text)
+    return decomposed.encode('ascii', 'ignore').decode('ascii').lower()
+
+class KeywordMatcher:
+    def __init__(self, rules, priorities=None):
+        """
+        rules: [(termo, categoria, peso, whole_word)]
+        priorities: categoria -> prioridade (desempate entre pontuações iguais)
+        """
+        self.priorities = dict(priorities or {})
+        self.outputs = {}
+        trie = {}
+        for term, category, weight, whole_word in rules:
+            term = normalize_text(term)
+            if not term:
+                continue
+            self.outputs.setdefault(term, []).append((category, float(weight)))
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            # Um termo cadastrado como radical e como palavra inteira vale como radical
+            node[_END] = node.get(_END, True) and bool(whole_word)
+        self.pattern = re.compile(r'\b(?:' + self._render(trie) + r')') if trie else None
+
+    def _render(self, node) -> str:
+        branches = [re.escape(char) + self._render(child) for char, child in sorted(node.items()) if char != _END]
+        if _END in node:
+            # Fim de termo por último: prefere o termo mais longo que casar
+            branches.append(r'\b' if node[_END] else '')
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+
+    def scores(self, text: str) -> dict:
+        """
+        Pontuação por categoria numa única passada sobre o texto
+        """
+        totals = {}
+        if self.pattern is None:
+            return totals
+        for term in self.pattern.findall(normalize_text(text)):
+            for category, weight in self.outputs[term]:
+                totals[category] = totals.get(category, 0.0) + weight
+        return totals
+
+    def best(self, text: str):
+        """
+        Categoria de maior pontuação (desempate pela prioridade), ou None
+        """
+        totals = self.scores(text)
+        if not totals:
+            return None
+        return max(totals, key=lambda c: (totals[c], self.priorities.get(c, 0)))
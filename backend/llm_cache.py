@@ -0,0 +1,120 @@
+from app import db
+from db_context import independent_session
+from models import CacheLLM
+from datetime import datetime
+from sqlalchemy import func
+import hashlib
+import json
+import os
+import re
+import threading
+
+# Cache persistente de respostas de LLM endereçado por provedor, modelo,
+# temperatura e prompt normalizado. Compartilhado por extração, classificação
+# e RAG; usado também fora de requisições. Lê e grava numa sessão própria
+# (independent_session), sem commit/rollback na sessão de quem chamou.
+_counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_counters_lock = threading.Lock()
+
+def _count(name: str, amount: int = 1):
+    with _counters_lock:
+        _counters[name] += amount
+
+def enabled() -> bool:
+    return os.getenv('LLM_CACHE', '1') != '0'
+
+def max_entries() -> int:
+    return int(os.getenv('LLM_CACHE_MAX_ENTRIES') or 20000)
+
+def normalize_prompt(prompt) -> str:
+    if not isinstance(prompt, str):
+        prompt = json.dumps(prompt, ensure_ascii=False, sort_keys=True)
+    return re.sub(r"\s+", " ", prompt).strip()
+
+def cache_key(provider: str, model: str, prompt, temperature: float) -> str:
+    raw = f"{provider}\n{model or ''}\n{float(temperature or 0):.3f}\n{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def lookup(key: str):
+    """
+    Retorna a resposta em cache para a chave, ou None
+    """
+    return lookup_any([key])
+
+def lookup_any(keys):
+    """
+    Retorna a resposta em cache da primeira chave (na ordem dada) presente,
+    ou None; uma única consulta para todas as chaves
+    """
+    if not enabled() or not keys:
+        return None
+    try:
+        with independent_session() as session:
+            entries = {e.chave: e for e in session.query(CacheLLM).filter(CacheLLM.chave.in_(list(keys))).all()}
+            entry = next((entries[k] for k in keys if k in entries), None)
+            if not entry:
+                _count('misses')
+                return None
+            value = json.loads(entry.response_json)
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_accessed_at = datetime.utcnow()
+    except Exception as e:
+        print(f"Erro ao ler cache de LLM: {e}")
+        _count('misses')
+        return None
+    _count('hits')
+    return value
+
+def store(key: str, provider: str, model: str, value):
+    """
+    Grava a resposta e aplica o limite de tamanho (LRU por último acesso)
+    """
+    if not enabled() or value is None:
+        return
+    try:
+        with independent_session() as session:
+            entry = session.query(CacheLLM).filter_by(chave=key).first()
+            if not entry:
+                entry = CacheLLM(chave=key, provedor=provider, modelo=model, hits=0)
+                session.add(entry)
+            entry.response_json = json.dumps(value, ensure_ascii=False)
+            entry.last_accessed_at = datetime.utcnow()
+            evicted = _evict(session)
+    except Exception as e:
+        print(f"Erro ao gravar cache de LLM: {e}")
+        return
+    _count('stores')
+    _count('evictions', evicted)
+
+def cached(provider: str, model: str, prompt, temperature: float, fn):
+    """
+    Retorna a resposta em cache ou chama fn() e grava o resultado
+    """
+    key = cache_key(provider, model, prompt, temperature)
+    value = lookup(key)
+    if value is not None:
+        return value
+    value = fn()
+    store(key, provider, model, value)
+    return value
+
+def _evict(session) -> int:
+    session.flush()
+    excess = session.query(CacheLLM).count() - max_entries()
+    if excess <= 0:
+        return 0
+    stale = session.query(CacheLLM).order_by(CacheLLM.last_accessed_at.asc()).limit(excess).all()
+    for entry in stale:
+        session.delete(entry)
+    return len(stale)
+
+def stats() -> dict:
+    with _counters_lock:
+        counters = dict(_counters)
+    lookups = counters['hits'] + counters['misses']
+    counters['hit_rate'] = (counters['hits'] / lookups) if lookups else 0.0
+    counters['enabled'] = enabled()
+    counters['entries'] = CacheLLM.query.count()
+    counters['max_entries'] = max_entries()
+    counters['total_hits'] = int(db.session.query(func.coalesce(func.sum(CacheLLM.hits), 0)).scalar())
+    return counters
@@ -0,0 +1,438 @@
+from app import app
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import json
+import llm_cache
+import os
+import threading
+import time
+
+# Infraestrutura comum das chamadas aos provedores de LLM (OpenAI / Gemini).
+
+# ==================== REGISTRO DE CLIENTES ====================
+
+# Um cliente por processo: o OpenAI mantém um pool HTTP (keep-alive) e o
+# genai.configure é global. O pid evita herdar conexões de um fork
+# (workers do ProcessPoolExecutor/gunicorn).
+_clients_lock = threading.Lock()
+_clients = {"pid": None, "openai": None, "gemini": False, "gemini_models": {}}
+
+def openai_key():
+    return os.getenv('OPENAI_API_KEY')
+
+def gemini_key():
+    return os.getenv('GOOGLE_API_KEY') or os.getenv('GEMINI_API_KEY')
+
+def _clients_for_process():
+    if _clients["pid"] != os.getpid():
+        _clients.update(pid=os.getpid(), openai=None, gemini=False, gemini_models={})
+    return _clients
+
+def openai_client():
+    """
+    Cliente OpenAI compartilhado do processo (None sem OPENAI_API_KEY)
+    """
+    if not openai_key():
+        return None
+    with _clients_lock:
+        clients = _clients_for_process()
+        if clients["openai"] is None:
+            from openai import OpenAI
+            clients["openai"] = OpenAI(api_key=openai_key())
+        return clients["openai"]
+
+def gemini():
+    """
+    Módulo genai configurado uma única vez por processo.
+    Levanta exceção sem GOOGLE_API_KEY/GEMINI_API_KEY.
+    """
+    if not gemini_key():
+        raise Exception("Gemini não configurado")
+    with _clients_lock:
+        clients = _clients_for_process()
+        import google.generativeai as genai
+        if not clients["gemini"]:
+            genai.configure(api_key=gemini_key())
+            clients["gemini"] = True
+        return genai
+
+def gemini_model(name: str):
+    """
+    Modelo Gemini compartilhado do processo
+    """
+    genai = gemini()
+    with _clients_lock:
+        clients = _clients_for_process()
+        model = clients["gemini_models"].get(name)
+        if model is None:
+            model = clients["gemini_models"][name] = genai.GenerativeModel(name)
+        return model
+
+# ==================== DESCOBERTA DE MODELOS GEMINI ====================
+
+# list_models é uma chamada remota: o resultado fica em memória e em disco
+# (instance/gemini_models.json) por GEMINI_MODELS_TTL segundos, compartilhado
+# por extração, classificação e RAG e entre workers/reinícios.
+DISCOVERY_RETRY = 300  # após falha, não tenta de novo antes disso
+
+_discovery_lock = threading.Lock()
+_discovery = {"at": 0.0, "ttl": 0.0, "models": None}
+
+def _discovery_file() -> str:
+    return os.getenv('GEMINI_MODELS_CACHE') or os.path.join(app.instance_path, 'gemini_models.json')
+
+def _discovery_ttl() -> float:
+    return float(os.getenv('GEMINI_MODELS_TTL') or 86400)
+
+def _read_discovery_file():
+    try:
+        with open(_discovery_file(), 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        return float(cached["fetched_at"]), list(cached["models"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def _write_discovery_file(fetched_at: float, models):
+    path = _discovery_file()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"fetched_at": fetched_at, "models": models}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Gemini model cache write error: {e}")
+
+def _list_gemini_models():
+    available = []
+    for m in gemini().list_models():
+        methods = getattr(m, "supported_generation_methods", None)
+        base = getattr(m, "name", "").replace("models/", "")
+        if methods and "generateContent" in methods:
+            # Evitar modelos experimentais/preview/latest que podem causar 404/429
+            if any(suf in base for suf in ["-exp", "-preview"]) or base.endswith("-latest"):
+                continue
+            available.append(base)
+    return available
+
+def available_gemini_models(refresh: bool = False):
+    """
+    Modelos Gemini estáveis com generateContent (memória -> disco -> list_models).
+    Lista vazia sem chave ou se a descoberta falhar.
+    """
+    if not gemini_key():
+        return []
+    with _discovery_lock:
+        now = time.time()
+        if not refresh and _discovery["models"] is not None and now - _discovery["at"] < _discovery["ttl"]:
+            return list(_discovery["models"])
+        cached = None if refresh else _read_discovery_file()
+        if cached and now - cached[0] < _discovery_ttl():
+            _discovery.update(at=cached[0], ttl=_discovery_ttl(), models=cached[1])
+            return list(cached[1])
+        try:
+            models = _list_gemini_models()
+        except Exception as e:
+            print(f"Gemini list_models error: {e}")
+            stale = _discovery["models"] if _discovery["models"] is not None else (cached[1] if cached else [])
+            _discovery.update(at=now, ttl=DISCOVERY_RETRY, models=stale)
+            return list(stale)
+        _discovery.update(at=now, ttl=_discovery_ttl(), models=models)
+        _write_discovery_file(now, models)
+        return list(models)
+
+def pick_gemini_model(preferred, env_model=None, default="gemini-1.5-pro") -> str:
+    """
+    Escolhe o modelo: o configurado em env, o primeiro preferido disponível,
+    o primeiro disponível ou `default` se a descoberta não trouxe nada
+    """
+    if env_model:
+        return env_model
+    available = available_gemini_models()
+    for name in preferred:
+        if name in available:
+            return name
+    return available[0] if available else default
+
+# ==================== CIRCUIT BREAKER POR PROVEDOR ====================
+
+# Erros de quota, autenticação ou timeout repetidos (LLM_BREAKER_THRESHOLD)
+# abrem o circuito do provedor: ele é pulado por LLM_BREAKER_COOLDOWN segundos
+# e depois uma única chamada de teste decide se volta a ser usado.
+# Outros erros (JSON inválido, modelo inexistente) não contam.
+BREAKER_ERRORS = [
+    ("quota", ("quota", "exceeded", "insufficient_quota")),
+    ("rate_limit", ("rate limit", "rate_limit", "429", "resource_exhausted")),
+    ("auth", ("authentication", "api key", "api_key", "401", "403", "permission")),
+    ("timeout", ("timeout", "timed out", "deadline")),
+]
+
+def breaker_error_kind(error):
+    """
+    Tipo do erro do provedor que conta para o circuit breaker, ou None
+    """
+    message = str(error).lower()
+    for kind, needles in BREAKER_ERRORS:
+        if any(n in message for n in needles):
+            return kind
+    return None
+
+class ProviderUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = "fechado"
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+
+    def threshold(self) -> int:
+        return int(os.getenv('LLM_BREAKER_THRESHOLD') or 3)
+
+    def cooldown(self) -> float:
+        return float(os.getenv('LLM_BREAKER_COOLDOWN') or 60)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == "fechado":
+                return True
+            if self.state == "aberto" and time.time() - self.opened_at >= self.cooldown():
+                self.state = "teste"  # libera uma única chamada de teste
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = "fechado"
+            self.failures = 0
+            self.opened_at = None
+
+    def release(self):
+        # Chamada de teste cancelada antes de rodar: libera outro teste
+        with self.lock:
+            if self.state == "teste":
+                self.state = "aberto"
+                self.opened_at = time.time() - self.cooldown()
+
+    def record_failure(self, error):
+        kind = breaker_error_kind(error)
+        with self.lock:
+            if not kind:
+                # O provedor respondeu; só a chamada em si falhou
+                if self.state == "teste":
+                    self.state = "fechado"
+                    self.failures = 0
+                return
+            self.failures += 1
+            self.last_error = f"{kind}: {str(error)[:200]}"
+            if self.state == "teste" or self.failures >= self.threshold():
+                if self.state != "aberto":
+                    print(f"Circuit breaker aberto para {self.name} ({kind})")
+                self.state = "aberto"
+                self.opened_at = time.time()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            retry_in = None
+            if self.state == "aberto":
+                retry_in = max(0.0, round(self.opened_at + self.cooldown() - time.time(), 1))
+            return {
+                "estado": self.state,
+                "falhas_consecutivas": self.failures,
+                "ultimo_erro": self.last_error,
+                "nova_tentativa_em_s": retry_in,
+            }
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def breaker(provider: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+def call_provider(provider: str, fn, *args, **kwargs):
+    """
+    Executa fn sob o circuit breaker do provedor ("openai" ou "gemini").
+    Levanta ProviderUnavailable sem chamar fn se o circuito estiver aberto.
+    """
+    cb = breaker(provider)
+    if not cb.allow():
+        raise ProviderUnavailable(f"{provider} em cool-down após falhas repetidas")
+    return _run_recorded(cb, fn, *args, **kwargs)
+
+def _run_recorded(cb: CircuitBreaker, fn, *args, **kwargs):
+    # A falha/sucesso é registrada mesmo se a chamada terminar após o deadline
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        cb.record_failure(e)
+        raise
+    cb.record_success()
+    return result
+
+def breaker_report() -> dict:
+    """
+    Estado dos circuit breakers deste processo
+    """
+    report = {}
+    for provider, configured in (("openai", openai_key()), ("gemini", gemini_key())):
+        report[provider] = dict(breaker(provider).to_dict(), configurado=bool(configured))
+    return report
+
+# ==================== CHAMADAS COM HEDGE E DEADLINE ====================
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(os.getenv('LLM_THREADS') or 16)
+            _executor = ThreadPoolExecutor(max_workers=max(2, workers), thread_name_prefix='llm')
+        return _executor
+
+def hedge_delay():
+    """
+    Atraso até disparar o próximo provedor (LLM_HEDGE_MODE):
+    - off: só após a falha do anterior (fallback serial)
+    - hedged (padrão): após LLM_HEDGE_DELAY segundos ou na falha do anterior
+    - parallel: todos ao mesmo tempo
+    """
+    mode = (os.getenv('LLM_HEDGE_MODE') or 'hedged').lower()
+    if mode == 'off':
+        return None
+    if mode == 'parallel':
+        return 0.0
+    return float(os.getenv('LLM_HEDGE_DELAY') or 2.0)
+
+def request_deadline() -> float:
+    return float(os.getenv('LLM_DEADLINE') or 30.0)
+
+def _split_name(name: str):
+    provider, _, model = name.partition(':')
+    return provider, model or None
+
+def max_in_flight() -> int:
+    return max(1, int(os.getenv('LLM_HEDGE_MAX_IN_FLIGHT') or 2))
+
+def _provider_chain(candidates, stop):
+    """
+    Uma tentativa por provedor: os modelos candidatos [(nome, fn(timeout))]
+    são tentados em sequência, cada um com o tempo que sobrar; retorna
+    (nome, resultado) do primeiro que responder
+    """
+    def run(timeout):
+        expires_at = time.monotonic() + timeout
+        errors = []
+        for name, fn in candidates:
+            remaining = expires_at - time.monotonic()
+            if stop.is_set() or remaining <= 0:
+                break
+            try:
+                result = fn(remaining)
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+                continue
+            if result is not None:
+                return name, result
+            errors.append(f"{name}: resposta vazia")
+        raise Exception("; ".join(errors) or "tempo esgotado")
+    return run
+
+def hedged_call(attempts, delay=None, deadline=None, cache=None):
+    """
+    Executa as tentativas [(nome, fn(timeout))] em ordem de preferência.
+    O hedge é entre provedores (prefixo do nome, "gemini:modelo" -> "gemini"):
+    os modelos de um mesmo provedor formam uma única tentativa e são tentados
+    em sequência. O primeiro provedor começa imediatamente; o seguinte começa
+    após `delay` segundos ou assim que o anterior falhar, com no máximo
+    LLM_HEDGE_MAX_IN_FLIGHT (padrão 2) chamadas simultâneas. O primeiro
+    resultado válido (sem exceção e diferente de None) vence. Um único
+    deadline cobre todas as tentativas; provedores com circuito aberto são pulados.
+    cache: (prompt, temperatura) para consultar/gravar o cache de respostas
+    (llm_cache) de cada "provedor:modelo" antes de chamar a rede.
+    """
+    if not attempts:
+        raise Exception("Nenhum provedor de LLM configurado")
+    keys = {}
+    if cache is not None:
+        prompt, temperature = cache
+        keys = {name: llm_cache.cache_key(*_split_name(name), prompt, temperature) for name, _ in attempts}
+        hit = llm_cache.lookup_any([keys[name] for name, _ in attempts])
+        if hit is not None:
+            return hit
+    delay = hedge_delay() if delay is None else delay
+    deadline = request_deadline() if deadline is None else deadline
+    limit = max_in_flight()
+    started_at = time.monotonic()
+    expires_at = started_at + deadline
+    executor = _get_executor()
+
+    # Agrupa por provedor, na ordem em que cada um aparece
+    by_provider = {}
+    for name, fn in attempts:
+        by_provider.setdefault(_split_name(name)[0], []).append((name, fn))
+    stop = threading.Event()
+    chains = [(provider, _provider_chain(candidates, stop)) for provider, candidates in by_provider.items()]
+
+    pending = {}
+    errors = []
+    next_index = 0
+    next_start = started_at
+
+    def launch():
+        nonlocal next_index, next_start
+        while next_index < len(chains) and len(pending) < limit:
+            provider, chain = chains[next_index]
+            next_index += 1
+            if not breaker(provider).allow():
+                errors.append(f"{provider}: em cool-down")
+                continue
+            remaining = max(0.1, expires_at - time.monotonic())
+            pending[executor.submit(_run_recorded, breaker(provider), chain, remaining)] = provider
+            break
+        next_start = time.monotonic() + delay if delay is not None else float('inf')
+
+    def can_launch():
+        return next_index < len(chains) and len(pending) < limit
+
+    try:
+        launch()
+        while pending:
+            now = time.monotonic()
+            if now >= expires_at:
+                break
+            if can_launch() and now >= next_start:
+                launch()
+                continue
+            wake_at = min(expires_at, next_start) if can_launch() else expires_at
+            done, _ = wait(list(pending), timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    name, result = future.result()
+                except Exception as e:
+                    errors.append(f"{provider}: {e}")
+                    continue
+                if name in keys:
+                    llm_cache.store(keys[name], *_split_name(name), result)
+                return result
+            # Provedor falhou: o próximo começa já, sem esperar o atraso
+            if done and can_launch():
+                launch()
+        if time.monotonic() >= expires_at:
+            errors.append(f"deadline de {deadline:.1f}s excedido")
+    finally:
+        # Tentativas na fila são canceladas; as em andamento não passam para o
+        # próximo modelo e terminam pelo timeout da chamada atual
+        stop.set()
+        for future, provider in pending.items():
+            if future.cancel():
+                breaker(provider).release()
+
+    raise Exception("Todos os provedores de LLM falharam: " + "; ".join(errors))
@@ -0,0 +1,219 @@
+from app import app, db
+from models import ContaPagar, ClassificacaoDespesa, TipoDespesa
+from keyword_matcher import normalize_text
+import category_registry
+from datetime import datetime
+import os
+import re
+import threading
+import numpy as np
+
+# Classificador local de despesas (TF-IDF + naive Bayes multinomial em NumPy)
+# treinado com as classificações já gravadas: ContaPagar.descricao_produtos ->
+# TipoDespesa.nome. Aprende também tipos de despesa criados pelo usuário.
+# O modelo fica em instance/expense_classifier.npz e é recarregado quando o
+# arquivo muda (retreino em outro worker/processo). Previsões de categorias
+# que não estão mais ativas no category_registry são descartadas (o modelo só
+# as esquece no próximo treino).
+
+TOKEN_PATTERN = re.compile(r"[a-z][a-z0-9]{2,}|\d{3,}")  # ignora "de", "e", "da"...
+
+# Fração mínima das palavras da descrição que o modelo precisa conhecer;
+# sem isso o naive Bayes decide por uma ou duas palavras soltas
+MIN_COVERAGE = 0.5
+
+def tokenize(text: str):
+    words = TOKEN_PATTERN.findall(normalize_text(text))
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def model_path() -> str:
+    return os.getenv('LOCAL_CLASSIFIER_PATH') or os.path.join(app.instance_path, 'expense_classifier.npz')
+
+def min_confidence() -> float:
+    return float(os.getenv('LOCAL_CLASSIFIER_MIN_CONFIDENCE') or 0.6)
+
+def min_samples() -> int:
+    return int(os.getenv('LOCAL_CLASSIFIER_MIN_SAMPLES') or 20)
+
+class NaiveBayesTextClassifier:
+    def __init__(self, classes, vocabulary, idf, class_log_prior, feature_log_prob, samples, trained_at):
+        self.classes = list(classes)
+        self.vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self.idf = idf
+        self.class_log_prior = class_log_prior
+        self.feature_log_prob = feature_log_prob
+        self.samples = int(samples)
+        self.trained_at = trained_at
+
+    @classmethod
+    def fit(cls, descriptions, labels, alpha: float = 0.1):
+        classes = sorted(set(labels))
+        class_index = {c: i for i, c in enumerate(classes)}
+        docs = []
+        for description in descriptions:
+            counts = {}
+            for term in tokenize(description):
+                counts[term] = counts.get(term, 0) + 1
+            docs.append(counts)
+        vocabulary = sorted({t for doc in docs for t in doc})
+        index = {term: i for i, term in enumerate(vocabulary)}
+
+        # Sem matriz documentos x termos: acumula direto por categoria
+        document_frequency = np.zeros(len(vocabulary), dtype=np.float64)
+        for doc in docs:
+            document_frequency[[index[t] for t in doc]] += 1
+        idf = (np.log((1 + len(docs)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        y = np.array([class_index[label] for label in labels])
+        class_features = np.zeros((len(classes), len(vocabulary)), dtype=np.float64)
+        for row, doc in zip(y, docs):
+            idx = np.fromiter((index[t] for t in doc), dtype=np.int64, count=len(doc))
+            class_features[row, idx] += np.log1p(np.fromiter(doc.values(), dtype=np.float64, count=len(doc))) * idf[idx]
+        smoothed = class_features + alpha
+        feature_log_prob = np.log(smoothed / smoothed.sum(axis=1, keepdims=True)).astype(np.float32)
+        class_log_prior = np.log(np.bincount(y, minlength=len(classes)) / len(y)).astype(np.float32)
+        return cls(classes, vocabulary, idf, class_log_prior, feature_log_prob, len(docs), datetime.utcnow().isoformat())
+
+    def predict(self, description: str):
+        """
+        Retorna (categoria, probabilidade) ou (None, 0.0) quando a descrição
+        tem poucas palavras conhecidas pelo modelo
+        """
+        columns = {}
+        words = known = 0
+        for term in tokenize(description):
+            i = self.vocabulary.get(term)
+            if " " not in term:
+                words += 1
+                known += i is not None
+            if i is not None:
+                columns[i] = columns.get(i, 0) + 1
+        if not columns or known < MIN_COVERAGE * words:
+            return None, 0.0
+        idx = np.fromiter(columns.keys(), dtype=np.int64)
+        weights = np.log1p(np.fromiter(columns.values(), dtype=np.float32)) * self.idf[idx]
+        scores = self.class_log_prior + self.feature_log_prob[:, idx] @ weights
+        scores = np.exp(scores - scores.max())
+        probabilities = scores / scores.sum()
+        best = int(probabilities.argmax())
+        return self.classes[best], float(probabilities[best])
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez(
+            tmp,
+            classes=np.array(self.classes),
+            vocabulary=np.array(vocabulary),
+            idf=self.idf,
+            class_log_prior=self.class_log_prior,
+            feature_log_prob=self.feature_log_prob,
+            samples=np.array(self.samples),
+            trained_at=np.array(self.trained_at),
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data['classes'].tolist(), data['vocabulary'].tolist(), data['idf'],
+                data['class_log_prior'], data['feature_log_prob'],
+                int(data['samples']), str(data['trained_at']),
+            )
+
+    def info(self) -> dict:
+        return {
+            "samples": self.samples,
+            "classes": self.classes,
+            "vocabulary": len(self.vocabulary),
+            "trained_at": self.trained_at,
+        }
+
+_model = {"mtime": None, "classifier": None}
+_model_lock = threading.Lock()
+
+def get_model():
+    """
+    Modelo treinado (recarregado se o arquivo mudou), ou None
+    """
+    path = model_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _model_lock:
+        if _model["mtime"] != mtime:
+            try:
+                _model["classifier"] = NaiveBayesTextClassifier.load(path)
+            except Exception as e:
+                print(f"Erro ao carregar classificador local: {e}")
+                _model["classifier"] = None
+            _model["mtime"] = mtime
+        return _model["classifier"]
+
+def classify(description: str):
+    """
+    Categoria prevista pelo modelo local quando ele é confiável
+    (LOCAL_CLASSIFIER_MIN_SAMPLES e LOCAL_CLASSIFIER_MIN_CONFIDENCE) e a
+    categoria continua ativa, ou None
+    """
+    model = get_model()
+    if model is None or model.samples < min_samples() or len(model.classes) < 2:
+        return None
+    category, probability = model.predict(description)
+    if probability < min_confidence() or category not in category_registry.get_categories():
+        return None
+    return category
+
+def classify_many(descriptions):
+    """
+    Como classify, para uma lista (modelo carregado e verificado uma vez)
+    """
+    model = get_model()
+    if model is None or model.samples < min_samples() or len(model.classes) < 2:
+        return [None] * len(descriptions)
+    threshold = min_confidence()
+    active = category_registry.get_categories()
+    results = []
+    for description in descriptions:
+        category, probability = model.predict(description)
+        results.append(category if probability >= threshold and category in active else None)
+    return results
+
+def training_rows():
+    return (
+        db.session.query(ContaPagar.descricao_produtos, TipoDespesa.nome)
+        .join(ClassificacaoDespesa, ClassificacaoDespesa.conta_pagar_id == ContaPagar.id)
+        .join(TipoDespesa, TipoDespesa.id == ClassificacaoDespesa.tipo_despesa_id)
+        .filter(TipoDespesa.is_active.is_(True), ClassificacaoDespesa.is_active.is_(True))
+        .all()
+    )
+
+def train() -> dict:
+    """
+    Treina com as classificações gravadas no banco e salva o modelo
+    """
+    rows = [(d, nome) for d, nome in training_rows() if d and d.strip()]
+    if not rows:
+        raise ValueError("Nenhuma despesa classificada para treinar")
+    descriptions, labels = zip(*rows)
+    model = NaiveBayesTextClassifier.fit(descriptions, labels)
+    model.save(model_path())
+    get_model()
+    return model.info()
+
+def status() -> dict:
+    model = get_model()
+    return {
+        "trained": model is not None,
+        "model": model.info() if model else None,
+        "min_samples": min_samples(),
+        "min_confidence": min_confidence(),
+    }
+
+if __name__ == '__main__':
+    with app.app_context():
+        info = train()
+        print(f"Classificador treinado: {info['samples']} despesas, {len(info['classes'])} categorias, {info['vocabulary']} termos")
@@ -0,0 +1,129 @@
+"""
+Converte os embeddings do EmbeddingIndex de JSON (embedding_json) para o
+formato binário (embedding_blob, ver embedding_codec), em lotes.
+
+Uso:
+    python migrate_embeddings.py [--batch-size 500] [--dtype float32|float16] [--vacuum]
+
+Em bancos criados antes da coluna binária, ajusta antes o esquema da tabela
+(no SQLite, recriando-a, já que não há ALTER COLUMN); o mesmo ajuste roda na
+inicialização do app (ensure_schema). Pode ser interrompido
+e executado de novo: só converte linhas ainda sem embedding_blob.
+"""
+import argparse
+import json
+from sqlalchemy import inspect
+from app import app, db
+from models import EmbeddingIndex
+from embedding_codec import pack_embedding, storage_dtype, DTYPE_CODES
+
+TABLE = EmbeddingIndex.__tablename__
+
+def upgrade_schema():
+    """
+    Garante a coluna embedding_blob e embedding_json anulável
+    """
+    inspector = inspect(db.engine)
+    if not inspector.has_table(TABLE):
+        EmbeddingIndex.__table__.create(db.engine)
+        return
+    columns = {c['name']: c for c in inspector.get_columns(TABLE)}
+    missing_blob = 'embedding_blob' not in columns
+    json_required = not columns['embedding_json']['nullable']
+    if not missing_blob and not json_required:
+        return
+
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as conn:
+        if dialect == 'sqlite':
+            old = f"{TABLE}_antigo"
+            conn.exec_driver_sql(f"ALTER TABLE {TABLE} RENAME TO {old}")
+            EmbeddingIndex.__table__.create(conn)
+            names = ", ".join(c for c in columns if c in EmbeddingIndex.__table__.columns)
+            conn.exec_driver_sql(f"INSERT INTO {TABLE} ({names}) SELECT {names} FROM {old}")
+            conn.exec_driver_sql(f"DROP TABLE {old}")
+        elif dialect == 'mysql':
+            if missing_blob:
+                blob_type = EmbeddingIndex.__table__.c.embedding_blob.type.compile(dialect=db.engine.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {TABLE} ADD COLUMN embedding_blob {blob_type}")
+            if json_required:
+                conn.exec_driver_sql(f"ALTER TABLE {TABLE} MODIFY embedding_json TEXT NULL")
+        else:
+            raise RuntimeError(f"Banco {dialect} não suportado pela migração")
+    print("Esquema de embedding_index atualizado")
+
+def ensure_schema():
+    """
+    Chamado na inicialização do app (run.py/passenger_wsgi.py): aplica
+    upgrade_schema e, se não for possível, interrompe com uma mensagem clara
+    em vez de deixar as consultas do RAG falharem pela coluna ausente
+    """
+    try:
+        upgrade_schema()
+    except Exception as e:
+        raise RuntimeError(
+            f"Não foi possível adicionar embedding_index.embedding_blob ({e}). "
+            "Ajuste o esquema com 'python migrate_embeddings.py' antes de iniciar o servidor."
+        ) from e
+
+def migrate(batch_size: int = 500, dtype: str = None) -> dict:
+    upgrade_schema()
+    dtype = dtype or storage_dtype()
+    stats = {"converted": 0, "invalid": 0, "json_bytes": 0, "binary_bytes": 0}
+    last_id = 0
+    while True:
+        rows = (
+            db.session.query(EmbeddingIndex.id, EmbeddingIndex.embedding_json)
+            .filter(
+                EmbeddingIndex.id > last_id,
+                EmbeddingIndex.embedding_blob.is_(None),
+                EmbeddingIndex.embedding_json.isnot(None),
+            )
+            .order_by(EmbeddingIndex.id.asc())
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        mappings = []
+        for row_id, raw in rows:
+            try:
+                vector = json.loads(raw)
+            except Exception:
+                stats["invalid"] += 1
+                continue
+            if not isinstance(vector, list) or not vector:
+                stats["invalid"] += 1
+                continue
+            blob = pack_embedding(vector, dtype)
+            stats["json_bytes"] += len(raw.encode('utf-8'))
+            stats["binary_bytes"] += len(blob)
+            mappings.append({"id": row_id, "embedding_blob": blob, "embedding_json": None})
+        last_id = rows[-1][0]
+        if mappings:
+            db.session.bulk_update_mappings(EmbeddingIndex, mappings)
+            db.session.commit()
+            stats["converted"] += len(mappings)
+            print(f"{stats['converted']} embeddings convertidos (até id {last_id})")
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Converte embeddings JSON para binário")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dtype", choices=sorted(DTYPE_CODES))
+    parser.add_argument("--vacuum", action="store_true", help="SQLite: devolve ao disco o espaço liberado")
+    args = parser.parse_args()
+    with app.app_context():
+        stats = migrate(args.batch_size, args.dtype)
+        if stats["json_bytes"]:
+            ratio = stats["binary_bytes"] / stats["json_bytes"]
+            print(f"JSON {stats['json_bytes'] / 2**20:.1f} MB -> binário {stats['binary_bytes'] / 2**20:.1f} MB ({ratio:.0%})")
+        if stats["invalid"]:
+            print(f"{stats['invalid']} linhas com JSON inválido mantidas como estão")
+        if args.vacuum and db.engine.dialect.name == 'sqlite':
+            with db.engine.connect() as conn:
+                conn.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("VACUUM")
+            print("VACUUM concluído")
+
+if __name__ == '__main__':
+    main()
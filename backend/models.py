@@ -1,6 +1,7 @@
 from app import db
 from datetime import datetime
 from sqlalchemy.orm import relationship
+from embedding_codec import pack_embedding, unpack_embedding
 import json
 
 class BaseModel(db.Model):
@@ -144,13 +145,88 @@ class EmbeddingIndex(BaseModel):
     entity_type = db.Column(db.String(50), nullable=False)
     entity_id = db.Column(db.Integer, nullable=False)
     text = db.Column(db.Text, nullable=False)
-    embedding_json = db.Column(db.Text, nullable=False)  # armazenar lista de floats como JSON
+    embedding_blob = db.Column(db.LargeBinary)  # float32/float16 com cabeçalho (ver embedding_codec)
+    embedding_json = db.Column(db.Text)  # formato antigo, convertido por migrate_embeddings.py
 
     def set_embedding(self, vector):
-        self.embedding_json = json.dumps(vector)
+        self.embedding_blob = pack_embedding(vector)
+        self.embedding_json = None
 
     def get_embedding(self):
         try:
+            if self.embedding_blob is not None:
+                return unpack_embedding(self.embedding_blob).tolist()
             return json.loads(self.embedding_json)
         except Exception:
-            return []
\ No newline at end of file
+            return []
+
+class ExtracaoJob(BaseModel):
+    __tablename__ = 'extracao_jobs'
+
+    status = db.Column(db.String(20), nullable=False, default='pendente')  # pendente, processando, concluido, erro
+    filename = db.Column(db.String(255))
+    file_path = db.Column(db.String(500))
+    documento_hash = db.Column(db.String(64), index=True)
+    result_json = db.Column(db.Text)
+    error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+
+class CacheExtracao(BaseModel):
+    __tablename__ = 'cache_extracao'
+
+    documento_hash = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 do PDF
+    result_json = db.Column(db.Text, nullable=False)
+    texto = db.Column(db.Text)  # texto extraído do PDF (usado no aprendizado de templates)
+    hits = db.Column(db.Integer, default=0)
+    last_accessed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class TemplateFornecedor(BaseModel):
+    __tablename__ = 'templates_fornecedor'
+
+    cnpj = db.Column(db.String(18), unique=True, nullable=False)
+    razao_social = db.Column(db.String(255))
+    fantasia = db.Column(db.String(255))
+    template_json = db.Column(db.Text, nullable=False)  # regras (âncora + tipo) por campo
+    confirmacoes = db.Column(db.Integer, default=0)
+
+class TemplateConfirmacao(BaseModel):
+    __tablename__ = 'templates_confirmacoes'
+    __table_args__ = (db.UniqueConstraint('template_id', 'documento_hash'),)
+
+    # Documento (SHA-256) já contado nas confirmações do template
+    template_id = db.Column(db.Integer, db.ForeignKey('templates_fornecedor.id'), nullable=False)
+    documento_hash = db.Column(db.String(64), nullable=False)
+
+class EstatisticaExtracao(BaseModel):
+    __tablename__ = 'estatisticas_extracao'
+
+    caminho = db.Column(db.String(30), unique=True, nullable=False)  # template, rules, llm, cache...
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+class CacheLLM(BaseModel):
+    __tablename__ = 'cache_llm'
+
+    chave = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 de provedor+modelo+temperatura+prompt
+    provedor = db.Column(db.String(20), nullable=False)
+    modelo = db.Column(db.String(100))
+    response_json = db.Column(db.Text, nullable=False)
+    hits = db.Column(db.Integer, default=0)
+    last_accessed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class ClassificacaoMemo(BaseModel):
+    __tablename__ = 'classificacoes_memo'
+
+    chave = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 da descrição normalizada
+    descricao_normalizada = db.Column(db.Text, nullable=False)
+    categoria = db.Column(db.String(100), nullable=False)
+    categorias_versao = db.Column(db.String(64), nullable=False, index=True)  # conjunto de categorias da época
+    hits = db.Column(db.Integer, default=0)
+    last_accessed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class VersaoRegistro(BaseModel):
+    __tablename__ = 'versoes_registro'
+
+    nome = db.Column(db.String(50), unique=True, nullable=False)  # ex.: categorias_despesa
+    versao = db.Column(db.Integer, nullable=False, default=0)
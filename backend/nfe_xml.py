@@ -0,0 +1,155 @@
+import codecs
+import defusedxml.ElementTree as ET
+from defusedxml import DefusedXmlException
+from datetime import datetime
+from typing import List, Optional
+
+# Leitura direta do XML da NF-e (nfeProc / NFe): produz o mesmo dicionário de
+# PDFProcessor.extract_invoice_data, com itens e duplicatas reais e sem LLM.
+
+NFE_NS = "http://www.portalfiscal.inf.br/nfe"
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+def _child(node, *path):
+    """Navega pelos filhos pelo nome local da tag (ignora namespace)"""
+    for name in path:
+        if node is None:
+            return None
+        node = next((c for c in node if _local(c.tag) == name), None)
+    return node
+
+def _children(node, name) -> List:
+    if node is None:
+        return []
+    return [c for c in node if _local(c.tag) == name]
+
+def _text(node, *path) -> Optional[str]:
+    node = _child(node, *path)
+    if node is None or node.text is None:
+        return None
+    return node.text.strip() or None
+
+def _float(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _date(value) -> Optional[str]:
+    """dhEmi (2024-09-20T10:00:00-03:00) ou dEmi (2024-09-20) -> YYYY-MM-DD"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:10], "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        return None
+
+def _format_cnpj(value) -> Optional[str]:
+    if not value or len(value) != 14:
+        return value
+    return f"{value[:2]}.{value[2:5]}.{value[5:8]}/{value[8:12]}-{value[12:]}"
+
+def _format_cpf(value) -> Optional[str]:
+    if not value or len(value) != 11:
+        return value
+    return f"{value[:3]}.{value[3:6]}.{value[6:9]}-{value[9:]}"
+
+def _format_qty(value) -> str:
+    qty = _float(value)
+    if qty is None:
+        return value or ""
+    return f"{qty:g}"
+
+class InvalidNFeXML(ValueError):
+    """
+    Conteúdo enviado não é um XML de NF-e legível (erro do cliente, não do servidor)
+    """
+
+def is_nfe_xml(content: bytes) -> bool:
+    """
+    Confere pelo início do conteúdo se o arquivo é o XML de uma NF-e
+    """
+    head = content[:2048].lstrip()
+    if head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8):].lstrip()
+    return head.startswith(b"<") and (b"nfeProc" in head or b"<NFe" in head or NFE_NS.encode() in head)
+
+def parse_nfe_xml(content: bytes) -> dict:
+    """
+    Converte o XML da NF-e no dicionário de extração usado em /api/save-invoice
+    """
+    try:
+        # defusedxml: upload não confiável (sem entidades externas nem expansão)
+        root = ET.fromstring(content)
+    except (ET.ParseError, DefusedXmlException) as e:
+        raise InvalidNFeXML(f"XML da NF-e inválido: {str(e)}")
+
+    if _local(root.tag) == "infNFe":
+        inf = root
+    else:
+        nfe = root if _local(root.tag) == "NFe" else _child(root, "NFe")
+        inf = _child(nfe, "infNFe")
+    if inf is None:
+        raise InvalidNFeXML("XML não contém o elemento infNFe de uma NF-e")
+
+    ide = _child(inf, "ide")
+    emit = _child(inf, "emit")
+    dest = _child(inf, "dest")
+
+    itens = []
+    descricoes = []
+    for det in _children(inf, "det"):
+        prod = _child(det, "prod")
+        if _text(prod, "xProd"):
+            unidade = f" {_text(prod, 'uCom')}" if _text(prod, "uCom") else ""
+            descricoes.append(f"{_text(prod, 'xProd')} ({_format_qty(_text(prod, 'qCom'))}{unidade})")
+        itens.append({
+            "numero_item": int(det.get("nItem")) if (det.get("nItem") or "").isdigit() else len(itens) + 1,
+            "codigo": _text(prod, "cProd"),
+            "descricao": _text(prod, "xProd"),
+            "ncm": _text(prod, "NCM"),
+            "cfop": _text(prod, "CFOP"),
+            "unidade": _text(prod, "uCom"),
+            "quantidade": _float(_text(prod, "qCom")),
+            "valor_unitario": _float(_text(prod, "vUnCom")),
+            "valor_total": _float(_text(prod, "vProd"))
+        })
+
+    data_emissao = _date(_text(ide, "dhEmi") or _text(ide, "dEmi"))
+    valor_total = _float(_text(inf, "total", "ICMSTot", "vNF"))
+
+    parcelas = []
+    for dup in _children(_child(inf, "cobr"), "dup"):
+        parcelas.append({
+            "numero_parcela": len(parcelas) + 1,
+            "numero_duplicata": _text(dup, "nDup"),
+            "data_vencimento": _date(_text(dup, "dVenc")),
+            "valor": _float(_text(dup, "vDup"))
+        })
+
+    return {
+        "fornecedor": {
+            "razao_social": _text(emit, "xNome"),
+            "fantasia": _text(emit, "xFant"),
+            "cnpj": _format_cnpj(_text(emit, "CNPJ"))
+        },
+        "faturado": {
+            "nome_completo": _text(dest, "xNome"),
+            "cpf": _format_cpf(_text(dest, "CPF")),
+            # Destinatário pessoa jurídica: Faturado só guarda CPF, o CNPJ vai à parte
+            "cnpj": _format_cnpj(_text(dest, "CNPJ"))
+        },
+        "numero_nota_fiscal": _text(ide, "nNF"),
+        "serie": _text(ide, "serie"),
+        "chave_acesso": (inf.get("Id") or "").replace("NFe", "") or None,
+        "data_emissao": data_emissao,
+        "descricao_produtos": "; ".join(descricoes) or None,
+        "valor_total": valor_total,
+        "data_vencimento": (parcelas[0]["data_vencimento"] if parcelas else None) or data_emissao,
+        "quantidade_parcelas": len(parcelas) or 1,
+        "parcelas": parcelas,
+        "itens": itens,
+        "extraction_path": "xml"
+    }
@@ -5,9 +5,13 @@ sys.path.insert(0, os.path.dirname(__file__))
 
 from run import app as application
 from run import db  # noqa: F401
+from job_queue import recover_jobs
+from migrate_embeddings import ensure_schema
 
 with application.app_context():
     try:
         db.create_all()
     except Exception:
         pass
+    ensure_schema()
+    recover_jobs()
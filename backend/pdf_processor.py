@@ -1,71 +1,506 @@
-import openai
-from openai import OpenAI
-import PyPDF2
+import copy
 import json
-import io
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Iterator, List, Optional
 from expense_classifier import ExpenseClassifier
+from supplier_templates import match_template, apply_template, template_fields_found
+from supplier_templates import REQUIRED_FIELDS as TEMPLATE_REQUIRED_FIELDS
+from nfe_xml import parse_nfe_xml, InvalidNFeXML
+from pdf_text_backends import get_backend
+from llm_providers import hedged_call, openai_client, gemini_model, gemini_key
+
+# Campos obrigatórios para salvar a nota (caminhos "a.b" no dicionário de extração)
+REQUIRED_FIELDS = [
+    "fornecedor.razao_social",
+    "fornecedor.cnpj",
+    "faturado.cpf",
+    "numero_nota_fiscal",
+    "data_emissao",
+    "descricao_produtos",
+    "valor_total",
+    "data_vencimento",
+]
+
+FIELD_SCHEMA = {
+    "fornecedor.razao_social": "string",
+    "fornecedor.fantasia": "string ou null",
+    "fornecedor.cnpj": "string (formato XX.XXX.XXX/XXXX-XX)",
+    "faturado.nome_completo": "string",
+    "faturado.cpf": "string (formato XXX.XXX.XXX-XX)",
+    "numero_nota_fiscal": "string",
+    "data_emissao": "string (formato YYYY-MM-DD)",
+    "descricao_produtos": "string (descrição detalhada de todos os produtos/serviços)",
+    "valor_total": "number (valor decimal)",
+    "data_vencimento": "string (formato YYYY-MM-DD)",
+}
+
+# Seções de um DANFE e os campos que dependem de cada uma (None = sempre manter).
+# Seções que não alimentam nenhum campo do schema ficam com conjunto vazio.
+_EMITENTE_FIELDS = {"fornecedor.razao_social", "fornecedor.cnpj", "numero_nota_fiscal", "data_emissao"}
+COMPACTION_SECTIONS = {
+    "cabecalho": None,
+    "emitente": _EMITENTE_FIELDS,
+    "destinatario": {"faturado.cpf", "faturado.nome_completo", "data_emissao"},
+    "fatura": {"data_vencimento", "valor_total"},
+    "imposto": {"valor_total"},
+    "produtos": {"descricao_produtos"},
+    "transportador": set(),
+    "issqn": set(),
+    "adicionais": set(),
+}
+
+SECTION_HEADERS = [
+    (name, re.compile(pattern, re.IGNORECASE)) for name, pattern in [
+        ("emitente", r"^(IDENTIFICA[ÇC][ÃA]O DO )?EMITENTE\b"),
+        ("destinatario", r"^DESTINAT[ÁA]RIO|^REMETENTE"),
+        ("fatura", r"^FATURA|^DUPLICATA"),
+        ("imposto", r"^C[ÁA]LCULO DO IMPOSTO"),
+        ("transportador", r"^TRANSPORTADOR"),
+        ("produtos", r"^DADOS DO(S)? PRODUTO|^PRODUTOS?\s*/\s*SERVI"),
+        ("issqn", r"^C[ÁA]LCULO DO ISSQN"),
+        ("adicionais", r"^DADOS ADICIONAIS|^INFORMA[ÇC][ÕO]ES COMPLEMENTARES|^RESERVADO AO FISCO"),
+    ]
+]
+
+BOILERPLATE = re.compile(
+    r"DOCUMENTO AUXILIAR DA NOTA|RECEBEMOS DE|DATA DE RECEBIMENTO|ASSINATURA DO RECEBEDOR|"
+    r"CONSULTA DE AUTENTICIDADE|nfe\.fazenda\.gov\.br|PROTOCOLO DE AUTORIZA|"
+    r"SIMPLES NACIONAL|LEI\s*(N[ºo°]\s*)?12\.741|N[ÃA]O GERA DIREITO A CR[ÉE]DITO|"
+    r"^FOLHA\s*\d+\s*/\s*\d+$|^P[ÁA]GINA\s*\d+",
+    re.IGNORECASE
+)
+
+# Rótulos de colunas da tabela de itens do DANFE ("NCM CST CFOP UN QTD V.UNIT"):
+# uma linha com dois ou mais deles é cabeçalho, não descrição
+ITEM_COLUMN_LABELS = re.compile(
+    r"(?<![A-Z])(NCM(/SH)?|CST|CSOSN|CFOP|UNID?|QTDE?|QUANT|V\.\s*UNIT|V\.\s*TOTAL|VL\.?\s*UNIT|"
+    r"B\.?\s*C[ÁA]LC|AL[ÍI]Q|C[ÓO]D(IGO)?)(?![A-Z])",
+    re.IGNORECASE
+)
+
+def _is_layout_line(line: str) -> bool:
+    """
+    Texto do formulário do DANFE (cabeçalho de colunas, títulos de seção,
+    avisos padrão) que as heurísticas não devem tomar por descrição
+    """
+    line = line.strip()
+    if len(ITEM_COLUMN_LABELS.findall(line)) >= 2 or BOILERPLATE.search(line):
+        return True
+    if re.search(r"CONSTANTES DA NOTA|INDICAD[AO] AO LADO", line, re.IGNORECASE):
+        return True
+    return any(pattern.search(line) for _, pattern in SECTION_HEADERS)
+
+# Campos que podem continuar nas páginas seguintes (lista de itens, totais)
+CHUNK_FIELDS = ["descricao_produtos", "valor_total"]
+
+FISCAL_COLUMNS = re.compile(r"\s\d{8}\s+\d{2,4}\s+[1-7]\d{3}(?=\s)")
+
+def _get_field(data: dict, path: str):
+    for key in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+def missing_required_fields(data: dict) -> List[str]:
+    """
+    Campos obrigatórios sem valor no dicionário de extração
+    """
+    return [f for f in REQUIRED_FIELDS if _get_field(data, f) in (None, "")]
+
+def _set_field(data: dict, path: str, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        data = data.setdefault(key, {})
+    data[keys[-1]] = value
+
+def _response_fields(fields):
+    fields = list(fields)
+    if "fornecedor.razao_social" in fields and "fornecedor.fantasia" not in fields:
+        fields.append("fornecedor.fantasia")
+    return fields
+
+def response_schema(fields) -> dict:
+    """
+    JSON Schema (modo strict da OpenAI) só com os campos pedidos; todos
+    obrigatórios e anuláveis, sem propriedades extras
+    """
+    schema = {"type": "object", "properties": {}, "required": [], "additionalProperties": False}
+    for field in _response_fields(fields):
+        node = schema
+        keys = field.split(".")
+        for key in keys[:-1]:
+            if key not in node["properties"]:
+                node["properties"][key] = {"type": "object", "properties": {}, "required": [], "additionalProperties": False}
+                node["required"].append(key)
+            node = node["properties"][key]
+        kind = "number" if FIELD_SCHEMA[field].startswith("number") else "string"
+        prop = {"type": [kind, "null"]}
+        # Só a dica de formato vira descrição: "string (formato YYYY-MM-DD)" -> "formato YYYY-MM-DD"
+        hint = re.search(r"\((.+)\)", FIELD_SCHEMA[field])
+        if hint:
+            prop["description"] = hint.group(1)
+        node["properties"][keys[-1]] = prop
+        node["required"].append(keys[-1])
+    return schema
+
+def gemini_schema(schema: dict) -> dict:
+    """
+    Converte o JSON Schema para o subconjunto OpenAPI do response_schema do Gemini
+    """
+    kind = schema["type"]
+    converted = {}
+    if isinstance(kind, list):
+        converted["nullable"] = "null" in kind
+        kind = next(k for k in kind if k != "null")
+    converted["type"] = kind
+    if "description" in schema:
+        converted["description"] = schema["description"]
+    if kind == "object":
+        converted["properties"] = {k: gemini_schema(v) for k, v in schema["properties"].items()}
+        converted["required"] = list(schema["required"])
+    return converted
+
+def validate_llm_data(data, fields) -> dict:
+    """
+    Validação estrita da resposta do LLM contra os campos consumidos por
+    save_invoice. Estrutura inválida (não-objeto, campo ausente ou de tipo
+    errado) levanta ValueError; valores em formato inválido viram None e
+    ficam com o valor das heurísticas.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("resposta do LLM não é um objeto JSON")
+    for field in _response_fields(fields):
+        parent = _get_field(data, field.rsplit(".", 1)[0]) if "." in field else data
+        key = field.rsplit(".", 1)[-1]
+        if not isinstance(parent, dict) or key not in parent:
+            raise ValueError(f"campo ausente na resposta do LLM: {field}")
+        value = parent[key]
+        if value is None:
+            continue
+        if FIELD_SCHEMA[field].startswith("number"):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"campo {field} deveria ser número")
+            if value <= 0:
+                parent[key] = None
+            continue
+        if not isinstance(value, str):
+            raise ValueError(f"campo {field} deveria ser texto")
+        value = value.strip()
+        if field in ("data_emissao", "data_vencimento"):
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                value = None
+        elif field == "fornecedor.cnpj":
+            value = value if len(re.sub(r"\D", "", value)) == 14 else None
+        elif field == "faturado.cpf":
+            value = value if len(re.sub(r"\D", "", value)) == 11 else None
+        parent[key] = value or None
+    return data
+
+def merge_chunk_results(results) -> dict:
+    """
+    Junta as respostas por bloco de forma determinística: campos de cabeçalho
+    do primeiro bloco, descrições dos produtos concatenadas na ordem das
+    páginas e valor total conferido entre os blocos (o valor informado pela
+    maioria; no empate, o do bloco mais próximo do início). Quando os blocos
+    divergem, os valores ficam em "valor_total_candidatos".
+    """
+    merged = copy.deepcopy(results[0])
+    descriptions = []
+    totals = []
+    for result in results:
+        if not result:
+            continue
+        description = (result.get("descricao_produtos") or "").strip()
+        if description and description not in descriptions:
+            descriptions.append(description)
+        if result.get("valor_total") is not None:
+            totals.append(result["valor_total"])
+    if "descricao_produtos" in merged:
+        merged["descricao_produtos"] = "\n".join(descriptions) or None
+    if totals:
+        merged["valor_total"] = max(totals, key=lambda v: (totals.count(v), -totals.index(v)))
+        if len(set(totals)) > 1:
+            merged["valor_total_candidatos"] = totals
+    merged["llm_chunks"] = len(results)
+    return merged
+
+def _check_digits(digits: str, weights) -> int:
+    total = sum(int(d) * w for d, w in zip(digits, weights))
+    rest = total % 11
+    return 0 if rest < 2 else 11 - rest
+
+def _valid_cnpj(value) -> bool:
+    digits = "".join(c for c in (value or "") if c.isdigit())
+    if len(digits) != 14 or len(set(digits)) == 1:
+        return False
+    w1 = [5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]
+    d1 = _check_digits(digits[:12], w1)
+    d2 = _check_digits(digits[:12] + str(d1), [6] + w1)
+    return digits[-2:] == f"{d1}{d2}"
+
+def _valid_cpf(value) -> bool:
+    digits = "".join(c for c in (value or "") if c.isdigit())
+    if len(digits) != 11 or len(set(digits)) == 1:
+        return False
+    d1 = _check_digits(digits[:9], range(10, 1, -1))
+    d2 = _check_digits(digits[:9] + str(d1), range(11, 1, -1))
+    return digits[-2:] == f"{d1}{d2}"
 
 class PDFProcessor:
-    def __init__(self):
+    def __init__(self, templates: Optional[dict] = None, text_backend: Optional[str] = None):
         """
-        Inicializa o processador de PDF com cliente OpenAI e Gemini
+        Inicializa o processador de PDF com cliente OpenAI e Gemini.
+        templates: templates aprendidos por fornecedor (CNPJ em dígitos -> template),
+        usados para extrair localmente PDFs de fornecedores conhecidos.
+        text_backend: backend de extração de texto (padrão: PDF_TEXT_BACKEND ou pypdf2).
         """
-        openai_key = os.getenv('OPENAI_API_KEY')
-        self.client = OpenAI(api_key=openai_key) if openai_key else None
+        # Cliente compartilhado do processo (reusa conexões entre instâncias)
+        self.client = openai_client()
         
         # Lazy: não importe/instancie Gemini no startup
         # Apenas guarde chaves/nomes; importe quando necessário
-        self.gemini_key = os.getenv('GOOGLE_API_KEY') or os.getenv('GEMINI_API_KEY')
+        self.gemini_key = gemini_key()
         self.gemini_model_name = os.getenv('GEMINI_MODEL_NAME')
         self.gemini_model = None  # será criado sob demanda
 
         # Lazy: não instancie o classificador no startup
         self.classifier = None
+
+        self.templates = templates or {}
+        self.text_backend = get_backend(text_backend)
     
-    def extract_text_from_pdf(self, pdf_file) -> str:
+    def iter_text_from_pdf(self, pdf_file) -> Iterator[str]:
         """
-        Extrai texto de um arquivo PDF
+        Gera o texto do PDF página a página, até PDF_MAX_PAGES páginas
         """
+        max_pages = int(os.getenv('PDF_MAX_PAGES') or 50)
         try:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
-            
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            
-            return text.strip()
+            for number, page_text in enumerate(self.text_backend.iter_pages(pdf_file), start=1):
+                yield page_text
+                if number >= max_pages:
+                    break
         except Exception as e:
             raise Exception(f"Erro ao extrair texto do PDF: {str(e)}")
+
+    def extract_text_from_pdf(self, pdf_file) -> str:
+        """
+        Extrai texto de um arquivo PDF
+        """
+        return "\n".join(self.iter_text_from_pdf(pdf_file)).strip()
+
+    def extract_text_until_complete(self, pdf_file) -> str:
+        """
+        Lê o PDF página a página e para assim que todos os campos obrigatórios
+        são encontrados localmente (normalmente na página 1 de um DANFE),
+        evitando processar anexos longos de produtos.
+        """
+        return "\n".join(self.extract_pages_until_complete(pdf_file)).strip()
+
+    def extract_pages_until_complete(self, pdf_file) -> List[str]:
+        """
+        Como extract_text_until_complete, mas mantém o texto separado por página.
+        Cada página nova é verificada só junto da anterior (campos que cruzam a
+        quebra de página), acumulando os campos já encontrados, em vez de
+        reprocessar todo o texto lido a cada página.
+        """
+        threshold = self._confidence_threshold()
+        pages = []
+        found = set()
+        template = None
+        template_found = set()
+        for page_text in self.iter_text_from_pdf(pdf_file):
+            window = "\n".join(pages[-1:] + [page_text])
+            pages.append(page_text)
+
+            if template is None:
+                template = match_template(self.templates, window)
+            if template:
+                template_found |= template_fields_found(template, window)
+                if template_found.issuperset(TEMPLATE_REQUIRED_FIELDS):
+                    # Confere uma única vez com as validações do template
+                    if self._extract_with_template("\n".join(pages)):
+                        break
+                    template = False
+
+            _, confidence = self._extract_fields_with_rules(window)
+            found |= {f for f in REQUIRED_FIELDS if confidence.get(f, 0.0) >= threshold}
+            if found.issuperset(REQUIRED_FIELDS):
+                break
+        return pages
+
+    def _confidence_threshold(self) -> float:
+        return float(os.getenv('RULES_CONFIDENCE_THRESHOLD') or 0.7)
     
-    def extract_invoice_data(self, pdf_text: str) -> dict:
+    def extract_invoice_data(self, pdf_text: str, pages: Optional[List[str]] = None) -> dict:
+        """
+        Extrai dados estruturados da nota fiscal. Ordem: template do fornecedor,
+        heurísticas locais com confiança por campo e, somente para os campos
+        obrigatórios ausentes/pouco confiáveis, LLM (OpenAI, depois Gemini).
+        O caminho usado fica em data["extraction_path"].
+        pages: texto por página; notas longas são enviadas ao LLM em blocos.
+        """
+        # Fornecedor com template aprendido: extração local, sem LLM
+        data = self._extract_with_template(pdf_text)
+        if data:
+            data["extraction_path"] = "template"
+            return self._classify(data)
+
+        data, confidence = self._extract_fields_with_rules(pdf_text)
+        threshold = self._confidence_threshold()
+        missing = [f for f in REQUIRED_FIELDS if confidence.get(f, 0.0) < threshold]
+        if not missing:
+            data["extraction_path"] = "rules"
+            return self._classify(data)
+
+        try:
+            llm_data = self._extract_missing_with_llm(pdf_text, missing, pages)
+        except Exception as e:
+            print(f"LLM error: {str(e)}")
+            data["extraction_path"] = "rules_fallback"
+            return self._classify(data)
+
+        for field in missing:
+            value = _get_field(llm_data, field)
+            if value not in (None, ""):
+                _set_field(data, field, value)
+        if "fornecedor.razao_social" in missing and _get_field(llm_data, "fornecedor.fantasia"):
+            _set_field(data, "fornecedor.fantasia", _get_field(llm_data, "fornecedor.fantasia"))
+        if llm_data.get("quantidade_parcelas"):
+            data["quantidade_parcelas"] = llm_data["quantidade_parcelas"]
+        for key in ("llm_chunks", "valor_total_candidatos"):
+            if key in llm_data:
+                data[key] = llm_data[key]
+        data["extraction_path"] = "llm" if len(missing) == len(REQUIRED_FIELDS) else "llm_partial"
+        data["llm_fields"] = missing
+        return self._classify(data)
+
+    def _chunk_budget(self) -> int:
+        return int(os.getenv('PDF_CHUNK_CHARS') or 12000)
+
+    def split_into_chunks(self, pages: List[str]) -> List[str]:
         """
-        Extrai dados estruturados da nota fiscal usando OpenAI GPT
+        Agrupa páginas consecutivas em blocos de até PDF_CHUNK_CHARS caracteres;
+        uma página maior que o limite é dividida em quebras de linha
+        """
+        budget = self._chunk_budget()
+        pieces = []
+        for page_text in pages:
+            if len(page_text) <= budget:
+                pieces.append(page_text)
+                continue
+            current = []
+            size = 0
+            for line in page_text.splitlines():
+                if current and size + len(line) + 1 > budget:
+                    pieces.append("\n".join(current))
+                    current, size = [], 0
+                current.append(line)
+                size += len(line) + 1
+            if current:
+                pieces.append("\n".join(current))
+
+        chunks = []
+        current = []
+        size = 0
+        for piece in pieces:
+            if current and size + len(piece) + 1 > budget:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 1
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    def _extract_missing_with_llm(self, pdf_text: str, fields, pages: Optional[List[str]] = None) -> dict:
+        """
+        Pede ao LLM os campos informados. Textos maiores que PDF_CHUNK_CHARS
+        (com o texto por página disponível) são divididos em blocos alinhados
+        às páginas e extraídos em paralelo: o primeiro bloco responde por todos
+        os campos e os seguintes só por descrição dos produtos e valor total.
+        """
+        if not pages or len(pdf_text) <= self._chunk_budget():
+            return self._extract_with_llm(self._build_prompt(pdf_text, fields), fields)
+
+        chunks = self.split_into_chunks(pages)
+        later_fields = [f for f in CHUNK_FIELDS if f in fields]
+        requests = [(chunks[0], list(fields))]
+        if later_fields:
+            requests += [(chunk, later_fields) for chunk in chunks[1:]]
+
+        workers = min(len(requests), int(os.getenv('PDF_CHUNK_WORKERS') or 4))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [
+                executor.submit(self._extract_with_llm, self._build_prompt(chunk, chunk_fields), chunk_fields)
+                for chunk, chunk_fields in requests
+            ]
+            results = []
+            for number, future in enumerate(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    if number == 0:
+                        raise
+                    print(f"LLM error no bloco {number + 1}: {str(e)}")
+                    results.append(None)
+        return merge_chunk_results(results)
+
+    def compact_text(self, pdf_text: str, fields=None) -> str:
+        """
+        Reduz o texto do PDF às partes que o JSON pede antes de montar o prompt:
+        remove linhas repetidas (cabeçalhos de cada página), textos legais e
+        seções sem campos do schema (transportador, ISSQN, dados adicionais...).
+        Com fields, também descarta seções que só alimentam campos não pedidos.
+        """
+        if os.getenv('PROMPT_COMPACTION', '1').lower() in ('0', 'false'):
+            return pdf_text
+        fields = set(fields or REQUIRED_FIELDS)
+        wanted = set()
+        for section, section_fields in COMPACTION_SECTIONS.items():
+            if section_fields is None or fields & section_fields:
+                wanted.add(section)
+
+        seen = set()
+        kept = []
+        section = "cabecalho"
+        for raw_line in (pdf_text or "").splitlines():
+            line = re.sub(r"\s+", " ", raw_line).strip()
+            if not line:
+                continue
+            for name, pattern in SECTION_HEADERS:
+                if pattern.search(line):
+                    section = name
+                    break
+            if section not in wanted or BOILERPLATE.search(line):
+                continue
+            if section == "produtos":
+                # Colunas fiscais (NCM, CST, CFOP) não entram na descrição dos produtos
+                line = FISCAL_COLUMNS.sub("", line)
+            key = line.lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            kept.append(line)
+
+        compacted = "\n".join(kept)
+        return compacted or pdf_text
+
+    def _build_prompt(self, pdf_text: str, fields) -> str:
         """
-        prompt = f"""
+        Monta o prompt pedindo apenas os campos informados
+        """
+        pdf_text = self.compact_text(pdf_text, fields)
+        # Os campos e formatos seguem no schema da resposta (response_schema)
+        return f"""
         Você é um especialista em extração de dados de notas fiscais brasileiras.
         
-        Analise o texto da nota fiscal abaixo e extraia EXATAMENTE as seguintes informações em formato JSON:
-        
-        {{
-            "fornecedor": {{
-                "razao_social": "string",
-                "fantasia": "string ou null",
-                "cnpj": "string (formato XX.XXX.XXX/XXXX-XX)"
-            }},
-            "faturado": {{
-                "nome_completo": "string",
-                "cpf": "string (formato XXX.XXX.XXX-XX)"
-            }},
-            "numero_nota_fiscal": "string",
-            "data_emissao": "string (formato YYYY-MM-DD)",
-            "descricao_produtos": "string (descrição detalhada de todos os produtos/serviços)",
-            "valor_total": "number (valor decimal)",
-            "data_vencimento": "string (formato YYYY-MM-DD)",
-            "quantidade_parcelas": 1
-        }}
+        Analise o texto da nota fiscal abaixo e preencha os campos do schema JSON.
         
         REGRAS IMPORTANTES:
         1. Se algum campo não for encontrado, use null
@@ -76,56 +511,78 @@ class PDFProcessor:
         
         Texto da nota fiscal:
         {pdf_text}
-        
-        Responda APENAS com o JSON válido:
         """
-        
-        try:
-            if self.client:
-                response = self.client.completions.create(
-                    model="gpt-3.5-turbo-instruct",
-                    prompt=prompt,
-                    max_tokens=1000,
-                    temperature=0.1
-                )
-                json_response = response.choices[0].text.strip()
-                try:
-                    data = json.loads(json_response)
-                except json.JSONDecodeError:
-                    json_response = json_response.replace("```json", "").replace("```", "").strip()
-                    data = json.loads(json_response)
-                # Classificar
-                if data.get("descricao_produtos"):
-                    if self.classifier is None:
-                        self.classifier = ExpenseClassifier()
-                    classificacao = self.classifier.classify_expense(data["descricao_produtos"])
-                    data["classificacao_despesa"] = classificacao
-                return data
-        except Exception as e:
-            print(f"OpenAI error: {str(e)}")
 
-        # Fallback: tentar Gemini; se falhar, heurísticas locais
-        try:
-            return self._extract_with_gemini(prompt)
-        except Exception as gem_err:
-            print(f"Gemini error: {str(gem_err)}")
-            return self._extract_with_rules(pdf_text)
-    
-    def _extract_with_gemini(self, prompt: str) -> dict:
+    def _extract_with_llm(self, prompt: str, fields) -> dict:
         """
-        Extrai dados usando Google Gemini como fallback
+        Envia o prompt para a OpenAI e o Gemini com hedge entre os provedores
+        (os modelos Gemini candidatos são tentados em sequência): o próximo
+        provedor começa após LLM_HEDGE_DELAY (ou na falha do anterior),
+        a primeira resposta JSON válida vence e LLM_DEADLINE limita o total.
+        A resposta é restrita ao schema dos campos pedidos (structured output)
+        e validada; prompts idênticos são respondidos pelo cache de LLM.
         """
-        # Exigir chave configurada
-        if not (self.gemini_key):
+        schema = response_schema(fields)
+        attempts = []
+        if self.client:
+            model = os.getenv('OPENAI_EXTRACTION_MODEL', 'gpt-4o-mini')
+            attempts.append((f"openai:{model}", lambda timeout: validate_llm_data(self._extract_with_openai(model, prompt, schema, timeout), fields)))
+        if self.gemini_key:
+            for name in self._gemini_candidates():
+                attempts.append((f"gemini:{name}", lambda timeout, name=name: validate_llm_data(self._extract_with_gemini(name, prompt, schema, timeout), fields)))
+        if not attempts:
             raise Exception("Erro na extração de dados: OpenAI indisponível e Gemini não configurado. Verifique as chaves de API.")
-        
-        # Importar e configurar Gemini apenas quando necessário
-        import google.generativeai as genai
         try:
-            genai.configure(api_key=self.gemini_key)
+            return hedged_call(attempts, cache=([prompt, schema], 0.1))
         except Exception as e:
-            raise Exception(f"Falha ao configurar Gemini: {e}")
+            raise Exception(f"Erro na extração de dados: {e}")
 
+    def _extract_with_openai(self, model: str, prompt: str, schema: dict, timeout: float) -> dict:
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "nota_fiscal", "strict": True, "schema": schema},
+            },
+            max_tokens=1000,
+            temperature=0.1,
+            timeout=timeout
+        )
+        message = response.choices[0].message
+        if getattr(message, "refusal", None):
+            raise Exception(f"OpenAI recusou a extração: {message.refusal}")
+        return json.loads(message.content)
+
+    def _classify(self, data: dict) -> dict:
+        if data.get("descricao_produtos"):
+            if self.classifier is None:
+                self.classifier = ExpenseClassifier()
+            data["classificacao_despesa"] = self.classifier.classify_expense(data["descricao_produtos"])
+        return data
+    
+    def _extract_with_template(self, pdf_text: str) -> Optional[dict]:
+        """
+        Extrai os campos com o template do fornecedor, se houver um aprendido.
+        O resultado passa pelas mesmas checagens das heurísticas (dígitos do
+        CNPJ/CPF e valor positivo); se falhar, segue para as heurísticas.
+        """
+        template = match_template(self.templates, pdf_text)
+        if not template:
+            return None
+        data = apply_template(template, pdf_text)
+        if not data:
+            return None
+        if not data["faturado"]["cpf"]:
+            m = re.search(r"([0-9]{3}\.[0-9]{3}\.[0-9]{3}\-[0-9]{2})", pdf_text)
+            data["faturado"]["cpf"] = m.group(1) if m else None
+        if not _valid_cnpj(data["fornecedor"]["cnpj"]) or not _valid_cpf(data["faturado"]["cpf"]):
+            return None
+        if not isinstance(data["valor_total"], float) or data["valor_total"] <= 0:
+            return None
+        return data
+
+    def _gemini_candidates(self):
         candidates = [
             self.gemini_model_name,
             "gemini-1.5-flash-001",
@@ -136,52 +593,43 @@ class PDFProcessor:
             "gemini-1.5-pro",
             "gemini-pro"
         ]
-        last_error = None
-        
-        # Tenta candidatos diretos
-        for name in [c for c in candidates if c]:
-            try:
-                model = genai.GenerativeModel(name)
-                response = model.generate_content(prompt)
-                json_response = response.text.strip()
-                try:
-                    data = json.loads(json_response)
-                except json.JSONDecodeError:
-                    json_response = json_response.replace("```json", "").replace("```", "").strip()
-                    data = json.loads(json_response)
-                if data.get("descricao_produtos"):
-                    if self.classifier is None:
-                        self.classifier = ExpenseClassifier()
-                    classificacao = self.classifier.classify_expense(data["descricao_produtos"])
-                    data["classificacao_despesa"] = classificacao
-                self.gemini_model = model
-                return data
-            except Exception as e:
-                last_error = e
-                continue
+        return list(dict.fromkeys(c for c in candidates if c))
 
-        # Evitar list_models durante execução local para reduzir chamadas remotas
-        # Apenas retorne o último erro
-        
-        raise Exception(f"Erro na extração de dados: Tanto OpenAI quanto Gemini falharam. Gemini error: {str(last_error)}")
+    def _extract_with_gemini(self, name: str, prompt: str, schema: dict, timeout: float) -> dict:
+        """
+        Extrai dados usando um modelo Google Gemini como fallback
+        """
+        model = gemini_model(name)
+        response = model.generate_content(
+            prompt,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": gemini_schema(schema),
+                "temperature": 0.1,
+            },
+            request_options={"timeout": timeout}
+        )
+        data = json.loads(response.text)
+        self.gemini_model = model
+        return data
 
-    def _extract_with_rules(self, pdf_text: str) -> dict:
+    def _extract_fields_with_rules(self, pdf_text: str):
         """
         Extração heurística local sem LLM: usa regex/padrões comuns para NF.
+        Retorna (dados, confiança por campo entre 0 e 1).
         """
         text = pdf_text or ""
         def find_regex(patterns):
-            import re
-            for p in patterns:
+            """Retorna (valor, índice do padrão que casou)"""
+            for i, p in enumerate(patterns):
                 m = re.search(p, text, re.IGNORECASE | re.MULTILINE)
                 if m:
-                    return m.group(1) if m.groups() else m.group(0)
-            return None
+                    return (m.group(1) if m.groups() else m.group(0)), i
+            return None, None
 
         def norm_date(dt):
             if not dt:
                 return None
-            from datetime import datetime
             for fmt in ["%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y", "%d.%m.%Y"]:
                 try:
                     return datetime.strptime(dt, fmt).date().isoformat()
@@ -199,32 +647,70 @@ class PDFProcessor:
             except Exception:
                 return None
 
-        cnpj = find_regex([r"CNPJ\s*[:\-]?\s*([0-9\.\/-]{14,18})"]) or find_regex([r"([0-9]{2}\.[0-9]{3}\.[0-9]{3}\/[0-9]{4}\-[0-9]{2})"])
-        cpf = find_regex([r"CPF\s*[:\-]?\s*([0-9\.\/-]{11,14})", r"([0-9]{3}\.[0-9]{3}\.[0-9]{3}\-[0-9]{2})"])
-        nf = find_regex([r"Nota Fiscal\s*(?:N[ºo]\s*)?([A-Za-z0-9\-]+)", r"NF\s*(?:N[ºo]\s*)?([A-Za-z0-9\-]+)"])
-        emissao = norm_date(find_regex([r"Emiss[aã]o\s*[:\-]?\s*([0-9]{2}\/[0-9]{2}\/[0-9]{4})", r"([0-9]{4}\-[0-9]{2}\-[0-9]{2})"]))
-        venc = norm_date(find_regex([r"Vencimento\s*[:\-]?\s*([0-9]{2}\/[0-9]{2}\/[0-9]{4})"]))
-        total = norm_money(find_regex([r"Total\s*[:\-]?\s*R?\$?\s*([0-9\.,]+)", r"Valor Total\s*[:\-]?\s*R?\$?\s*([0-9\.,]+)"]))
+        confidence = {}
+
+        cnpj, i = find_regex([r"CNPJ\s*[:\-]?\s*([0-9\.\/-]{14,18})", r"([0-9]{2}\.[0-9]{3}\.[0-9]{3}\/[0-9]{4}\-[0-9]{2})"])
+        if cnpj:
+            cnpj = cnpj.strip(".-/")
+        confidence["fornecedor.cnpj"] = (1.0 if _valid_cnpj(cnpj) else 0.4) if cnpj else 0.0
+
+        cpf, i = find_regex([r"CPF\s*[:\-]?\s*([0-9\.\/-]{11,14})", r"([0-9]{3}\.[0-9]{3}\.[0-9]{3}\-[0-9]{2})"])
+        if cpf:
+            cpf = cpf.strip(".-/")
+        confidence["faturado.cpf"] = (1.0 if _valid_cpf(cpf) else 0.4) if cpf else 0.0
+
+        nf, i = find_regex([
+            r"Nota Fiscal\s*(?:N[ºo°\.]?\s*)?[:\-]?\s*([0-9][0-9\.\-]*)",
+            r"N[ºo°]\s*[:\-]?\s*([0-9][0-9\.\-]*)",
+            r"Nota Fiscal\s*(?:N[ºo]\s*)?([A-Za-z0-9\-]+)",
+            r"NF\s*(?:N[ºo]\s*)?([A-Za-z0-9\-]+)"
+        ])
+        confidence["numero_nota_fiscal"] = [0.9, 0.8, 0.4, 0.3][i] if nf else 0.0
+
+        raw, i = find_regex([r"Emiss[aã]o\s*[:\-]?\s*([0-9]{2}\/[0-9]{2}\/[0-9]{4})", r"([0-9]{4}\-[0-9]{2}\-[0-9]{2})"])
+        emissao = norm_date(raw)
+        confidence["data_emissao"] = [0.9, 0.4][i] if emissao else 0.0
+
+        raw, i = find_regex([r"Vencimento\s*[:\-]?\s*([0-9]{2}\/[0-9]{2}\/[0-9]{4})"])
+        venc = norm_date(raw)
+        # Sem vencimento explícito, assume à vista (emissão) com baixa confiança
+        confidence["data_vencimento"] = 0.9 if venc else (0.3 if emissao else 0.0)
+
+        raw, i = find_regex([r"Valor Total\s*(?:da Nota)?\s*[:\-]?\s*R?\$?\s*([0-9\.,]+)", r"Total\s*[:\-]?\s*R?\$?\s*([0-9\.,]+)"])
+        total = norm_money(raw)
+        confidence["valor_total"] = [0.9, 0.6][i] if total else 0.0
 
         # Tentar razão social ao redor de CNPJ
         razao = None
-        if cnpj:
-            import re
+        confidence["fornecedor.razao_social"] = 0.0
+        labeled, _ = find_regex([r"Raz[aã]o Social\s*[:\-]?\s*(.+)"])
+        if labeled and len(labeled.strip()) > 2:
+            razao = labeled.strip()
+            confidence["fornecedor.razao_social"] = 0.8
+        elif cnpj:
             for m in re.finditer(re.escape(cnpj), text):
                 start = max(0, m.start() - 120)
                 snippet = text[start:m.start()]
-                cand = find_regex([r"Raz[aã]o Social\s*[:\-]?\s*(.+)"]) or snippet.strip().split("\n")[-1].strip()
+                cand = snippet.strip().split("\n")[-1].strip()
                 if cand and len(cand) > 2:
                     razao = cand
+                    # Linha anterior ao CNPJ só é confiável se não parecer um rótulo
+                    confidence["fornecedor.razao_social"] = 0.3 if re.search(r"CNPJ|:\s*$", cand, re.IGNORECASE) else 0.5
                     break
 
         descricao = None
-        # Buscar bloco de itens/descrição
-        for key in ["Descrição", "Itens", "Produtos", "Serviços"]:
-            import re
-            m = re.search(key + r"[:\-]?\s*(.+)\n", text, re.IGNORECASE)
-            if m:
-                descricao = m.group(1)
+        confidence["descricao_produtos"] = 0.2
+        # Buscar bloco de itens/descrição, ignorando cabeçalhos e textos do formulário
+        for key in [r"Descri[çc][ãa]o", "Itens", "Produtos", r"Servi[çc]os"]:
+            for m in re.finditer(key + r"\s*([:\-]?)\s*([^\n]+)", text, re.IGNORECASE):
+                candidate = m.group(2).strip()
+                if len(candidate) < 3 or not re.search(r"[A-Za-z]", candidate) or _is_layout_line(candidate):
+                    continue
+                descricao = candidate
+                # Sem ":" o rótulo pode ser só parte de um título; fica abaixo do limiar e vai ao LLM
+                confidence["descricao_produtos"] = 0.7 if m.group(1) == ":" else 0.4
+                break
+            if descricao:
                 break
         if not descricao:
             # fallback: recortar trecho central
@@ -247,40 +733,82 @@ class PDFProcessor:
             "data_vencimento": venc or emissao,
             "quantidade_parcelas": 1
         }
+        return data, confidence
 
-        if data.get("descricao_produtos"):
-            if self.classifier is None:
-                self.classifier = ExpenseClassifier()
-            cat = self.classifier.classify_expense(data["descricao_produtos"])
-            data["classificacao_despesa"] = cat
-
-        return data
-    
     def process_pdf(self, pdf_file) -> dict:
         """
-        Processa um arquivo PDF completo e retorna os dados extraídos
+        Processa um arquivo PDF completo e retorna os dados extraídos.
+        pdf_file: caminho em disco (lido via mmap) ou arquivo binário.
         """
         try:
-            # Extrair texto do PDF
-            pdf_text = self.extract_text_from_pdf(pdf_file)
+            # Extrair texto do PDF (para de ler quando os campos já foram encontrados)
+            pages = self.extract_pages_until_complete(pdf_file)
+            pdf_text = "\n".join(pages).strip()
             
             if not pdf_text:
                 raise Exception("Não foi possível extrair texto do PDF")
             
             # Extrair dados estruturados
-            invoice_data = self.extract_invoice_data(pdf_text)
+            invoice_data = self.extract_invoice_data(pdf_text, pages)
             
             # Adicionar metadados
             invoice_data["processed_at"] = datetime.now().isoformat()
-            # Removido campo 'pdf_text' do retorno conforme solicitado
+            # Removido campo 'pdf_text' dos dados retornados conforme solicitado;
+            # o texto segue à parte para o cache de extração/templates
             
             return {
                 "success": True,
-                "data": invoice_data
+                "data": invoice_data,
+                "text": pdf_text
             }
             
         except Exception as e:
             return {
                 "success": False,
                 "error": str(e)
-            }
\ No newline at end of file
+            }
+
+    def process_xml(self, xml_file) -> dict:
+        """
+        Processa o XML de uma NF-e: leitura estruturada, sem extração de texto nem LLM.
+        XML malformado ou sem NF-e volta com "invalid_input" (resposta 400 nas rotas).
+        """
+        try:
+            if isinstance(xml_file, str):
+                with open(xml_file, 'rb') as f:
+                    content = f.read()
+            else:
+                content = xml_file.read()
+            invoice_data = self._classify(parse_nfe_xml(content))
+            invoice_data["processed_at"] = datetime.now().isoformat()
+            return {
+                "success": True,
+                "data": invoice_data,
+                "text": None
+            }
+        except InvalidNFeXML as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "invalid_input": True
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+def process_pdf_path(pdf_path: str, templates: Optional[dict] = None) -> dict:
+    """
+    Processa um PDF gravado em disco. Ponto de entrada dos workers do pool
+    de processos usado no upload em lote (precisa ser picklável, por isso fica
+    no nível do módulo); recebe o caminho para não trafegar os bytes do PDF.
+    """
+    processor = PDFProcessor(templates=templates)
+    return processor.process_pdf(pdf_path)
+
+def process_xml_path(xml_path: str, templates: Optional[dict] = None) -> dict:
+    """
+    Processa o XML de uma NF-e gravado em disco (mesmo contrato de process_pdf_path)
+    """
+    return PDFProcessor(templates=templates).process_xml(xml_path)
@@ -0,0 +1,83 @@
+import mmap
+import os
+from typing import Iterator
+
+# Backends de extração de texto de PDF. O padrão é PyPDF2; cada implantação
+# pode escolher outro com a variável PDF_TEXT_BACKEND.
+
+class PDFTextBackend:
+    name = None
+
+    def iter_pages(self, pdf_file) -> Iterator[str]:
+        """
+        Gera o texto de cada página. pdf_file: caminho, bytes ou arquivo binário
+        (prefira o caminho: os backends leem direto do disco/mmap).
+        """
+        raise NotImplementedError
+
+    def extract_text(self, pdf_file) -> str:
+        return "\n".join(self.iter_pages(pdf_file)).strip()
+
+class PyPDF2Backend(PDFTextBackend):
+    name = "pypdf2"
+
+    def iter_pages(self, pdf_file) -> Iterator[str]:
+        if isinstance(pdf_file, str):
+            # Caminho em disco: mapear em memória em vez de ler o arquivo inteiro
+            with open(pdf_file, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise Exception("Arquivo PDF vazio")
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    yield from self._iter_reader(mapped)
+                finally:
+                    mapped.close()
+            return
+        if isinstance(pdf_file, (bytes, bytearray)):
+            import io
+            pdf_file = io.BytesIO(pdf_file)
+        yield from self._iter_reader(pdf_file)
+
+    def _iter_reader(self, stream) -> Iterator[str]:
+        import PyPDF2
+        reader = PyPDF2.PdfReader(stream)
+        for page in reader.pages:
+            yield page.extract_text() or ""
+
+class PdfiumBackend(PDFTextBackend):
+    """
+    Backend baseado no PDFium (pacote opcional pypdfium2). Bem mais rápido
+    que o PyPDF2 para PDFs grandes.
+    """
+    name = "pdfium"
+
+    def iter_pages(self, pdf_file) -> Iterator[str]:
+        try:
+            import pypdfium2 as pdfium
+        except ImportError:
+            raise Exception("Backend 'pdfium' requer o pacote pypdfium2 (pip install pypdfium2)")
+        document = pdfium.PdfDocument(pdf_file)
+        try:
+            for index in range(len(document)):
+                page = document[index]
+                textpage = page.get_textpage()
+                try:
+                    yield textpage.get_text_range().replace("\r\n", "\n")
+                finally:
+                    textpage.close()
+                    page.close()
+        finally:
+            document.close()
+
+BACKENDS = {
+    PyPDF2Backend.name: PyPDF2Backend,
+    PdfiumBackend.name: PdfiumBackend,
+}
+
+DEFAULT_BACKEND = PyPDF2Backend.name
+
+def get_backend(name: str = None) -> PDFTextBackend:
+    name = (name or os.getenv('PDF_TEXT_BACKEND') or DEFAULT_BACKEND).lower()
+    if name not in BACKENDS:
+        raise Exception(f"Backend de PDF desconhecido: {name}. Opções: {', '.join(sorted(BACKENDS))}")
+    return BACKENDS[name]()
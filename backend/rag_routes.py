@@ -2,26 +2,12 @@ from flask import request, jsonify
 from app import app, db
 from models import *
 import os
-import math
 import json
 import re
+import embedding_search
+import ann_index
+from llm_providers import hedged_call, openai_client, openai_key, gemini_model, gemini_key, available_gemini_models, call_provider
 
-# LLM providers
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
-
-def _cosine_similarity(a, b):
-    if not a or not b:
-        return 0.0
-    s = 0.0
-    na = 0.0
-    nb = 0.0
-    for i in range(min(len(a), len(b))):
-        s += a[i] * b[i]
-        na += a[i] * a[i]
-        nb += b[i] * b[i]
-    denom = math.sqrt(na) * math.sqrt(nb)
-    return (s / denom) if denom else 0.0
 
 def _call_llm(question, contexts):
     """Call LLM (OpenAI preferred, fallback to Gemini) with provided context.
@@ -34,11 +20,10 @@ def _call_llm(question, contexts):
     context_text = "\n\n".join([c[:4000] for c in contexts])
     user_msg = f"Contexto:\n{context_text}\n\nPergunta:\n{question}"
 
-    # Try OpenAI
-    if OPENAI_API_KEY:
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
+    attempts = []
+    client = openai_client()
+    if client:
+        def ask_openai(timeout):
             resp = client.chat.completions.create(
                 model=os.getenv('OPENAI_MODEL', 'gpt-4o-mini'),
                 messages=[
@@ -46,97 +31,63 @@ def _call_llm(question, contexts):
                     {"role": "user", "content": user_msg},
                 ],
                 temperature=0.2,
+                timeout=timeout,
             )
             return resp.choices[0].message.content
-        except Exception as e:
-            print(f"OpenAI chat completion error: {e}")
+        attempts.append((f"openai:{os.getenv('OPENAI_MODEL', 'gpt-4o-mini')}", ask_openai))
 
-    # Fallback Gemini (dinâmico)
-    if GOOGLE_API_KEY:
-        try:
-            import google.generativeai as genai
-            genai.configure(api_key=GOOGLE_API_KEY)
+    # Fallback Gemini (dinâmico): modelos preferidos em sequência e, por último,
+    # os demais modelos descobertos (list_models em cache, ver llm_providers)
+    if gemini_key():
+        def ask_gemini(name, timeout):
+            model = gemini_model(name)
+            resp = model.generate_content([system_prompt, user_msg], request_options={"timeout": timeout})
+            return resp.text
 
-            def pick_gemini_model():
-                env_model = os.getenv('GOOGLE_MODEL')
-                preferred = [
-                    'gemini-2.0-flash',
-                    'gemini-1.5-pro',
-                    'gemini-1.5-flash',
-                    'gemini-pro',
-                ]
-                try:
-                    available = []
-                    for m in genai.list_models():
-                        methods = getattr(m, 'supported_generation_methods', None)
-                        name = getattr(m, 'name', '')
-                        base = name.replace('models/', '')
-                        if methods and 'generateContent' in methods:
-                            if any(suf in base for suf in ['-exp', '-preview']) or base.endswith('-latest'):
-                                continue
-                            available.append(base)
-                    # respeita env se existir
-                    if env_model and env_model in available:
-                        return env_model, available
-                    for name in preferred:
-                        if name in available:
-                            return name, available
-                    if available:
-                        return available[0], available
-                except Exception:
-                    pass
-                # fallback conservador
-                return (env_model or 'gemini-1.5-pro'), []
-
-            first_model, available = pick_gemini_model()
-            tried = set()
-            candidates = []
-            if first_model:
-                candidates.append(first_model)
-            # adicionar preferidos e os disponíveis, mantendo ordem e sem duplicar
-            for n in ['gemini-2.0-flash', 'gemini-1.5-pro', 'gemini-1.5-flash', 'gemini-pro']:
-                if n not in candidates:
-                    candidates.append(n)
-            for n in available:
-                if n not in candidates:
-                    candidates.append(n)
+        preferred = [os.getenv('GOOGLE_MODEL'), 'gemini-2.0-flash', 'gemini-1.5-pro', 'gemini-1.5-flash', 'gemini-pro']
+        preferred = list(dict.fromkeys(n for n in preferred if n))
 
+        def ask_discovered(timeout):
             last_err = None
-            for name in candidates:
-                if name in tried:
+            for base in available_gemini_models():
+                if base in preferred:
                     continue
-                tried.add(name)
                 try:
-                    model = genai.GenerativeModel(name)
-                    resp = model.generate_content([system_prompt, user_msg])
-                    return resp.text
+                    return ask_gemini(base, timeout)
                 except Exception as e:
                     last_err = e
-                    print(f"Gemini generate_content error for {name}: {e}")
-                    continue
-            # Do not surface error string to user; signal failure
-            return None
-        except Exception as e:
-            print(f"Gemini client error: {e}")
-            return None
+                    print(f"Gemini generate_content error for {base}: {e}")
+            raise Exception(f"nenhum modelo descoberto respondeu ({last_err})")
+
+        for name in preferred:
+            attempts.append((f'gemini:{name}', lambda timeout, name=name: ask_gemini(name, timeout)))
+        attempts.append(('gemini:descoberta', ask_discovered))
 
     # No provider available
-    return None
+    if not attempts:
+        return None
+    try:
+        return hedged_call(attempts, cache=([system_prompt, user_msg], 0.2))
+    except Exception as e:
+        # Do not surface error string to user; signal failure
+        print(f"LLM error: {e}")
+        return None
 
 def _embed_text(text):
     """Create embedding for text using OpenAI or Gemini. Returns list[float]."""
-    if OPENAI_API_KEY:
+    client = openai_client()
+    if client:
         try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            resp = client.embeddings.create(
+            resp = call_provider(
+                "openai",
+                client.embeddings.create,
                 model=os.getenv('OPENAI_EMBEDDINGS_MODEL', 'text-embedding-3-small'),
                 input=text,
             )
             return resp.data[0].embedding
         except Exception:
             pass
-    if GOOGLE_API_KEY:
+    if gemini_key():
         # Gemini não tem embeddings públicos padronizados; como fallback simples, retorne None
         return None
     return None
@@ -170,7 +121,7 @@ def rag_build_embeddings():
     try:
         created = 0
         updated = 0
-        if not OPENAI_API_KEY and not GOOGLE_API_KEY:
+        if not openai_key() and not gemini_key():
             return jsonify({"error": "LLM/Embeddings não configurado"}), 400
         for entity_type, entity_id, text in _entity_texts():
             vec = _embed_text(text)
@@ -187,6 +138,12 @@ def rag_build_embeddings():
                 db.session.add(idx)
                 created += 1
         db.session.commit()
+        embedding_search.invalidate()
+        try:
+            # Atualiza o índice aproximado só com as linhas alteradas
+            ann_index.sync()
+        except Exception as e:
+            print(f"Erro ao atualizar índice ANN: {e}")
         return jsonify({"message": "Embeddings construídos", "created": created, "updated": updated}), 200
     except Exception as e:
         db.session.rollback()
@@ -199,25 +156,29 @@ def rag_embeddings_query():
         data = request.get_json() or {}
         question = data.get('question') or ''
         top_k = int(data.get('top_k') or 5)
+        # "ann" (índice aproximado, padrão) ou "exact"; RAG_SEARCH_MODE muda o padrão
+        mode = (data.get('search') or os.getenv('RAG_SEARCH_MODE') or 'ann').lower()
+        if mode not in ('ann', 'exact'):
+            return jsonify({"error": "search deve ser 'ann' ou 'exact'"}), 400
         if not question.strip():
             return jsonify({"error": "Pergunta vazia"}), 400
         qvec = _embed_text(question)
         if not qvec:
             return jsonify({"error": "Embeddings não disponíveis"}), 400
-        items = EmbeddingIndex.query.all()
-        scored = []
-        for it in items:
-            vec = it.get_embedding()
-            score = _cosine_similarity(qvec, vec)
-            scored.append((score, it.text))
-        scored.sort(key=lambda x: x[0], reverse=True)
-        contexts = [t for _, t in scored[:top_k]]
+        found = None
+        if mode == 'ann':
+            found = ann_index.search(qvec, top_k, nprobe=int(data.get('nprobe') or 0) or None)
+            if found is None:
+                mode = 'exact'
+        if found is None:
+            found = embedding_search.search(qvec, top_k)
+        contexts = [it.text for _, it in found]
         answer = _call_llm(question, contexts)
         if answer is None:
             # Fallback: return contexts without LLM answer
             summary = f"LLM indisponível. {len(contexts)} contextos relevantes encontrados."
-            return jsonify({"answer": summary, "contexts": contexts}), 200
-        return jsonify({"answer": answer, "contexts": contexts}), 200
+            return jsonify({"answer": summary, "contexts": contexts, "search": mode}), 200
+        return jsonify({"answer": answer, "contexts": contexts, "search": mode}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1,18 +1,80 @@
-from flask import request, jsonify
+from flask import request, jsonify, Response, stream_with_context
 from app import app, db
 from models import *
-from pdf_processor import PDFProcessor
+from pdf_processor import PDFProcessor, process_pdf_path, process_xml_path
+from nfe_xml import is_nfe_xml
+from upload_spool import spooled, spool_upload, hash_file, remove_quietly
 from expense_classifier import ExpenseClassifier
+from job_queue import enqueue_pdf, job_to_dict
+import category_registry
+import extraction_cache
+import extraction_stats
+import llm_cache
+import local_classifier
+import llm_providers
+from extraction_stats import record_path
+from supplier_templates import load_templates, learn_from_confirmation
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import json
+import multiprocessing
 import os
+import threading
 from datetime import datetime
 from decimal import Decimal
 
 # Lazy: instanciar processadores/classificadores apenas quando necessário
 
+# Pool de processos para extração em lote (criado sob demanda, limitado por PDF_POOL_WORKERS).
+# Workers via spawn: fork copiaria o processo web com threads (fila de jobs,
+# hedge de LLM) e locks possivelmente presos, além das conexões do banco.
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            workers = int(os.getenv('PDF_POOL_WORKERS') or (os.cpu_count() or 2))
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=max(1, workers),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pdf_pool
+
+def _reset_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+def _is_xml(filename) -> bool:
+    return (filename or '').lower().endswith('.xml')
+
+def _upload_suffix(filename) -> str:
+    return '.xml' if _is_xml(filename) else '.pdf'
+
+def _is_supported_upload(filename) -> bool:
+    return (filename or '').lower().endswith('.pdf') or _is_xml(filename)
+
+def _upload_content_error(file):
+    """
+    Confere o conteúdo de um upload .xml (sem depender só da extensão):
+    retorna a mensagem de erro, ou None se for uma NF-e
+    """
+    if not _is_xml(file.filename):
+        return None
+    head = file.stream.read(2048)
+    file.stream.seek(0)
+    return None if is_nfe_xml(head) else 'O arquivo XML enviado não é uma NF-e'
+
 @app.route('/api/upload-pdf', methods=['POST'])
 def upload_pdf():
     """
-    Endpoint para upload e processamento de PDF
+    Endpoint para upload de PDF. O processamento roda em segundo plano e a
+    resposta traz o job_id para consulta em /api/jobs/<id> (use ?sync=1 para
+    aguardar o resultado na própria requisição).
     """
     try:
         if 'file' not in request.files:
@@ -23,21 +85,208 @@ def upload_pdf():
         if file.filename == '':
             return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
         
-        if not file.filename.lower().endswith('.pdf'):
-            return jsonify({'error': 'Apenas arquivos PDF são aceitos'}), 400
-        
-        # Processar o PDF (instanciação lazy)
-        processor = PDFProcessor()
-        result = processor.process_pdf(file)
-        
-        if not result['success']:
-            return jsonify({'error': result['error']}), 500
+        if not _is_supported_upload(file.filename):
+            return jsonify({'error': 'Apenas arquivos PDF ou XML (NF-e) são aceitos'}), 400
+        content_error = _upload_content_error(file)
+        if content_error:
+            return jsonify({'error': content_error}), 400
         
-        return jsonify(result['data']), 200
+        # Modo síncrono mantido para clientes que precisam da resposta imediata
+        if request.args.get('sync', '').lower() in ('1', 'true'):
+            with spooled(file, suffix=_upload_suffix(file.filename)) as path:
+                documento_hash = hash_file(path)
+                cached = extraction_cache.lookup(documento_hash)
+                if cached is not None:
+                    record_path('cache')
+                    return jsonify(cached), 200
+
+                processor = PDFProcessor(templates=load_templates())
+                if _is_xml(file.filename):
+                    result = processor.process_xml(path)
+                else:
+                    result = processor.process_pdf(path)
+
+            if not result['success']:
+                return jsonify({'error': result['error']}), 400 if result.get('invalid_input') else 500
+
+            record_path(result['data'].get('extraction_path'))
+            result['data']['documento_hash'] = documento_hash
+            extraction_cache.store_result(documento_hash, result['data'], result['text'])
+            return jsonify(result['data']), 200
+
+        # Processar o PDF em segundo plano; o resultado fica em /api/jobs/<id>
+        # (PDFs já extraídos voltam concluídos direto do cache)
+        job = enqueue_pdf(file)
+
+        response = job_to_dict(job)
+        response['job_id'] = job.id
+        response['status_url'] = f'/api/jobs/{job.id}'
+        return jsonify(response), 200 if job.status == 'concluido' else 202
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': f'Erro interno do servidor: {str(e)}'}), 500
 
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Endpoint para consultar o status/resultado de um job de extração
+    """
+    try:
+        job = ExtracaoJob.query.get(job_id)
+        if not job:
+            return jsonify({'error': 'Job não encontrado'}), 404
+        return jsonify(job_to_dict(job)), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao buscar job: {str(e)}'}), 500
+
+@app.route('/api/upload-pdfs', methods=['POST'])
+def upload_pdfs():
+    """
+    Endpoint para upload e processamento de vários PDFs em uma única requisição.
+    Os arquivos (campo multipart "files") são processados em paralelo num pool
+    de processos. Com ?stream=1 (ou Accept: application/x-ndjson) os resultados
+    são enviados como NDJSON à medida que cada arquivo termina.
+    """
+    spooled_paths = []
+
+    def cleanup():
+        for path in spooled_paths:
+            remove_quietly(path)
+
+    try:
+        files = request.files.getlist('files') or request.files.getlist('file')
+        if not files:
+            return jsonify({'error': 'Nenhum arquivo enviado'}), 400
+
+        max_files = int(os.getenv('PDF_BATCH_MAX_FILES') or 500)
+        if len(files) > max_files:
+            return jsonify({'error': f'Máximo de {max_files} arquivos por lote'}), 400
+
+        results = []
+        pending = []
+
+        for index, file in enumerate(files):
+            filename = file.filename or ''
+            if not _is_supported_upload(filename):
+                results.append({
+                    'index': index,
+                    'filename': filename,
+                    'success': False,
+                    'error': 'Apenas arquivos PDF ou XML (NF-e) são aceitos'
+                })
+                continue
+            content_error = _upload_content_error(file)
+            if content_error:
+                results.append({'index': index, 'filename': filename, 'success': False, 'error': content_error})
+                continue
+            # Grava em disco e envia só o caminho ao pool (os bytes não passam pela memória do worker HTTP)
+            path = spool_upload(file, suffix=_upload_suffix(filename))
+            spooled_paths.append(path)
+            documento_hash = hash_file(path)
+            cached = extraction_cache.lookup(documento_hash)
+            if cached is not None:
+                record_path('cache')
+                results.append({'index': index, 'filename': filename, 'success': True, 'data': cached})
+                continue
+            pending.append((index, filename, documento_hash, path))
+
+        pool = _get_pdf_pool() if pending else None
+        templates = load_templates()
+        futures = {
+            pool.submit(process_xml_path if _is_xml(filename) else process_pdf_path, path, templates): (index, filename, documento_hash)
+            for index, filename, documento_hash, path in pending
+        }
+
+        def batch_item(future):
+            index, filename, documento_hash = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                _reset_pdf_pool()
+                result = {'success': False, 'error': 'Worker de extração encerrado inesperadamente'}
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+            item = {'index': index, 'filename': filename, 'success': result['success']}
+            if result['success']:
+                record_path(result['data'].get('extraction_path'))
+                result['data']['documento_hash'] = documento_hash
+                item['data'] = result['data']
+                extraction_cache.store_result(documento_hash, result['data'], result['text'])
+            else:
+                item['error'] = result['error']
+            return item
+
+        stream = request.args.get('stream', '').lower() in ('1', 'true') or \
+            'application/x-ndjson' in request.headers.get('Accept', '')
+        if stream:
+            def generate():
+                try:
+                    for item in results:
+                        yield json.dumps(item, ensure_ascii=False) + '\n'
+                    for future in as_completed(futures):
+                        yield json.dumps(batch_item(future), ensure_ascii=False) + '\n'
+                finally:
+                    cleanup()
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        try:
+            for future in as_completed(futures):
+                results.append(batch_item(future))
+        finally:
+            cleanup()
+        results.sort(key=lambda item: item['index'])
+        processed = sum(1 for item in results if item['success'])
+
+        return jsonify({
+            'total': len(results),
+            'processed': processed,
+            'failed': len(results) - processed,
+            'results': results
+        }), 200
+
+    except Exception as e:
+        cleanup()
+        return jsonify({'error': f'Erro interno do servidor: {str(e)}'}), 500
+
+@app.route('/api/extraction-cache/stats', methods=['GET'])
+def get_extraction_cache_stats():
+    """
+    Endpoint com contadores de hit/miss e ocupação do cache de extração
+    """
+    try:
+        return jsonify(extraction_cache.stats()), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao buscar estatísticas do cache: {str(e)}'}), 500
+
+@app.route('/api/extraction-stats', methods=['GET'])
+def get_extraction_stats():
+    """
+    Endpoint com a quantidade de documentos por caminho de extração
+    (cache, template, rules, llm_partial, llm, rules_fallback)
+    """
+    try:
+        return jsonify(extraction_stats.report()), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao buscar estatísticas de extração: {str(e)}'}), 500
+
+@app.route('/api/llm-cache/stats', methods=['GET'])
+def get_llm_cache_stats():
+    """
+    Endpoint com contadores de hit/miss e ocupação do cache de respostas de LLM
+    """
+    try:
+        return jsonify(llm_cache.stats()), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao buscar estatísticas do cache de LLM: {str(e)}'}), 500
+
+@app.route('/api/llm/health', methods=['GET'])
+def llm_health():
+    """
+    Estado dos circuit breakers dos provedores de LLM (por processo)
+    """
+    return jsonify(llm_providers.breaker_report()), 200
+
 @app.route('/api/extract-data', methods=['POST'])
 def extract_data_text():
     """
@@ -51,8 +300,9 @@ def extract_data_text():
         if not text or not isinstance(text, str):
             return jsonify({'error': 'Campo "text" (string) é obrigatório'}), 400
 
-        processor = PDFProcessor()
+        processor = PDFProcessor(templates=load_templates())
         data = processor.extract_invoice_data(text)
+        record_path(data.get('extraction_path'))
 
         # Adicionar metadados
         data['processed_at'] = datetime.now().isoformat()
@@ -95,6 +345,8 @@ def save_invoice():
         faturado_data = data.get('faturado', {})
         nome_fat = (faturado_data.get('nome_completo') or '').strip()
         cpf_fat = (faturado_data.get('cpf') or '').strip()
+        if not cpf_fat and faturado_data.get('cnpj'):
+            return jsonify({'error': 'Faturado: destinatário com CNPJ (pessoa jurídica) não é suportado; informe o CPF do faturado'}), 400
         if not cpf_fat:
             return jsonify({'error': 'Faturado: cpf é obrigatório'}), 400
         faturado = Faturado.query.filter_by(cpf=cpf_fat).first()
@@ -118,17 +370,12 @@ def save_invoice():
         db.session.add(conta_pagar)
         db.session.flush()
         
-        # Criar parcela
-        parcela = ParcelaPagar(
-            numero_parcela=1,
-            data_vencimento=datetime.strptime(data.get('data_vencimento'), '%Y-%m-%d').date(),
-            valor=_to_decimal(data.get('valor_total')),
-            conta_pagar_id=conta_pagar.id
-        )
-        db.session.add(parcela)
+        # Criar parcela(s)
+        _add_parcelas(conta_pagar, data)
         
         # Criar ou buscar tipo de despesa
         classificacao_nome = data.get('classificacao_despesa')
+        novo_tipo = False
         if classificacao_nome:
             tipo_despesa = TipoDespesa.query.filter_by(nome=classificacao_nome).first()
             
@@ -139,6 +386,7 @@ def save_invoice():
                 )
                 db.session.add(tipo_despesa)
                 db.session.flush()
+                novo_tipo = True
             
             # Criar classificação
             classificacao = ClassificacaoDespesa(
@@ -148,6 +396,11 @@ def save_invoice():
             db.session.add(classificacao)
         
         db.session.commit()
+        if novo_tipo:
+            category_registry.bump_version()
+
+        # Nota confirmada: aprender/atualizar o template do fornecedor
+        learn_from_confirmation(data)
         
         return jsonify({
             'success': True,
@@ -162,15 +415,66 @@ def save_invoice():
 @app.route('/api/expense-categories', methods=['GET'])
 def get_expense_categories():
     """
-    Endpoint para obter todas as categorias de despesas
+    Endpoint para obter todas as categorias de despesas (com ETag: clientes
+    que reenviam If-None-Match recebem 304 enquanto nada mudar)
     """
     try:
-        classifier = ExpenseClassifier()
-        categories = classifier.get_all_categories()
-        return jsonify(categories), 200
+        categories, etag = category_registry.snapshot()
+        response = jsonify(categories)
+        response.set_etag(etag)
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': f'Erro ao buscar categorias: {str(e)}'}), 500
 
+@app.route('/api/classify-batch', methods=['POST'])
+def classify_batch():
+    """
+    Endpoint para classificar várias descrições de produtos de uma vez
+    (JSON: {"descriptions": [...]}); as não resolvidas localmente vão ao LLM
+    numa única chamada por lote
+    """
+    try:
+        data = request.get_json() or {}
+        descriptions = data.get('descriptions')
+        if not isinstance(descriptions, list) or not all(isinstance(d, str) for d in descriptions):
+            return jsonify({'error': 'Informe descriptions como lista de textos'}), 400
+        max_items = int(os.getenv('CLASSIFY_BATCH_MAX_ITEMS') or 10000)
+        if len(descriptions) > max_items:
+            return jsonify({'error': f'Máximo de {max_items} descrições por requisição'}), 400
+
+        categories = ExpenseClassifier().classify_many(descriptions)
+        return jsonify({
+            'total': len(descriptions),
+            'results': [
+                {'descricao': d, 'classificacao': c}
+                for d, c in zip(descriptions, categories)
+            ]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao classificar: {str(e)}'}), 500
+
+@app.route('/api/expense-classifier', methods=['GET'])
+def get_expense_classifier_status():
+    """
+    Endpoint com o estado do classificador local de despesas
+    """
+    try:
+        return jsonify(local_classifier.status()), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao buscar classificador: {str(e)}'}), 500
+
+@app.route('/api/expense-classifier/train', methods=['POST'])
+def train_expense_classifier():
+    """
+    Endpoint para (re)treinar o classificador local com as despesas já classificadas
+    """
+    try:
+        return jsonify(local_classifier.train()), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Erro ao treinar classificador: {str(e)}'}), 500
+
 @app.route('/api/fornecedores', methods=['GET'])
 def get_fornecedores():
     """
@@ -263,6 +567,8 @@ def analyze_and_save():
             return jsonify({'error': 'Fornecedor: razao_social é obrigatório'}), 400
         if not cnpj:
             return jsonify({'error': 'Fornecedor: cnpj é obrigatório'}), 400
+        if not cpf_fat and faturado_data.get('cnpj'):
+            return jsonify({'error': 'Faturado: destinatário com CNPJ (pessoa jurídica) não é suportado; informe o CPF do faturado'}), 400
         if not cpf_fat:
             return jsonify({'error': 'Faturado: cpf é obrigatório'}), 400
         fornecedor = Fornecedor.query.filter_by(cnpj=cnpj).first()
@@ -331,13 +637,7 @@ def analyze_and_save():
         db.session.add(conta_pagar)
         db.session.flush()
 
-        parcela = ParcelaPagar(
-            numero_parcela=1,
-            data_vencimento=datetime.strptime(data.get('data_vencimento'), '%Y-%m-%d').date(),
-            valor=_to_decimal(data.get('valor_total')),
-            conta_pagar_id=conta_pagar.id
-        )
-        db.session.add(parcela)
+        _add_parcelas(conta_pagar, data)
 
         if tipo_despesa:
             # Se houver lista de classificações, criar todas; caso contrário, apenas a única
@@ -348,6 +648,7 @@ def analyze_and_save():
                         td = TipoDespesa(nome=nome, descricao=f"Categoria: {nome}")
                         db.session.add(td)
                         db.session.flush()
+                        created["tipo_despesa"] = True
                     classificacao = ClassificacaoDespesa(
                         conta_pagar_id=conta_pagar.id,
                         tipo_despesa_id=td.id
@@ -361,6 +662,11 @@ def analyze_and_save():
                 db.session.add(classificacao)
 
         db.session.commit()
+        if created["tipo_despesa"]:
+            category_registry.bump_version()
+
+        # Nota confirmada: aprender/atualizar o template do fornecedor
+        learn_from_confirmation(data)
 
         return jsonify({
             'success': True,
@@ -392,6 +698,27 @@ def health_check():
         'message': 'API funcionando corretamente',
         'timestamp': datetime.now().isoformat()
     }), 200
+def _add_parcelas(conta_pagar, data):
+    """
+    Cria as parcelas da conta: usa a lista "parcelas" (ex.: duplicatas do XML
+    da NF-e) quando presente; caso contrário, parcela única no vencimento.
+    """
+    parcelas = data.get('parcelas') or []
+    if not parcelas:
+        parcelas = [{
+            'numero_parcela': 1,
+            'data_vencimento': data.get('data_vencimento'),
+            'valor': data.get('valor_total')
+        }]
+    for i, p in enumerate(parcelas, start=1):
+        vencimento = p.get('data_vencimento') or data.get('data_vencimento')
+        db.session.add(ParcelaPagar(
+            numero_parcela=p.get('numero_parcela') or i,
+            data_vencimento=datetime.strptime(vencimento, '%Y-%m-%d').date(),
+            valor=_to_decimal(p.get('valor')),
+            conta_pagar_id=conta_pagar.id
+        ))
+
 def _to_decimal(val):
     try:
         if val is None:
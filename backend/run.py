@@ -7,8 +7,12 @@ from models import *
 from routes import *
 from crud_routes import *
 from rag_routes import *
+from job_queue import recover_jobs
+from migrate_embeddings import ensure_schema
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        ensure_schema()
+        recover_jobs()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
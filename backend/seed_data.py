@@ -1,16 +1,13 @@
 from app import app, db
 from models import TipoDespesa
-from expense_classifier import ExpenseClassifier
+from category_registry import DEFAULT_CATEGORIES, bump_version
 
 def seed_expense_categories():
     """
     Popula o banco de dados com as categorias de despesas predefinidas
     """
     with app.app_context():
-        classifier = ExpenseClassifier()
-        categories = classifier.get_all_categories()
-        
-        for category_name, subcategories in categories.items():
+        for category_name, subcategories in DEFAULT_CATEGORIES.items():
             # Verificar se a categoria já existe
             existing = TipoDespesa.query.filter_by(nome=category_name).first()
             
@@ -26,6 +23,7 @@ def seed_expense_categories():
         
         try:
             db.session.commit()
+            bump_version()
             print("Todas as categorias de despesas foram criadas com sucesso!")
         except Exception as e:
             db.session.rollback()
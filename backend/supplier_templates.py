@@ -0,0 +1,351 @@
+from db_context import independent_session
+from models import TemplateFornecedor, TemplateConfirmacao, CacheExtracao
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import json
+import os
+import re
+import threading
+import time
+
+# Templates aprendidos por fornecedor (CNPJ): para cada campo guardamos o
+# "rótulo" (âncora) que o precede no texto do PDF e o tipo do valor. Quando
+# chega um PDF do mesmo fornecedor, os campos são lidos localmente, sem LLM.
+# A descrição dos produtos (tipo "block") tem tamanho variável: é lida entre o
+# rótulo inicial e um marcador de fim (o texto que a seguia no PDF confirmado).
+
+CNPJ_PATTERN = re.compile(r"\b(\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2})\b")
+
+DATE_FORMATS = {
+    '%d/%m/%Y': r"(\d{2}/\d{2}/\d{4})",
+    '%d-%m-%Y': r"(\d{2}-\d{2}-\d{4})",
+    '%d.%m.%Y': r"(\d{2}\.\d{2}\.\d{4})",
+    '%Y-%m-%d': r"(\d{4}-\d{2}-\d{2})",
+}
+
+VALUE_PATTERNS = {
+    'nf': r"([A-Za-z0-9][A-Za-z0-9\-\./]*)",
+    'money': r"R?\$?\s*(\d[\d\.,]*\d)",
+    'cpf': r"(\d{3}\.?\d{3}\.?\d{3}-?\d{2})",
+    'text': r"([^\n]+)",
+    'block': r"([^\n][\s\S]*?)",
+}
+
+# campo -> (tipo, caminho no dicionário de extração)
+FIELDS = {
+    'numero_nota_fiscal': ('nf', ('numero_nota_fiscal',)),
+    'data_emissao': ('date', ('data_emissao',)),
+    'data_vencimento': ('date', ('data_vencimento',)),
+    'valor_total': ('money', ('valor_total',)),
+    'descricao_produtos': ('block', ('descricao_produtos',)),
+    'faturado_cpf': ('cpf', ('faturado', 'cpf')),
+    'faturado_nome': ('text', ('faturado', 'nome_completo')),
+}
+
+REQUIRED_FIELDS = ('numero_nota_fiscal', 'data_emissao', 'valor_total', 'descricao_produtos')
+
+MAX_ANCHOR_LENGTH = 40
+
+def only_digits(value) -> str:
+    return re.sub(r"\D", "", value or "")
+
+def find_cnpjs(text: str):
+    """
+    CNPJs presentes no texto (somente dígitos), na ordem em que aparecem
+    """
+    return [only_digits(m) for m in CNPJ_PATTERN.findall(text or "")]
+
+def _get_path(data: dict, path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+def _value_forms(kind: str, value):
+    """
+    Representações textuais possíveis de um valor confirmado: [(texto, formato)]
+    """
+    if value in (None, ''):
+        return []
+    if kind == 'date':
+        try:
+            dt = datetime.strptime(str(value)[:10], '%Y-%m-%d')
+        except ValueError:
+            return []
+        return [(dt.strftime(fmt), fmt) for fmt in DATE_FORMATS]
+    if kind == 'money':
+        try:
+            amount = Decimal(str(value)).quantize(Decimal('0.01'))
+        except (InvalidOperation, ValueError):
+            return []
+        us = f"{amount:,}"
+        br = us.replace(',', '_').replace('.', ',').replace('_', '.')
+        return [(br, 'br'), (br.replace('.', ''), 'br'), (us, 'us'), (us.replace(',', ''), 'us')]
+    text = str(value).strip()
+    return [(text, None)] if text else []
+
+def _value_pattern(kind: str, fmt) -> str:
+    if kind == 'date':
+        return DATE_FORMATS[fmt]
+    return VALUE_PATTERNS[kind]
+
+def _parse_value(kind: str, fmt, raw: str):
+    raw = raw.strip()
+    if kind == 'date':
+        try:
+            return datetime.strptime(raw, fmt).date().isoformat()
+        except ValueError:
+            return None
+    if kind == 'money':
+        if fmt == 'br':
+            raw = raw.replace('.', '').replace(',', '.')
+        else:
+            raw = raw.replace(',', '')
+        try:
+            return float(raw)
+        except ValueError:
+            return None
+    return raw or None
+
+def _rule_regex(rule: dict):
+    separator = r"[ \t:\-]*" if rule['same_line'] else r"[^\n]*\n\s*"
+    pattern = re.escape(rule['anchor']) + separator + _value_pattern(rule['kind'], rule['format'])
+    if rule['kind'] == 'block':
+        pattern += r"(?=\s*" + re.escape(rule['end']) + ")"
+    return re.compile(pattern)
+
+def _apply_rule(rule: dict, text: str):
+    m = _rule_regex(rule).search(text)
+    if not m:
+        return None
+    return _parse_value(rule['kind'], rule['format'], m.group(1))
+
+def _anchor_candidates(prefix: str):
+    """
+    Sufixos do texto anterior ao valor, começando em limites de palavra, do
+    menor para o maior (âncoras curtas são menos sensíveis a dados variáveis)
+    """
+    prefix = prefix.rstrip(' \t:-')[-MAX_ANCHOR_LENGTH:]
+    starts = [0] + [m.end() for m in re.finditer(r"\s+", prefix)]
+    seen = set()
+    for start in sorted(starts, reverse=True):
+        anchor = prefix[start:]
+        if len(anchor.strip()) >= 2 and anchor not in seen:
+            seen.add(anchor)
+            yield anchor
+
+def _end_candidates(suffix: str):
+    """
+    Prefixos do texto seguinte ao valor (resto da linha ou próxima linha não
+    vazia), terminando em limites de palavra, do menor para o maior
+    """
+    following = suffix.lstrip().split('\n', 1)[0].strip()[:MAX_ANCHOR_LENGTH]
+    ends = [m.start() for m in re.finditer(r"\s+", following)] + [len(following)]
+    seen = set()
+    for end in ends:
+        marker = following[:end]
+        if len(marker.strip()) >= 2 and marker not in seen:
+            seen.add(marker)
+            yield marker
+
+def _learn_rule(kind: str, value, text: str):
+    expected = [_parse_value(kind, fmt, form) for form, fmt in _value_forms(kind, value)]
+    for form, fmt in _value_forms(kind, value):
+        for m in re.finditer(re.escape(form), text):
+            line_start = text.rfind('\n', 0, m.start()) + 1
+            prefix = text[line_start:m.start()]
+            if prefix.strip():
+                candidates = [(anchor, True) for anchor in _anchor_candidates(prefix)]
+            else:
+                previous = text[:max(line_start - 1, 0)].rstrip().rsplit('\n', 1)[-1].strip()
+                candidates = [(previous[-MAX_ANCHOR_LENGTH:], False)] if previous else []
+            ends = list(_end_candidates(text[m.end():])) if kind == 'block' else [None]
+            for anchor, same_line in candidates:
+                for end in ends:
+                    rule = {'anchor': anchor, 'same_line': same_line, 'kind': kind, 'format': fmt}
+                    if end is not None:
+                        rule['end'] = end
+                    # Só aceita a regra se ela reproduz o valor confirmado no próprio texto
+                    if _apply_rule(rule, text) in expected:
+                        return rule
+    return None
+
+def _rule_reproduces(rule: dict, text: str, value) -> bool:
+    """
+    A regra lê do texto o valor confirmado? (sem valor confirmado não há o
+    que conferir)
+    """
+    expected = [_parse_value(rule['kind'], fmt, form) for form, fmt in _value_forms(rule['kind'], value)]
+    if not expected:
+        return True
+    try:
+        return _apply_rule(rule, text) in expected
+    except (KeyError, re.error):
+        return False
+
+def learn_template(text: str, data: dict) -> dict:
+    """
+    Aprende as regras de cada campo a partir do texto do PDF e dos dados confirmados
+    """
+    rules = {}
+    for field, (kind, path) in FIELDS.items():
+        rule = _learn_rule(kind, _get_path(data, path), text)
+        if rule:
+            rules[field] = rule
+    return rules
+
+def _current_rules(template: dict) -> dict:
+    rules = template.get('rules') or {}
+    # Regras de formato antigo (tipo diferente do atual) valem como ausentes
+    return {field: rule for field, rule in rules.items() if field in FIELDS and rule.get('kind') == FIELDS[field][0]}
+
+def template_fields_found(template: dict, text: str) -> set:
+    """
+    Campos cujas regras do template casam no texto (usado na leitura página a
+    página, acumulando o que cada página trouxe)
+    """
+    return {field for field, rule in _current_rules(template).items() if _apply_rule(rule, text) not in (None, '')}
+
+def apply_template(template: dict, text: str):
+    """
+    Extrai os campos com o template do fornecedor. Retorna None se algum
+    campo obrigatório não for encontrado.
+    """
+    rules = _current_rules(template)
+    if any(field not in rules for field in REQUIRED_FIELDS):
+        return None
+    values = {}
+    for field, rule in rules.items():
+        values[field] = _apply_rule(rule, text)
+    if any(values.get(field) in (None, '') for field in REQUIRED_FIELDS):
+        return None
+
+    return {
+        "fornecedor": {
+            "razao_social": template.get('razao_social'),
+            "fantasia": template.get('fantasia'),
+            "cnpj": template.get('cnpj')
+        },
+        "faturado": {
+            "nome_completo": values.get('faturado_nome'),
+            "cpf": values.get('faturado_cpf')
+        },
+        "numero_nota_fiscal": values['numero_nota_fiscal'],
+        "data_emissao": values['data_emissao'],
+        "descricao_produtos": values['descricao_produtos'],
+        "valor_total": values['valor_total'],
+        "data_vencimento": values.get('data_vencimento') or values['data_emissao'],
+        "quantidade_parcelas": 1
+    }
+
+def min_confirmations() -> int:
+    return int(os.getenv('SUPPLIER_TEMPLATE_MIN_CONFIRMATIONS') or 2)
+
+def match_template(templates: dict, text: str):
+    """
+    Template do primeiro CNPJ do texto que tenha template aprendido e
+    confirmado ao menos SUPPLIER_TEMPLATE_MIN_CONFIRMATIONS vezes
+    """
+    if not templates:
+        return None
+    minimum = min_confirmations()
+    for cnpj in find_cnpjs(text):
+        template = templates.get(cnpj)
+        if template and (template.get('confirmacoes') or 0) >= minimum:
+            return template
+    return None
+
+# ===== Persistência =====
+
+_cache = {'templates': None, 'loaded_at': 0.0}
+_cache_lock = threading.Lock()
+
+def _cache_ttl() -> float:
+    return float(os.getenv('SUPPLIER_TEMPLATES_TTL') or 60)
+
+def load_templates() -> dict:
+    """
+    Templates ativos indexados pelo CNPJ (somente dígitos), com cache em memória
+    """
+    with _cache_lock:
+        if _cache['templates'] is not None and time.time() - _cache['loaded_at'] < _cache_ttl():
+            return _cache['templates']
+    templates = {}
+    try:
+        for row in TemplateFornecedor.query.filter_by(is_active=True).all():
+            templates[only_digits(row.cnpj)] = {
+                'cnpj': row.cnpj,
+                'razao_social': row.razao_social,
+                'fantasia': row.fantasia,
+                'confirmacoes': row.confirmacoes or 0,
+                'rules': json.loads(row.template_json or '{}')
+            }
+    except Exception as e:
+        print(f"Erro ao carregar templates de fornecedor: {e}")
+    with _cache_lock:
+        _cache['templates'] = templates
+        _cache['loaded_at'] = time.time()
+    return templates
+
+def learn_from_confirmation(data: dict):
+    """
+    Chamado após salvar uma nota confirmada: usa o texto do PDF original (via
+    documento_hash no cache de extração) para aprender/atualizar o template.
+    Cada documento conta uma única confirmação. Regras gravadas que não
+    reproduzem os valores deste documento são descartadas e, se alguma delas
+    era de campo obrigatório, a contagem recomeça (o template mudou).
+    Grava numa sessão própria; retorna o total de confirmações ou None.
+    """
+    try:
+        documento_hash = (data or {}).get('documento_hash')
+        fornecedor = (data or {}).get('fornecedor') or {}
+        cnpj = (fornecedor.get('cnpj') or '').strip()
+        if not documento_hash or not cnpj:
+            return None
+        with independent_session() as session:
+            entry = session.query(CacheExtracao).filter_by(documento_hash=documento_hash).first()
+            if not entry or not entry.texto:
+                return None
+
+            rules = learn_template(entry.texto, data)
+            if not rules:
+                return None
+
+            template = session.query(TemplateFornecedor).filter_by(cnpj=cnpj).first()
+            if not template:
+                template = TemplateFornecedor(cnpj=cnpj, confirmacoes=0)
+                session.add(template)
+                previous = {}
+            else:
+                counted = session.query(TemplateConfirmacao).filter_by(
+                    template_id=template.id, documento_hash=documento_hash
+                ).first()
+                if counted:
+                    return template.confirmacoes
+                previous = json.loads(template.template_json or '{}')
+
+            failed = {
+                field for field, rule in previous.items()
+                if field not in FIELDS or not _rule_reproduces(rule, entry.texto, _get_path(data, FIELDS[field][1]))
+            }
+            for field in failed:
+                previous.pop(field)
+            if failed & set(REQUIRED_FIELDS):
+                template.confirmacoes = 0
+            # Campos não reaprendidos nesta confirmação mantêm a regra anterior
+            previous.update(rules)
+            template.razao_social = fornecedor.get('razao_social')
+            template.fantasia = fornecedor.get('fantasia')
+            template.template_json = json.dumps(previous, ensure_ascii=False)
+            template.confirmacoes = (template.confirmacoes or 0) + 1
+            confirmacoes = template.confirmacoes
+            session.flush()
+            session.add(TemplateConfirmacao(template_id=template.id, documento_hash=documento_hash))
+
+        with _cache_lock:
+            _cache['templates'] = None
+        return confirmacoes
+    except Exception as e:
+        print(f"Erro ao aprender template de fornecedor: {e}")
+        return None
@@ -0,0 +1,53 @@
+from app import app
+from contextlib import contextmanager
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Uploads são gravados em disco (em blocos) e os backends de PDF os leem via
+# mmap/caminho, para que os bytes do PDF não sejam copiados para objetos
+# Python na memória do worker.
+
+CHUNK_SIZE = 1024 * 1024
+
+def spool_dir() -> str:
+    path = os.getenv('UPLOAD_SPOOL_DIR') or os.path.join(app.instance_path, 'spool')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def spool_upload(file, suffix: str = '') -> str:
+    """
+    Copia o stream do upload (FileStorage) para um arquivo temporário e
+    retorna o caminho. Quem chama é responsável por remover o arquivo.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=spool_dir())
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            file.stream.seek(0)
+            shutil.copyfileobj(file.stream, out, CHUNK_SIZE)
+    except Exception:
+        remove_quietly(path)
+        raise
+    return path
+
+@contextmanager
+def spooled(file, suffix: str = ''):
+    path = spool_upload(file, suffix)
+    try:
+        yield path
+    finally:
+        remove_quietly(path)
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
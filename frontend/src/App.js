@@ -67,7 +67,9 @@ function App() {
   const { getRootProps, getInputProps, isDragActive } = useDropzone({
     onDrop,
     accept: {
-      'application/pdf': ['.pdf']
+      'application/pdf': ['.pdf'],
+      'text/xml': ['.xml'],
+      'application/xml': ['.xml']
     },
     multiple: false
   });
@@ -184,7 +186,7 @@ function App() {
   // Fluxo de extração
   const extractData = async () => {
     if (!file) {
-      setError('Por favor, selecione um arquivo PDF');
+      setError('Por favor, selecione um arquivo PDF ou XML');
       return;
     }
 
@@ -200,7 +202,18 @@ function App() {
       const response = await axios.post(`${API_BASE_URL}/api/upload-pdf`, formData, {
         headers: { 'Content-Type': 'multipart/form-data' },
       });
-      setExtractedData(response.data);
+      // O processamento roda em segundo plano: consultar o job até concluir
+      let job = response.data;
+      while (job.status === 'pendente' || job.status === 'processando') {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        const res = await axios.get(`${API_BASE_URL}/api/jobs/${job.job_id || job.id}`);
+        job = res.data;
+      }
+      if (job.status === 'erro') {
+        setError('Erro ao extrair dados: ' + job.error);
+        return;
+      }
+      setExtractedData(job.data);
       setSuccess('Dados extraídos com sucesso!');
     } catch (err) {
       setError('Erro ao extrair dados: ' + (err.response?.data?.error || err.message));
@@ -328,9 +341,9 @@ function App() {
                 ) : (
                   <div>
                     <div className="upload-icon">📄</div>
-                    <p><strong>Arraste e solte seu PDF aqui</strong></p>
+                    <p><strong>Arraste e solte seu PDF ou XML da NF-e aqui</strong></p>
                     <p>ou clique para selecionar o arquivo</p>
-                    <div className="file-types">Aceita apenas arquivos PDF</div>
+                    <div className="file-types">Aceita arquivos PDF e XML (NF-e)</div>
                   </div>
                 )}
               </div>